@@ -2,75 +2,99 @@
 """
 Análise Avançada de Dados - Expresso Itaporanga
 Sistema de análise de dados para insights operacionais e estratégicos
+
+Lê o mesmo banco da aplicação (DATABASE_URL ou o SQLite local). Por padrão
+a análise mantém em disco, ao lado do relatório, um estado com agregados por
+dia × status × produto × rota e, a cada execução, recalcula só os dias com
+entregas alteradas desde a anterior. Sem o estado, contagens e
+agrupamentos rodam no banco e apenas as estatísticas de tempo por status
+leem as linhas, em lotes de duas colunas com tipos compactos.
+
+Uso:
+    python analise_avancada_entregas.py
+    python analise_avancada_entregas.py --banco postgresql://... --medir
+    python analise_avancada_entregas.py --saida relatorios/analise.json
+    python analise_avancada_entregas.py --reconstruir
+    python analise_avancada_entregas.py --sem-estado
+    python analise_avancada_entregas.py --snapshot snapshots
 """
 
-import sqlite3
-import pandas as pd
-import matplotlib.pyplot as plt
-from datetime import datetime, timedelta
+import argparse
 import json
 import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import matplotlib.pyplot as plt
+
+# Adicionar o diretório src ao path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from consultas_analiticas import TAMANHO_LOTE, ConsultasAnaliticas, EstadoAnalitico, conectar  # noqa: E402
 
 # Configuração de estilo para gráficos
 plt.style.use('default')
 plt.rcParams['figure.figsize'] = (10, 6)
 
+SAIDA_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'relatorio_analise_completa.json')
+
+
+def caminho_estado(saida):
+    """Arquivo do estado incremental correspondente a um relatório"""
+    return os.path.splitext(saida)[0] + '.estado.npz'
+
+
 class AnalisadorEntregas:
-    def __init__(self, db_path):
-        self.db_path = db_path
-        self.df_entregas = None
+    def __init__(self, url=None, tamanho_lote=TAMANHO_LOTE, estado=None, reconstruir=False, snapshot=None):
+        self.engine = conectar(url)
+        self.consultas = ConsultasAnaliticas(self.engine, tamanho_lote)
+        self.estado = estado
+        self.reconstruir = reconstruir
+        self.snapshot = snapshot
+        self.indicadores = None
         self.carregar_dados()
     
+    @property
+    def total_entregas(self):
+        return self.indicadores['total']
+    
     def carregar_dados(self):
-        """Carrega dados do banco SQLite para DataFrame pandas"""
+        """Atualiza o estado incremental (se houver) e carrega os totais gerais.
+        
+        Com um snapshot Parquet o banco não é consultado; sem estado nem
+        snapshot, as demais análises consultam o banco sob demanda.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            query = """
-            SELECT 
-                id,
-                codigo_rastreamento,
-                remetente_nome,
-                remetente_cidade,
-                destinatario_nome,
-                destinatario_cidade,
-                tipo_produto,
-                peso,
-                valor_declarado,
-                status,
-                data_criacao,
-                data_atualizacao
-            FROM entrega
-            ORDER BY data_criacao DESC
-            """
-            
-            self.df_entregas = pd.read_sql_query(query, conn)
-            
-            # Converter datas
-            self.df_entregas['data_criacao'] = pd.to_datetime(self.df_entregas['data_criacao'])
-            self.df_entregas['data_atualizacao'] = pd.to_datetime(self.df_entregas['data_atualizacao'])
-            
-            # Calcular tempo de processamento
-            self.df_entregas['tempo_processamento'] = (
-                self.df_entregas['data_atualizacao'] - self.df_entregas['data_criacao']
-            ).dt.total_seconds() / 3600  # em horas
-            
-            conn.close()
-            print(f"✅ Dados carregados: {len(self.df_entregas)} entregas")
-            
+            if self.snapshot:
+                from exportar_parquet import COLUNAS_ANALISE, ler_snapshot, linhas_para_estado
+                estado = EstadoAnalitico()
+                estado.aplicar(linhas_para_estado(ler_snapshot(self.snapshot, COLUNAS_ANALISE)))
+                print(f"📂 Snapshot carregado: {self.snapshot}")
+                self.consultas = estado
+            elif self.estado:
+                estado = EstadoAnalitico() if self.reconstruir else EstadoAnalitico.carregar(self.estado)
+                relidas = estado.atualizar(self.consultas)
+                estado.salvar(self.estado)
+                print(f"🔄 Estado atualizado: {relidas} entregas relidas ({self.estado})")
+                self.consultas = estado
+            self.indicadores = self.consultas.indicadores()
+            print(f"✅ Dados carregados: {self.total_entregas} entregas")
         except Exception as e:
             print(f"❌ Erro ao carregar dados: {e}")
     
+    def _percentual(self, quantidade):
+        return quantidade / self.total_entregas * 100 if self.total_entregas else 0.0
+    
     def analise_distribuicao_status(self):
         """Análise da distribuição de status das entregas"""
         print("\n📊 ANÁLISE DE DISTRIBUIÇÃO DE STATUS")
         print("=" * 50)
         
-        status_counts = self.df_entregas['status'].value_counts()
-        status_percentual = (status_counts / len(self.df_entregas) * 100).round(2)
-        
+        status_counts = self.consultas.contagem_status()
         for status, count in status_counts.items():
-            percentual = status_percentual[status]
-            print(f"{status.upper():<15}: {count:>3} entregas ({percentual:>5.1f}%)")
+            print(f"{status.upper():<15}: {count:>3} entregas ({self._percentual(count):>5.1f}%)")
         
         return status_counts
     
@@ -79,31 +103,20 @@ class AnalisadorEntregas:
         print("\n📦 ANÁLISE DE PRODUTOS TRANSPORTADOS")
         print("=" * 50)
         
-        produtos_counts = self.df_entregas['tipo_produto'].value_counts()
-        produtos_percentual = (produtos_counts / len(self.df_entregas) * 100).round(2)
-        
+        produtos_counts = self.consultas.contagem_produtos()
         for produto, count in produtos_counts.items():
-            percentual = produtos_percentual[produto]
-            print(f"{produto.upper():<15}: {count:>3} entregas ({percentual:>5.1f}%)")
+            print(f"{str(produto).upper():<15}: {count:>3} entregas ({self._percentual(count):>5.1f}%)")
         
         return produtos_counts
     
-    def analise_rotas(self):
+    def analise_rotas(self, limite=5):
         """Análise das rotas mais utilizadas"""
         print("\n🗺️  ANÁLISE DE ROTAS")
         print("=" * 50)
         
-        # Criar coluna de rota
-        self.df_entregas['rota'] = (
-            self.df_entregas['remetente_cidade'] + ' → ' + 
-            self.df_entregas['destinatario_cidade']
-        )
-        
-        rotas_counts = self.df_entregas['rota'].value_counts()
-        
-        for rota, count in rotas_counts.head(5).items():
-            percentual = (count / len(self.df_entregas) * 100)
-            print(f"{rota:<30}: {count:>3} entregas ({percentual:>5.1f}%)")
+        rotas_counts = self.consultas.contagem_rotas(limite)
+        for rota, count in rotas_counts.items():
+            print(f"{rota:<30}: {count:>3} entregas ({self._percentual(count):>5.1f}%)")
         
         return rotas_counts
     
@@ -112,18 +125,12 @@ class AnalisadorEntregas:
         print("\n📅 ANÁLISE TEMPORAL")
         print("=" * 50)
         
-        # Entregas por dia da semana
-        self.df_entregas['dia_semana'] = self.df_entregas['data_criacao'].dt.day_name()
-        dias_counts = self.df_entregas['dia_semana'].value_counts()
-        
+        dias_counts = self.consultas.por_dia_semana()
         print("Entregas por dia da semana:")
         for dia, count in dias_counts.items():
             print(f"{dia:<10}: {count:>3} entregas")
         
-        # Entregas por mês
-        self.df_entregas['mes'] = self.df_entregas['data_criacao'].dt.strftime('%Y-%m')
-        meses_counts = self.df_entregas['mes'].value_counts().sort_index()
-        
+        meses_counts = self.consultas.por_mes()
         print("\nEntregas por mês:")
         for mes, count in meses_counts.items():
             print(f"{mes}: {count:>3} entregas")
@@ -135,24 +142,16 @@ class AnalisadorEntregas:
         print("\n⚡ ANÁLISE DE PERFORMANCE")
         print("=" * 50)
         
-        # Tempo médio de processamento por status
-        tempo_por_status = self.df_entregas.groupby('status')['tempo_processamento'].agg([
-            'mean', 'median', 'std', 'min', 'max'
-        ]).round(2)
-        
+        tempo_por_status = self.consultas.tempo_por_status()
         print("Tempo de processamento por status (em horas):")
         print(tempo_por_status)
         
-        # Estatísticas gerais
-        total_entregas = len(self.df_entregas)
-        entregues = len(self.df_entregas[self.df_entregas['status'] == 'entregue'])
-        taxa_sucesso = (entregues / total_entregas * 100)
-        
+        entregues = self.indicadores['entregues']
         print(f"\n📈 INDICADORES GERAIS:")
-        print(f"Total de entregas: {total_entregas}")
+        print(f"Total de entregas: {self.total_entregas}")
         print(f"Entregas concluídas: {entregues}")
-        print(f"Taxa de sucesso: {taxa_sucesso:.1f}%")
-        print(f"Tempo médio de processamento: {self.df_entregas['tempo_processamento'].mean():.1f}h")
+        print(f"Taxa de sucesso: {self._percentual(entregues):.1f}%")
+        print(f"Tempo médio de processamento: {self.indicadores['tempo_medio']:.1f}h")
         
         return tempo_por_status
     
@@ -161,83 +160,97 @@ class AnalisadorEntregas:
         print("\n💰 ANÁLISE DE VALOR E PESO")
         print("=" * 50)
         
-        # Remover valores nulos
-        df_clean = self.df_entregas.dropna(subset=['valor_declarado', 'peso'])
-        
-        if len(df_clean) > 0:
-            print(f"Valor declarado médio: R$ {df_clean['valor_declarado'].mean():.2f}")
-            print(f"Valor declarado total: R$ {df_clean['valor_declarado'].sum():.2f}")
-            print(f"Peso médio: {df_clean['peso'].mean():.2f} kg")
-            print(f"Peso total: {df_clean['peso'].sum():.2f} kg")
-            
-            # Análise por tipo de produto
-            valor_por_produto = df_clean.groupby('tipo_produto')['valor_declarado'].agg([
-                'mean', 'sum', 'count'
-            ]).round(2)
+        valor_peso = self.consultas.valor_peso()
+        if valor_peso['total']:
+            print(f"Valor declarado médio: R$ {valor_peso['valor_medio']:.2f}")
+            print(f"Valor declarado total: R$ {valor_peso['valor_total']:.2f}")
+            print(f"Peso médio: {valor_peso['peso_medio']:.2f} kg")
+            print(f"Peso total: {valor_peso['peso_total']:.2f} kg")
             
             print("\nValor por tipo de produto:")
-            print(valor_por_produto)
+            print(valor_peso['por_produto'])
         else:
             print("Dados de valor e peso não disponíveis")
     
-    def gerar_relatorio_completo(self):
+    def gerar_relatorio_completo(self, saida=SAIDA_PADRAO):
         """Gera relatório completo de análise"""
         print("\n" + "="*60)
         print("🚚 RELATÓRIO COMPLETO DE ANÁLISE - EXPRESSO ITAPORANGA")
         print("="*60)
         print(f"Data da análise: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
-        print(f"Período analisado: {self.df_entregas['data_criacao'].min().strftime('%d/%m/%Y')} a {self.df_entregas['data_criacao'].max().strftime('%d/%m/%Y')}")
+        if self.indicadores['inicio'] is not None:
+            print(f"Período analisado: {self.indicadores['inicio'].strftime('%d/%m/%Y')} a {self.indicadores['fim'].strftime('%d/%m/%Y')}")
         
         # Executar todas as análises
         status_dist = self.analise_distribuicao_status()
         produtos_dist = self.analise_produtos()
         rotas_dist = self.analise_rotas()
         dias_counts, meses_counts = self.analise_temporal()
-        performance = self.analise_performance()
+        self.analise_performance()
         self.analise_valor_peso()
         
         # Salvar resultados em JSON
         resultados = {
             'data_analise': datetime.now().isoformat(),
-            'total_entregas': len(self.df_entregas),
+            'total_entregas': self.total_entregas,
             'distribuicao_status': status_dist.to_dict(),
             'distribuicao_produtos': produtos_dist.to_dict(),
-            'rotas_principais': rotas_dist.head(5).to_dict(),
+            'rotas_principais': rotas_dist.to_dict(),
             'entregas_por_dia_semana': dias_counts.to_dict(),
             'entregas_por_mes': meses_counts.to_dict(),
             'indicadores': {
-                'taxa_sucesso': (len(self.df_entregas[self.df_entregas['status'] == 'entregue']) / len(self.df_entregas) * 100),
-                'tempo_medio_processamento': float(self.df_entregas['tempo_processamento'].mean()),
-                'total_valor_declarado': float(self.df_entregas['valor_declarado'].sum()) if not self.df_entregas['valor_declarado'].isna().all() else 0,
-                'peso_total': float(self.df_entregas['peso'].sum()) if not self.df_entregas['peso'].isna().all() else 0
+                'taxa_sucesso': self._percentual(self.indicadores['entregues']),
+                'tempo_medio_processamento': self.indicadores['tempo_medio'],
+                'total_valor_declarado': self.indicadores['valor_total'],
+                'peso_total': self.indicadores['peso_total']
             }
         }
         
         # Salvar em arquivo JSON
-        with open('/home/ubuntu/relatorio_analise_completa.json', 'w', encoding='utf-8') as f:
+        with open(saida, 'w', encoding='utf-8') as f:
             json.dump(resultados, f, indent=2, ensure_ascii=False)
         
-        print(f"\n✅ Relatório salvo em: /home/ubuntu/relatorio_analise_completa.json")
+        print(f"\n✅ Relatório salvo em: {saida}")
         
         return resultados
 
+
 def main():
     """Função principal"""
-    db_path = '/home/ubuntu/site_integrado_expresso/src/instance/expresso_itaporanga.db'
+    parser = argparse.ArgumentParser(description='Análise avançada das entregas da Expresso Itaporanga')
+    parser.add_argument('--banco', help='URL do banco (padrão: DATABASE_URL ou o SQLite da aplicação)')
+    parser.add_argument('--saida', default=SAIDA_PADRAO, help='Arquivo JSON do relatório')
+    parser.add_argument('--lote', type=int, default=TAMANHO_LOTE, help='Linhas por lote nas leituras em memória')
+    parser.add_argument('--estado', help='Arquivo do estado incremental (padrão: ao lado do relatório)')
+    parser.add_argument('--reconstruir', action='store_true', help='Ignora o estado salvo e relê todas as entregas')
+    parser.add_argument('--sem-estado', action='store_true', help='Calcula tudo no banco, sem estado incremental')
+    parser.add_argument('--snapshot', help='Pasta de snapshots Parquet (ver exportar_parquet.py) no lugar do banco')
+    parser.add_argument('--medir', action='store_true', help='Mostra tempo total e pico de memória da análise')
+    args = parser.parse_args()
     
-    if not os.path.exists(db_path):
-        print(f"❌ Banco de dados não encontrado: {db_path}")
-        return
+    if args.medir:
+        tracemalloc.start()
+        inicio = time.perf_counter()
     
+    os.makedirs(os.path.dirname(os.path.abspath(args.saida)), exist_ok=True)
+
     # Criar analisador
-    analisador = AnalisadorEntregas(db_path)
+    estado = None if args.sem_estado or args.snapshot else (args.estado or caminho_estado(args.saida))
+    analisador = AnalisadorEntregas(args.banco, args.lote, estado, args.reconstruir, args.snapshot)
+    if analisador.indicadores is None:
+        return
     
     # Gerar relatório completo
-    resultados = analisador.gerar_relatorio_completo()
+    analisador.gerar_relatorio_completo(args.saida)
     
     print("\n🎯 ANÁLISE CONCLUÍDA COM SUCESSO!")
     print("Todos os dados foram processados e o relatório foi gerado.")
 
+    if args.medir:
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"⏱️  Tempo total: {time.perf_counter() - inicio:.2f}s | pico de memória: {pico / 2**20:.1f} MiB")
+
+
 if __name__ == "__main__":
     main()
-
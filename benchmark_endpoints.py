@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark dos endpoints críticos - Expresso Itaporanga
+
+Popula um banco SQLite temporário com um grande volume de entregas, mede o
+tempo de resposta de cada endpoint através do test client do Flask, confere
+o orçamento de consultas SQL por requisição e salva os resultados em JSON.
+Quando um resultado anterior é informado, aponta as regressões entre commits.
+
+Uso:
+    python benchmark_endpoints.py --entregas 50000 --saida bench_atual.json
+    python benchmark_endpoints.py --comparar bench_anterior.json
+    python benchmark_endpoints.py --serializacao 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Adicionar o diretório src ao path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+# Número máximo de consultas SQL por requisição em cada endpoint. O valor não
+# pode depender do volume de dados: crescer com o número de linhas indica N+1.
+# Rastreio, listagem e criação incluem a verificação de versão e a carga do
+# grafo de rotas (previsão de entrega e atribuição de rota), que só ocorrem
+# com o cache frio.
+ORCAMENTO_CONSULTAS = {
+    'api_rastrear': 3,
+    'api_entregas': 3,
+    'api_estatisticas': 6,
+    'dashboard': 4,
+    'api_criar_entrega': 4,
+    'api_atualizar_status': 3,  # SELECT, UPDATE e o esboço de tempo
+}
+
+CIDADES_ORIGEM = ['São Paulo/SP', 'Guarulhos/SP', 'Recife/PE', 'Campinas/SP']
+CIDADES_DESTINO = ['Itaporanga/PB', 'Campina Grande/PB', 'Sousa/PB', 'Patos/PB',
+                   'Cajazeiras/PB', 'Piancó/PB', 'João Pessoa/PB']
+PRODUTOS = ['Eletrônicos', 'Roupas', 'Livros', 'Medicamentos', 'Documentos',
+            'Cosméticos', 'Calçados', 'Informática']
+STATUS = ['pendente', 'coletado', 'em_transito', 'entregue', 'cancelado']
+
+NOVA_ENTREGA = {
+    'remetente_nome': 'Benchmark Remetente',
+    'remetente_endereco': 'Rua do Teste, 1',
+    'remetente_cidade': 'São Paulo/SP',
+    'destinatario_nome': 'Benchmark Destinatário',
+    'destinatario_endereco': 'Rua do Teste, 2',
+    'destinatario_cidade': 'Itaporanga/PB',
+    'tipo_produto': 'Documentos',
+    'peso': 1.0,
+    'valor_declarado': 100.0
+}
+
+
+class ContadorConsultas:
+    """Conta as consultas SQL executadas em um engine enquanto estiver ativo"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.total = 0
+
+    def _contar(self, conn, cursor, statement, parameters, context, executemany):
+        self.total += 1
+
+    def __enter__(self):
+        from sqlalchemy import event
+        self.total = 0
+        event.listen(self.engine, 'before_cursor_execute', self._contar)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._contar)
+        return False
+
+
+def semear_entregas(db, Entrega, total, lote=5000, semente=42):
+    """Insere `total` entregas sintéticas em lotes e retorna os códigos gerados"""
+    rnd = random.Random(semente)
+    agora = datetime.utcnow()
+    codigos = []
+
+    for inicio in range(0, total, lote):
+        linhas = []
+        for i in range(inicio, min(inicio + lote, total)):
+            criacao = agora - timedelta(days=rnd.randint(0, 365), minutes=rnd.randint(0, 1439))
+            codigo = f'EB{i:010d}'
+            codigos.append(codigo)
+            linhas.append({
+                'codigo_rastreamento': codigo,
+                'remetente_nome': f'Remetente {i}',
+                'remetente_endereco': f'Rua {i % 500}, {i % 1000}',
+                'remetente_cidade': rnd.choice(CIDADES_ORIGEM),
+                'destinatario_nome': f'Destinatário {i}',
+                'destinatario_endereco': f'Av. {i % 700}, {i % 900}',
+                'destinatario_cidade': rnd.choice(CIDADES_DESTINO),
+                'tipo_produto': rnd.choice(PRODUTOS),
+                'peso': round(rnd.uniform(0.1, 30.0), 2),
+                'valor_declarado': round(rnd.uniform(10.0, 5000.0), 2),
+                'observacoes': '',
+                'status': rnd.choice(STATUS),
+                'data_criacao': criacao,
+                'data_atualizacao': criacao + timedelta(hours=rnd.randint(0, 120))
+            })
+        db.session.execute(db.insert(Entrega), linhas)
+        db.session.commit()
+
+    # Inserções em massa não passam pelos eventos do ORM: normalizar as cidades
+    # deixa os dados como em produção (e o cache de cidades aquecido)
+    from app import normalizar_cidades
+    normalizar_cidades()
+
+    return codigos
+
+
+def cenarios(codigos):
+    """Requisições medidas por endpoint: (nome, método, url, corpo, requer_login, status_esperado)"""
+    rnd = random.Random(7)
+    return [
+        ('api_rastrear', 'get', lambda: f'/api/rastrear/{rnd.choice(codigos)}', None, False, 200),
+        ('api_entregas', 'get', lambda: '/api/entregas', None, False, 200),
+        ('api_estatisticas', 'get', lambda: '/api/estatisticas', None, False, 200),
+        ('dashboard', 'get', lambda: '/gestao/dashboard', None, True, 200),
+        ('api_criar_entrega', 'post', lambda: '/api/entregas', lambda: NOVA_ENTREGA, False, 201),
+        ('api_atualizar_status', 'put', lambda: f'/api/entregas/{rnd.choice(codigos)}/status',
+         lambda: {'status': rnd.choice(STATUS)}, False, 200),
+    ]
+
+
+def autenticar(cliente):
+    """Simula uma sessão de gestão autenticada no test client"""
+    with cliente.session_transaction() as sessao:
+        sessao['user_id'] = 1
+        sessao['username'] = 'benchmark'
+        sessao['perfil'] = 'admin'
+        sessao['login_time'] = datetime.now().isoformat()
+
+
+def medir_endpoint(cliente, engine, metodo, url, corpo, repeticoes):
+    """Executa a requisição `repeticoes` vezes; retorna tempos, consultas e os status de cada uma"""
+    tempos = []
+    consultas = 0
+    status_codes = []
+
+    for _ in range(repeticoes):
+        kwargs = {'json': corpo()} if corpo else {}
+        with ContadorConsultas(engine) as contador:
+            inicio = time.perf_counter()
+            response = getattr(cliente, metodo)(url(), **kwargs)
+            tempos.append((time.perf_counter() - inicio) * 1000)
+        consultas = max(consultas, contador.total)
+        status_codes.append(response.status_code)
+
+    return tempos, consultas, status_codes
+
+
+def resumir_tempos(tempos):
+    """Resumo estatístico dos tempos em milissegundos"""
+    ordenados = sorted(tempos)
+    p95 = ordenados[min(len(ordenados) - 1, int(round(0.95 * (len(ordenados) - 1))))]
+    return {
+        'min': round(ordenados[0], 3),
+        'mediana': round(statistics.median(ordenados), 3),
+        'p95': round(p95, 3),
+        'max': round(ordenados[-1], 3)
+    }
+
+
+def medir_cenarios(app, db, codigos, repeticoes=5):
+    """Mede todos os cenários na aplicação informada"""
+    cliente = app.test_client()
+    autenticar(cliente)
+    resultados = {}
+
+    for nome, metodo, url, corpo, requer_login, status_esperado in cenarios(codigos):
+        if requer_login:
+            autenticar(cliente)
+        tempos, consultas, status_codes = medir_endpoint(cliente, db.engine, metodo, url, corpo, repeticoes)
+        status_code = status_codes[-1]
+        resultados[nome] = {
+            'status': status_code,
+            'status_esperado': status_esperado,
+            # Uma resposta de erro mede outro caminho do código: a execução falha
+            'status_inesperados': sorted({s for s in status_codes if s != status_esperado}),
+            'consultas': consultas,
+            'orcamento_consultas': ORCAMENTO_CONSULTAS[nome],
+            'tempo_ms': resumir_tempos(tempos)
+        }
+        print(f"{nome:<22} status={status_code} consultas={consultas:>2} "
+              f"mediana={resultados[nome]['tempo_ms']['mediana']:>9.2f} ms")
+
+    return resultados
+
+
+def _medir_execucao(funcao):
+    """Tempo de CPU (ms), pico de memória alocada (MB) e resultado da função"""
+    tracemalloc.start()
+    inicio = time.process_time()
+    resultado = funcao()
+    cpu_ms = (time.process_time() - inicio) * 1000
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(cpu_ms, 1), round(pico / (1024 * 1024), 1), resultado
+
+
+def medir_serializacao(app, db, Entrega, total):
+    """Compara a listagem via objetos do ORM + jsonify com o serializador de tuplas"""
+    from flask import jsonify
+    from app import SERIALIZADOR_ENTREGA_LISTA
+    from serializacao import codificar
+
+    def via_orm():
+        entregas = Entrega.query.order_by(Entrega.id).limit(total).all()
+        dados = [{
+            'id': e.id,
+            'codigo_rastreamento': e.codigo_rastreamento,
+            'remetente_nome': e.remetente_nome,
+            'remetente_cidade': e.remetente_cidade,
+            'destinatario_nome': e.destinatario_nome,
+            'destinatario_cidade': e.destinatario_cidade,
+            'tipo_produto': e.tipo_produto,
+            'peso': e.peso,
+            'valor_declarado': e.valor_declarado,
+            'status': e.status,
+            'data_criacao': e.data_criacao.isoformat() if e.data_criacao else None,
+            'data_atualizacao': e.data_atualizacao.isoformat() if e.data_atualizacao else None
+        } for e in entregas]
+        with app.test_request_context():
+            corpo = jsonify({'success': True, 'data': dados, 'total': len(dados)}).get_data()
+        db.session.expunge_all()
+        return len(corpo)
+
+    def via_serializador():
+        linhas = db.session.execute(
+            db.select(*SERIALIZADOR_ENTREGA_LISTA.colunas).order_by(Entrega.id).limit(total)
+        )
+        dados = SERIALIZADOR_ENTREGA_LISTA.lista(linhas)
+        return len(codificar({'success': True, 'data': dados, 'total': len(dados)}))
+
+    resultados = {}
+    for nome, funcao in (('orm_jsonify', via_orm), ('tuplas_orjson', via_serializador)):
+        cpu_ms, pico_mb, tamanho = _medir_execucao(funcao)
+        resultados[nome] = {'cpu_ms': cpu_ms, 'pico_memoria_mb': pico_mb, 'bytes': tamanho}
+        print(f"{nome:<15} cpu={cpu_ms:>9.1f} ms  pico={pico_mb:>7.1f} MB  resposta={tamanho} bytes")
+
+    return resultados
+
+
+def commit_atual():
+    """Hash curto do commit atual, quando disponível"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def executar_benchmark(total_entregas, repeticoes, linhas_serializacao=0):
+    """Cria um banco temporário, popula os dados e mede os endpoints"""
+    diretorio = tempfile.mkdtemp(prefix='bench_expresso_')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(diretorio, 'bench.db')}"
+
+    from app import app, db, Entrega
+
+    with app.app_context():
+        db.create_all()
+        print(f"🚀 Populando {total_entregas} entregas...")
+        inicio = time.perf_counter()
+        codigos = semear_entregas(db, Entrega, total_entregas)
+        print(f"✅ Dados populados em {time.perf_counter() - inicio:.1f}s\n")
+
+        endpoints = medir_cenarios(app, db, codigos, repeticoes)
+
+        serializacao = None
+        if linhas_serializacao:
+            print(f"\n📦 Serialização de {linhas_serializacao} linhas:")
+            serializacao = medir_serializacao(app, db, Entrega, linhas_serializacao)
+
+    return {
+        'commit': commit_atual(),
+        'data': datetime.now().isoformat(),
+        'entregas': total_entregas,
+        'repeticoes': repeticoes,
+        'endpoints': endpoints,
+        'serializacao': serializacao
+    }
+
+
+def verificar_orcamentos(resultados):
+    """Lista os endpoints que excederam o orçamento de consultas"""
+    return [
+        f"{nome}: {dados['consultas']} consultas (orçamento {dados['orcamento_consultas']})"
+        for nome, dados in resultados['endpoints'].items()
+        if dados['consultas'] > dados['orcamento_consultas']
+    ]
+
+
+def verificar_status(resultados):
+    """Lista os endpoints com alguma resposta diferente do status esperado"""
+    return [
+        f"{nome}: status {', '.join(map(str, dados['status_inesperados']))} (esperado {dados['status_esperado']})"
+        for nome, dados in resultados['endpoints'].items()
+        if dados['status_inesperados']
+    ]
+
+
+def comparar_resultados(atuais, anteriores, tolerancia=0.2, piso_ms=1.0):
+    """Compara com uma execução anterior e lista as regressões encontradas.
+
+    Um endpoint regride quando faz mais consultas que antes ou quando a mediana
+    cresce acima da tolerância relativa (e acima de `piso_ms`, para ignorar ruído).
+    """
+    regressoes = []
+
+    for nome, dados in atuais['endpoints'].items():
+        anterior = anteriores.get('endpoints', {}).get(nome)
+        if not anterior:
+            continue
+
+        if dados['consultas'] > anterior['consultas']:
+            regressoes.append(f"{nome}: consultas {anterior['consultas']} → {dados['consultas']}")
+
+        mediana_atual = dados['tempo_ms']['mediana']
+        mediana_anterior = anterior['tempo_ms']['mediana']
+        if (mediana_atual > mediana_anterior * (1 + tolerancia)
+                and mediana_atual - mediana_anterior > piso_ms):
+            regressoes.append(
+                f"{nome}: mediana {mediana_anterior:.2f} ms → {mediana_atual:.2f} ms "
+                f"(+{(mediana_atual / mediana_anterior - 1) * 100:.0f}%)"
+            )
+
+    return regressoes
+
+
+def main():
+    """Função principal"""
+    parser = argparse.ArgumentParser(description='Benchmark dos endpoints da Expresso Itaporanga')
+    parser.add_argument('--entregas', type=int, default=50000, help='Número de entregas geradas')
+    parser.add_argument('--repeticoes', type=int, default=5, help='Repetições por endpoint')
+    parser.add_argument('--saida', default='bench_resultados.json', help='Arquivo JSON de saída')
+    parser.add_argument('--comparar', help='Resultado JSON anterior para detectar regressões')
+    parser.add_argument('--serializacao', type=int, default=0,
+                        help='Compara ORM+jsonify com o serializador em N linhas (ex.: 100000)')
+    parser.add_argument('--tolerancia', type=float, default=0.2,
+                        help='Aumento relativo de tempo tolerado (padrão: 0.2 = 20%%)')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print("BENCHMARK DE ENDPOINTS - EXPRESSO ITAPORANGA")
+    print("=" * 60)
+
+    resultados = executar_benchmark(max(args.entregas, args.serializacao), args.repeticoes,
+                                    args.serializacao)
+
+    with open(args.saida, 'w', encoding='utf-8') as f:
+        json.dump(resultados, f, indent=2, ensure_ascii=False)
+    print(f"\n✅ Resultados salvos em: {args.saida}")
+
+    problemas = verificar_status(resultados) + verificar_orcamentos(resultados)
+
+    if args.comparar:
+        with open(args.comparar, 'r', encoding='utf-8') as f:
+            anteriores = json.load(f)
+        problemas += comparar_resultados(resultados, anteriores, args.tolerancia)
+
+    if problemas:
+        print("\n❌ REGRESSÕES ENCONTRADAS:")
+        for problema in problemas:
+            print(f"- {problema}")
+        return 1
+
+    print("\n🎯 Nenhuma regressão encontrada")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Exportação das entregas para Parquet - Expresso Itaporanga
+
+Grava as entregas em arquivos Parquet particionados pelo mês de criação
+(entregas/mes=AAAA-MM/), com status, produto e cidades em colunas de
+dicionário. Cada execução acrescenta só as entregas alteradas desde a
+anterior (pela data de atualização); na leitura vale a versão mais recente
+de cada entrega. Assim as análises podem rodar sobre os snapshots, lendo
+apenas as colunas necessárias, sem consultar o banco de produção.
+
+Nomes e endereços de remetentes e destinatários não são exportados. Não há
+histórico de status neste banco; só o estado atual de cada entrega é
+exportado. As entregas movidas para o arquivo (entrega_arquivada) continuam
+no snapshot, como nas consultas analíticas: a exportação lê as duas tabelas
+e o arquivamento não altera as linhas. Exclusões feitas fora da aplicação
+só são refletidas com --completo, que regrava tudo.
+
+Requer pyarrow (opcional para a aplicação).
+
+Uso:
+    python exportar_parquet.py --destino snapshots
+    python exportar_parquet.py --destino snapshots --completo
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import or_, select
+
+# Adicionar o diretório src ao path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+
+from consultas_analiticas import FOLGA_MARCA, ENTREGA, ConsultasAnaliticas, conectar  # noqa: E402
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:  # pragma: no cover - dependência opcional
+    pa = ds = None
+
+# Versão 3: entregas arquivadas incluídas. Snapshots de versões anteriores
+# podem não ter o histórico arquivado e são regravados por inteiro.
+VERSAO_SNAPSHOT = 3
+ARQUIVO_MANIFESTO = '_snapshot.json'
+PASTA_ENTREGAS = 'entregas'
+# Ids arquivados gravados pela versão 2, removidos na regravação
+PASTA_ARQUIVADAS = 'arquivadas'
+TAMANHO_LOTE_EXPORTACAO = 500_000
+
+# Colunas de baixa cardinalidade, gravadas como dicionário
+COLUNAS_DICIONARIO = ('status', 'tipo_produto', 'origem', 'destino')
+
+# Colunas lidas para montar o estado das análises (as demais são ignoradas na leitura)
+COLUNAS_ANALISE = ('id', 'status', 'tipo_produto', 'origem', 'destino', 'peso', 'valor_declarado',
+                   'data_criacao', 'data_atualizacao')
+
+
+def esquema():
+    """Esquema fixo dos arquivos, para que todas as partes tenham os mesmos tipos"""
+    dicionario = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('id', pa.int64()),
+        ('codigo_rastreamento', pa.string()),
+        ('status', dicionario),
+        ('tipo_produto', dicionario),
+        ('origem', dicionario),
+        ('destino', dicionario),
+        ('cidade_origem_id', pa.int64()),
+        ('cidade_destino_id', pa.int64()),
+        ('rota_id', pa.int64()),
+        ('peso', pa.float64()),
+        ('valor_declarado', pa.float64()),
+        ('data_criacao', pa.timestamp('us')),
+        ('data_atualizacao', pa.timestamp('us')),
+        ('mes', pa.string()),
+    ])
+
+
+def _exigir_pyarrow():
+    if pa is None:
+        raise RuntimeError('pyarrow não instalado: pip install pyarrow')
+
+
+def ler_manifesto(destino):
+    caminho = os.path.join(destino, ARQUIVO_MANIFESTO)
+    if not os.path.exists(caminho):
+        return None
+    with open(caminho, encoding='utf-8') as arquivo:
+        manifesto = json.load(arquivo)
+    return manifesto if manifesto.get('versao') == VERSAO_SNAPSHOT else None
+
+
+def _gravar_manifesto(destino, manifesto):
+    caminho = os.path.join(destino, ARQUIVO_MANIFESTO)
+    with open(f'{caminho}.tmp', 'w', encoding='utf-8') as arquivo:
+        json.dump(manifesto, arquivo, indent=2, ensure_ascii=False)
+    os.replace(f'{caminho}.tmp', caminho)
+
+
+def _consulta_exportacao(consultas, desde=None):
+    e = ENTREGA.c
+    juncao, rotulo_origem, rotulo_destino = consultas.com_cidades()
+    consulta = select(
+        e.id, e.codigo_rastreamento, e.status, e.tipo_produto,
+        rotulo_origem.label('origem'), rotulo_destino.label('destino'),
+        e.cidade_origem_id, e.cidade_destino_id, e.rota_id,
+        e.peso, e.valor_declarado, e.data_criacao, e.data_atualizacao,
+    ).select_from(juncao)
+    if desde is not None:
+        consulta = consulta.where(or_(e.data_atualizacao >= desde, e.data_atualizacao.is_(None)))
+    return consulta
+
+
+def _tabela_arrow(lote):
+    """Converte um lote em tabela Arrow com dicionários e a coluna de partição"""
+    for coluna in ('data_criacao', 'data_atualizacao'):
+        lote[coluna] = pd.to_datetime(lote[coluna])
+    for coluna in ('cidade_origem_id', 'cidade_destino_id', 'rota_id'):
+        lote[coluna] = lote[coluna].astype('Int64')
+    for coluna in COLUNAS_DICIONARIO:
+        lote[coluna] = lote[coluna].astype('category')
+    meses = lote['data_criacao'].to_numpy('datetime64[M]')
+    lote['mes'] = np.where(np.isnat(meses), 'sem-data', meses.astype(str))
+    return pa.Table.from_pandas(lote, schema=esquema(), preserve_index=False)
+
+
+def exportar(url, destino, completo=False, tamanho_lote=TAMANHO_LOTE_EXPORTACAO):
+    """Acrescenta ao snapshot as entregas alteradas desde a última exportação.
+
+    Retorna o número de entregas gravadas.
+    """
+    _exigir_pyarrow()
+    manifesto = None if completo else ler_manifesto(destino)
+    pasta = os.path.join(destino, PASTA_ENTREGAS)
+    pasta_arquivadas = os.path.join(destino, PASTA_ARQUIVADAS)
+    if manifesto is None:
+        for caminho in (pasta, pasta_arquivadas):
+            if os.path.exists(caminho):
+                shutil.rmtree(caminho)
+    os.makedirs(pasta, exist_ok=True)
+
+    desde = None
+    if manifesto is not None:
+        desde = datetime.fromisoformat(manifesto['marca']) - FOLGA_MARCA
+    marca = datetime.utcnow()
+    prefixo = marca.strftime('%Y%m%dT%H%M%S%f')
+
+    consultas = ConsultasAnaliticas(conectar(url), tamanho_lote)
+    particionamento = ds.partitioning(pa.schema([('mes', pa.string())]), flavor='hive')
+    total = 0
+    for numero, lote in enumerate(consultas.ler_em_lotes(_consulta_exportacao(consultas, desde), dtype={})):
+        ds.write_dataset(
+            _tabela_arrow(lote), pasta, format='parquet', partitioning=particionamento,
+            basename_template=f'parte-{prefixo}-{numero}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+            file_options=ds.ParquetFileFormat().make_write_options(compression='zstd'),
+        )
+        total += len(lote)
+
+    _gravar_manifesto(destino, {
+        'versao': VERSAO_SNAPSHOT,
+        'marca': marca.isoformat(),
+        'linhas_gravadas': (manifesto or {}).get('linhas_gravadas', 0) + total,
+        'exportacoes': (manifesto or {}).get('exportacoes', 0) + 1,
+    })
+    return total
+
+
+def ler_snapshot(destino, colunas=None, meses=None):
+    """DataFrame com a versão mais recente de cada entrega do snapshot.
+
+    Lê só as `colunas` pedidas (mais id e data_atualizacao, usadas para
+    descartar versões antigas) e, se `meses` for informado, só as partições
+    desses meses.
+    """
+    _exigir_pyarrow()
+    if ler_manifesto(destino) is None:
+        raise FileNotFoundError(f'Snapshot não encontrado em {destino}')
+
+    particionamento = ds.partitioning(pa.schema([('mes', pa.string())]), flavor='hive')
+    dataset = ds.dataset(os.path.join(destino, PASTA_ENTREGAS), format='parquet', partitioning=particionamento,
+                         schema=esquema())
+    colunas = list(dict.fromkeys(['id', 'data_atualizacao', *(colunas or dataset.schema.names)]))
+    filtro = ds.field('mes').isin(list(meses)) if meses else None
+    tabela = dataset.to_table(columns=colunas, filter=filtro)
+
+    df = tabela.to_pandas()
+    if df['id'].duplicated().any():
+        df = df.sort_values(['id', 'data_atualizacao'], kind='stable').drop_duplicates('id', keep='last')
+    return df.reset_index(drop=True)
+
+
+def linhas_para_estado(df):
+    """Converte um snapshot no formato de `ConsultasAnaliticas.linhas_dos_dias`"""
+    criacao = df['data_criacao'].to_numpy('datetime64[us]')
+    atualizacao = df['data_atualizacao'].to_numpy('datetime64[us]')
+    tempo = (atualizacao - criacao).astype(np.float64) / 3.6e9
+    tempo[np.isnat(criacao) | np.isnat(atualizacao)] = np.nan
+    epoca = criacao.astype('datetime64[s]').astype(np.int64).astype(np.float64)
+    epoca[np.isnat(criacao)] = np.nan
+
+    # Rótulos de rota só para os pares (origem, destino) que aparecem; sem uma das cidades, rota nula
+    origem = pd.Categorical(df['origem'])
+    destino = pd.Categorical(df['destino'])
+    base = len(destino.categories)
+    validos = (origem.codes >= 0) & (destino.codes >= 0)
+    pares, rotas = np.unique(np.where(validos, origem.codes.astype(np.int64) * base + destino.codes, -1),
+                             return_inverse=True)
+    rotas = rotas.reshape(-1)
+    if len(pares) and pares[0] < 0:
+        pares, rotas = pares[1:], rotas - 1
+    rotulos = [f'{origem.categories[par // base]} → {destino.categories[par % base]}' for par in pares]
+
+    return pd.DataFrame({
+        'status': pd.Categorical(df['status']),
+        'tipo_produto': pd.Categorical(df['tipo_produto']),
+        'rota': pd.Categorical.from_codes(rotas.reshape(-1), rotulos),
+        'criacao': epoca,
+        'tempo': tempo.astype(np.float32),
+        'valor': df['valor_declarado'].to_numpy(np.float64),
+        'peso': df['peso'].to_numpy(np.float64),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exporta as entregas para Parquet particionado por mês')
+    parser.add_argument('--banco', help='URL do banco (padrão: DATABASE_URL ou o SQLite da aplicação)')
+    parser.add_argument('--destino', default='snapshots', help='Pasta dos snapshots')
+    parser.add_argument('--completo', action='store_true', help='Regrava o snapshot inteiro')
+    parser.add_argument('--lote', type=int, default=TAMANHO_LOTE_EXPORTACAO, help='Linhas por lote de gravação')
+    args = parser.parse_args()
+
+    if pa is None:
+        print("❌ pyarrow não instalado: pip install pyarrow")
+        sys.exit(1)
+
+    inicio = time.perf_counter()
+    total = exportar(args.banco, args.destino, args.completo, args.lote)
+    print(f"✅ {total} entregas exportadas para {args.destino} em {time.perf_counter() - inicio:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
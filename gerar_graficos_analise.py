@@ -2,13 +2,34 @@
 """
 Gerador de Gráficos - Análise Expresso Itaporanga
 Cria visualizações gráficas dos dados de entregas
+
+Cada gráfico declara as seções do relatório que usa. O hash dessas seções,
+do formato, da resolução e do código que desenha o gráfico fica em um
+manifesto na pasta de saída: na execução seguinte só são refeitos os
+gráficos cujo hash mudou, em paralelo em um pool de processos.
+
+Uso:
+    python gerar_graficos_analise.py relatorio_analise_completa.json
+    python gerar_graficos_analise.py relatorio.json --saida graficos --formato svg
+    python gerar_graficos_analise.py relatorio.json --dpi 150 --formato webp --forcar
 """
 
+import argparse
+import hashlib
+import inspect
 import json
-import matplotlib.pyplot as plt
-import numpy as np
-from datetime import datetime
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np  # noqa: E402
+
+FORMATOS = ('png', 'svg', 'webp')
+DPI_PADRAO = 300
+ARQUIVO_MANIFESTO = '.manifesto_graficos.json'
+SAIDA_PADRAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'graficos_analise')
 
 def configurar_matplotlib():
     """Configura matplotlib para melhor aparência"""
@@ -21,7 +42,7 @@ def configurar_matplotlib():
     plt.rcParams['ytick.labelsize'] = 10
     plt.rcParams['legend.fontsize'] = 10
 
-def criar_grafico_status(dados, output_dir):
+def criar_grafico_status(dados, output_dir, formato='png', dpi=DPI_PADRAO):
     """Cria gráfico de distribuição de status"""
     status_data = dados['distribuicao_status']
     
@@ -47,12 +68,12 @@ def criar_grafico_status(dados, output_dir):
                 f'{int(height)}', ha='center', va='bottom', fontweight='bold')
     
     plt.tight_layout()
-    plt.savefig(f'{output_dir}/distribuicao_status.png', dpi=300, bbox_inches='tight')
+    arquivo = os.path.join(output_dir, 'distribuicao_status.' + formato)
+    plt.savefig(arquivo, dpi=dpi, bbox_inches='tight')
     plt.close()
-    
-    print("✅ Gráfico de status criado: distribuicao_status.png")
+    return arquivo
 
-def criar_grafico_produtos(dados, output_dir):
+def criar_grafico_produtos(dados, output_dir, formato='png', dpi=DPI_PADRAO):
     """Cria gráfico de distribuição de produtos"""
     produtos_data = dados['distribuicao_produtos']
     
@@ -76,12 +97,12 @@ def criar_grafico_produtos(dados, output_dir):
     # Rotacionar labels do eixo x
     plt.xticks(rotation=45, ha='right')
     plt.tight_layout()
-    plt.savefig(f'{output_dir}/distribuicao_produtos.png', dpi=300, bbox_inches='tight')
+    arquivo = os.path.join(output_dir, 'distribuicao_produtos.' + formato)
+    plt.savefig(arquivo, dpi=dpi, bbox_inches='tight')
     plt.close()
-    
-    print("✅ Gráfico de produtos criado: distribuicao_produtos.png")
+    return arquivo
 
-def criar_grafico_dias_semana(dados, output_dir):
+def criar_grafico_dias_semana(dados, output_dir, formato='png', dpi=DPI_PADRAO):
     """Cria gráfico de entregas por dia da semana"""
     dias_data = dados['entregas_por_dia_semana']
     
@@ -118,12 +139,12 @@ def criar_grafico_dias_semana(dados, output_dir):
                     f'{int(height)}', ha='center', va='bottom', fontweight='bold')
     
     plt.tight_layout()
-    plt.savefig(f'{output_dir}/entregas_por_dia_semana.png', dpi=300, bbox_inches='tight')
+    arquivo = os.path.join(output_dir, 'entregas_por_dia_semana.' + formato)
+    plt.savefig(arquivo, dpi=dpi, bbox_inches='tight')
     plt.close()
-    
-    print("✅ Gráfico de dias da semana criado: entregas_por_dia_semana.png")
+    return arquivo
 
-def criar_dashboard_resumo(dados, output_dir):
+def criar_dashboard_resumo(dados, output_dir, formato='png', dpi=DPI_PADRAO):
     """Cria dashboard com resumo dos principais indicadores"""
     fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(16, 12))
     
@@ -191,42 +212,110 @@ def criar_dashboard_resumo(dados, output_dir):
     
     plt.tight_layout()
     plt.subplots_adjust(top=0.93)
-    plt.savefig(f'{output_dir}/dashboard_resumo.png', dpi=300, bbox_inches='tight')
+    arquivo = os.path.join(output_dir, 'dashboard_resumo.' + formato)
+    plt.savefig(arquivo, dpi=dpi, bbox_inches='tight')
     plt.close()
-    
-    print("✅ Dashboard resumo criado: dashboard_resumo.png")
+    return arquivo
+
+# Gráficos e as seções do relatório de que cada um depende
+GRAFICOS = {
+    'distribuicao_status': (criar_grafico_status, ('distribuicao_status',)),
+    'distribuicao_produtos': (criar_grafico_produtos, ('distribuicao_produtos',)),
+    'entregas_por_dia_semana': (criar_grafico_dias_semana, ('entregas_por_dia_semana',)),
+    'dashboard_resumo': (criar_dashboard_resumo, ('distribuicao_status', 'distribuicao_produtos',
+                                                  'indicadores', 'entregas_por_dia_semana')),
+}
+
+def hash_grafico(nome, dados, formato, dpi):
+    """Hash do conteúdo de um gráfico: seções usadas, formato, resolução e código"""
+    funcao, secoes = GRAFICOS[nome]
+    conteudo = json.dumps({
+        'secoes': {secao: dados.get(secao) for secao in secoes},
+        'formato': formato,
+        'dpi': dpi,
+        'codigo': inspect.getsource(funcao),
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+def ler_manifesto(output_dir):
+    caminho = os.path.join(output_dir, ARQUIVO_MANIFESTO)
+    if not os.path.exists(caminho):
+        return {}
+    with open(caminho, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def gravar_manifesto(output_dir, manifesto):
+    caminho = os.path.join(output_dir, ARQUIVO_MANIFESTO)
+    with open(caminho + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifesto, f, indent=2, sort_keys=True)
+    os.replace(caminho + '.tmp', caminho)
+
+def _renderizar(nome, dados, output_dir, formato, dpi):
+    """Executado nos processos do pool"""
+    configurar_matplotlib()
+    funcao, secoes = GRAFICOS[nome]
+    return funcao({secao: dados.get(secao) for secao in secoes}, output_dir, formato, dpi)
+
+def gerar_graficos(dados, output_dir, formato='png', dpi=DPI_PADRAO, processos=None, forcar=False):
+    """Gera os gráficos desatualizados e retorna (gerados, inalterados)"""
+    os.makedirs(output_dir, exist_ok=True)
+    manifesto = ler_manifesto(output_dir)
+
+    pendentes = {}
+    inalterados = []
+    for nome in GRAFICOS:
+        hash_atual = hash_grafico(nome, dados, formato, dpi)
+        arquivo = os.path.join(output_dir, f'{nome}.{formato}')
+        if not forcar and manifesto.get(f'{nome}.{formato}') == hash_atual and os.path.exists(arquivo):
+            inalterados.append(arquivo)
+        else:
+            pendentes[nome] = hash_atual
+
+    gerados = []
+    if len(pendentes) == 1 or processos == 1:
+        # Um gráfico só não compensa o custo de iniciar processos
+        for nome in pendentes:
+            gerados.append(_renderizar(nome, dados, output_dir, formato, dpi))
+            manifesto[f'{nome}.{formato}'] = pendentes[nome]
+    elif pendentes:
+        with ProcessPoolExecutor(max_workers=min(processos or os.cpu_count() or 1, len(pendentes))) as executor:
+            futuros = {nome: executor.submit(_renderizar, nome, dados, output_dir, formato, dpi) for nome in pendentes}
+            for nome, futuro in futuros.items():
+                gerados.append(futuro.result())
+                manifesto[f'{nome}.{formato}'] = pendentes[nome]
+
+    gravar_manifesto(output_dir, manifesto)
+    return gerados, inalterados
 
 def main():
     """Função principal"""
-    # Carregar dados da análise
-    json_path = '/home/ubuntu/relatorio_analise_completa.json'
-    
-    if not os.path.exists(json_path):
-        print(f"❌ Arquivo de dados não encontrado: {json_path}")
+    parser = argparse.ArgumentParser(description='Gera os gráficos do relatório de análise de entregas')
+    parser.add_argument('entrada', help='Relatório JSON gerado por analise_avancada_entregas.py')
+    parser.add_argument('--saida', default=SAIDA_PADRAO, help='Pasta dos gráficos')
+    parser.add_argument('--formato', choices=FORMATOS, default='png', help='Formato das imagens')
+    parser.add_argument('--dpi', type=int, default=DPI_PADRAO, help='Resolução das imagens rasterizadas')
+    parser.add_argument('--processos', type=int, help='Processos em paralelo (padrão: número de CPUs)')
+    parser.add_argument('--forcar', action='store_true', help='Refaz todos os gráficos')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.entrada):
+        print(f"❌ Arquivo de dados não encontrado: {args.entrada}")
         return
-    
-    with open(json_path, 'r', encoding='utf-8') as f:
+
+    with open(args.entrada, 'r', encoding='utf-8') as f:
         dados = json.load(f)
-    
-    # Criar diretório para gráficos
-    output_dir = '/home/ubuntu/site_integrado_expresso/graficos_analise'
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Configurar matplotlib
-    configurar_matplotlib()
-    
+
     print("🎨 GERANDO VISUALIZAÇÕES GRÁFICAS")
     print("=" * 50)
-    
-    # Gerar todos os gráficos
-    criar_grafico_status(dados, output_dir)
-    criar_grafico_produtos(dados, output_dir)
-    criar_grafico_dias_semana(dados, output_dir)
-    criar_dashboard_resumo(dados, output_dir)
-    
-    print(f"\n✅ Todos os gráficos foram salvos em: {output_dir}")
+
+    gerados, inalterados = gerar_graficos(dados, args.saida, args.formato, args.dpi, args.processos, args.forcar)
+    for arquivo in gerados:
+        print(f"✅ Gráfico criado: {os.path.basename(arquivo)}")
+    for arquivo in inalterados:
+        print(f"⏭️  Sem alterações: {os.path.basename(arquivo)}")
+
+    print(f"\n✅ Todos os gráficos foram salvos em: {args.saida}")
     print("🎯 VISUALIZAÇÕES CONCLUÍDAS COM SUCESSO!")
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,87 @@
+"""
+Detecção de anomalias no volume diário de entregas
+
+Cada série (por exemplo, cidade de destino × produto) é comparada, dia a dia,
+com a sua linha de base calculada só com os dias anteriores: o valor
+esperado é a média móvel exponencial (EWMA) e a escala é o desvio absoluto
+mediano (MAD) da janela recente, que não é distorcido pelos próprios picos.
+O escore é um z robusto; dias com |escore| acima do limiar são anomalias
+(queda ou pico). O cálculo é vetorizado com NumPy sobre todas as séries ao
+mesmo tempo, em blocos de séries para limitar a memória.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+JANELA_PADRAO = 28
+LIMIAR_PADRAO = 4.0
+
+# Abaixo deste volume esperado por dia a série é ruidosa demais para alertar
+MINIMO_ESPERADO = 5.0
+
+# Constante que torna o MAD um estimador do desvio padrão em dados normais
+FATOR_MAD = 1.4826
+
+SERIES_POR_BLOCO = 256
+
+
+def matriz_diaria(linhas):
+    """Matriz séries × dias a partir de linhas (dia, chave, quantidade).
+
+    Dias sem linha contam zero. Retorna (chaves, primeiro dia, matriz).
+    """
+    linhas = list(linhas)
+    if not linhas:
+        return [], None, np.zeros((0, 0))
+    dias, chaves, quantidades = zip(*linhas)
+    dias = np.array(dias, dtype='datetime64[D]')
+    inicio = dias.min()
+    colunas = (dias - inicio).astype(np.int64)
+
+    indice_chave = {}
+    series = np.fromiter((indice_chave.setdefault(chave, len(indice_chave)) for chave in chaves),
+                         dtype=np.int64, count=len(chaves))
+    matriz = np.zeros((len(indice_chave), colunas.max() + 1))
+    np.add.at(matriz, (series, colunas), np.asarray(quantidades, dtype=np.float64))
+    return list(indice_chave), inicio, matriz
+
+
+def linha_de_base(matriz, janela=JANELA_PADRAO):
+    """(esperado, escala) de cada dia usando só os dias anteriores; NaN sem histórico"""
+    series, dias = matriz.shape
+    esperado = np.full(matriz.shape, np.nan)
+    escala = np.full(matriz.shape, np.nan)
+    if dias <= janela:
+        return esperado, escala
+
+    # EWMA com meia-vida comparável à janela; o laço é no tempo, vetorizado nas séries
+    alfa = 2.0 / (janela + 1)
+    media = matriz[:, :janela].mean(axis=1)
+    for dia in range(janela, dias):
+        esperado[:, dia] = media
+        media = alfa * matriz[:, dia] + (1 - alfa) * media
+
+    for inicio in range(0, series, SERIES_POR_BLOCO):
+        bloco = matriz[inicio:inicio + SERIES_POR_BLOCO]
+        # Janela i cobre os dias i..i+janela-1 e serve de histórico ao dia i+janela
+        janelas = sliding_window_view(bloco, janela, axis=1)[:, :-1]
+        mediana = np.median(janelas, axis=2)
+        mad = np.median(np.abs(janelas - mediana[..., None]), axis=2)
+        escala[inicio:inicio + SERIES_POR_BLOCO, janela:] = FATOR_MAD * mad
+
+    # Contagens têm variância ao menos da ordem da média (Poisson): evita escala zero
+    return esperado, np.fmax(escala, np.sqrt(np.fmax(esperado, 1.0)))
+
+
+def detectar(matriz, janela=JANELA_PADRAO, limiar=LIMIAR_PADRAO, minimo_esperado=MINIMO_ESPERADO):
+    """Anomalias da matriz séries × dias.
+
+    Retorna arrays (série, dia, observado, esperado, escore) dos dias cujo
+    |escore| passa do limiar, com volume esperado de pelo menos `minimo_esperado`.
+    """
+    esperado, escala = linha_de_base(matriz, janela)
+    with np.errstate(invalid='ignore'):
+        escore = (matriz - esperado) / escala
+        anomalos = (np.abs(escore) >= limiar) & (esperado >= minimo_esperado)
+    series, dias = np.nonzero(anomalos)
+    return series, dias, matriz[series, dias], esperado[series, dias], escore[series, dias]
@@ -1,11 +1,19 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, column, event, false, func, literal, literal_column, or_, table, text
+from sqlalchemy.orm.exc import StaleDataError
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import functools
+import hashlib
+import json
 import logging
 import os
+import random
+import time
 from dotenv import load_dotenv
+import click
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -13,11 +21,33 @@ load_dotenv()
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 import secrets
+import threading
 import sqlite3
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+try:
+    from .serializacao import Serializador, formato_data_br, resposta
+    from .cidades import chave_cidade, dobrar, interpretar_cidade, intervalo_prefixo, rotulo_cidade
+    from .grafo_rotas import CRITERIOS, GrafoRotas, Trecho, interpretar_duracao
+    from .previsao import STATUS_PREVISAO, PrevisaoEntregas, prever_linhas
+    from .planejamento_carga import Volume, planejar
+    from .cotacao import TabelaFrete
+    from .consultas_analiticas import ConsultasAnaliticas, EstadoAnalitico, resumo as resumo_analises
+    from .esboco_quantis import QUANTIS_PADRAO, EsbocoQuantis
+    from . import anomalias
+except ImportError:
+    from serializacao import Serializador, formato_data_br, resposta
+    from cidades import chave_cidade, dobrar, interpretar_cidade, intervalo_prefixo, rotulo_cidade
+    from grafo_rotas import CRITERIOS, GrafoRotas, Trecho, interpretar_duracao
+    from previsao import STATUS_PREVISAO, PrevisaoEntregas, prever_linhas
+    from planejamento_carga import Volume, planejar
+    from cotacao import TabelaFrete
+    from consultas_analiticas import ConsultasAnaliticas, EstadoAnalitico, resumo as resumo_analises
+    from esboco_quantis import QUANTIS_PADRAO, EsbocoQuantis
+    import anomalias
+
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 
 # Configurar CORS
@@ -45,6 +75,30 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
 
+def inserir_ou_atualizar(conexao, tabela, linhas, chaves, atualizar=()):
+    """INSERT ... ON CONFLICT em uma única instrução (SQLite e PostgreSQL).
+    
+    `atualizar` lista as colunas copiadas da linha nova em caso de conflito, ou
+    é um dict coluna -> expressão. Sem ele, as linhas existentes são mantidas.
+    """
+    if conexao.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    
+    instrucao = insert(tabela).values(linhas)
+    if isinstance(atualizar, dict):
+        # Expressões explícitas, ex.: {'versao': tabela.c.versao + 1}
+        instrucao = instrucao.on_conflict_do_update(index_elements=chaves, set_=atualizar)
+    elif atualizar:
+        instrucao = instrucao.on_conflict_do_update(
+            index_elements=chaves,
+            set_={coluna: instrucao.excluded[coluna] for coluna in atualizar}
+        )
+    else:
+        instrucao = instrucao.on_conflict_do_nothing(index_elements=chaves)
+    return conexao.execute(instrucao)
+
 # Modelos do banco de dados
 class Usuario(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -55,6 +109,16 @@ class Usuario(db.Model):
     data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Entrega(db.Model):
+    __table_args__ = (
+        # Manifesto e planejamento de carga filtram por rota e status
+        db.Index('ix_entrega_rota_status', 'rota_id', 'status'),
+        # Detector de SLA: faixa de data_atualizacao dentro de um status
+        db.Index('ix_entrega_status_data_atualizacao', 'status', 'data_atualizacao'),
+        # Sem AUTOINCREMENT o SQLite reaproveita o maior id depois que ele é
+        # arquivado, e o id já existe em entrega_arquivada
+        {'sqlite_autoincrement': True},
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     codigo_rastreamento = db.Column(db.String(20), unique=True, nullable=False)
     
@@ -62,11 +126,13 @@ class Entrega(db.Model):
     remetente_nome = db.Column(db.String(100), nullable=False)
     remetente_endereco = db.Column(db.Text, nullable=False)
     remetente_cidade = db.Column(db.String(100), nullable=False)
+    cidade_origem_id = db.Column(db.Integer, db.ForeignKey('cidade.id'))
     
     # Dados do destinatário
     destinatario_nome = db.Column(db.String(100), nullable=False)
     destinatario_endereco = db.Column(db.Text, nullable=False)
     destinatario_cidade = db.Column(db.String(100), nullable=False)
+    cidade_destino_id = db.Column(db.Integer, db.ForeignKey('cidade.id'), index=True)
     
     # Dados da mercadoria
     tipo_produto = db.Column(db.String(50), nullable=False)
@@ -74,11 +140,93 @@ class Entrega(db.Model):
     valor_declarado = db.Column(db.Float)
     observacoes = db.Column(db.Text)
     
+    # Rota atribuída automaticamente (próximo trecho até o destino)
+    rota_id = db.Column(db.Integer, db.ForeignKey('rota.id'))
+    
     # Status e controle
-    status = db.Column(db.String(20), default='pendente')
-    data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
-    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow)
+    status = db.Column(db.String(20), default='pendente', index=True)
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Indexada: previsões e análises releem só as entregas alteradas
+    data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    
+    # Controle de concorrência otimista: todo UPDATE pelo ORM é
+    # "WHERE id = ? AND versao = ?" e incrementa a versão. UPDATEs em massa
+    # que mudam a representação da entrega incrementam a versão explicitamente.
+    versao = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': versao}
+
+# Cidades canônicas referenciadas por entregas e rotas
+class Cidade(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), nullable=False)
+    uf = db.Column(db.String(2))
+    nome_chave = db.Column(db.String(100), nullable=False, index=True)  # nome sem acentos, para autocompletar
+    chave = db.Column(db.String(110), nullable=False, unique=True)  # nome_chave + UF
+
+# Serializadores das entregas (colunas selecionadas diretamente, sem hidratar o ORM)
+SERIALIZADOR_ENTREGA_LISTA = Serializador([
+    ('id', Entrega.id),
+    ('codigo_rastreamento', Entrega.codigo_rastreamento),
+    ('remetente_nome', Entrega.remetente_nome),
+    ('remetente_cidade', Entrega.remetente_cidade),
+    ('destinatario_nome', Entrega.destinatario_nome),
+    ('destinatario_cidade', Entrega.destinatario_cidade),
+    ('tipo_produto', Entrega.tipo_produto),
+    ('peso', Entrega.peso),
+    ('valor_declarado', Entrega.valor_declarado),
+    ('status', Entrega.status),
+    ('data_criacao', Entrega.data_criacao),
+    ('data_atualizacao', Entrega.data_atualizacao)
+])
+
+SERIALIZADOR_ENTREGA_DETALHE = Serializador([
+    ('id', Entrega.id),
+    ('codigo_rastreamento', Entrega.codigo_rastreamento),
+    ('remetente_nome', Entrega.remetente_nome),
+    ('remetente_endereco', Entrega.remetente_endereco),
+    ('remetente_cidade', Entrega.remetente_cidade),
+    ('destinatario_nome', Entrega.destinatario_nome),
+    ('destinatario_endereco', Entrega.destinatario_endereco),
+    ('destinatario_cidade', Entrega.destinatario_cidade),
+    ('tipo_produto', Entrega.tipo_produto),
+    ('peso', Entrega.peso),
+    ('valor_declarado', Entrega.valor_declarado),
+    ('observacoes', Entrega.observacoes),
+    ('status', Entrega.status),
+    ('rota_id', Entrega.rota_id),
+    ('data_criacao', Entrega.data_criacao),
+    ('data_atualizacao', Entrega.data_atualizacao),
+    ('versao', Entrega.versao)
+])
+
+SERIALIZADOR_MANIFESTO = Serializador([
+    ('codigo_rastreamento', Entrega.codigo_rastreamento),
+    ('destinatario_nome', Entrega.destinatario_nome),
+    ('destinatario_endereco', Entrega.destinatario_endereco),
+    ('destinatario_cidade', Entrega.destinatario_cidade),
+    ('tipo_produto', Entrega.tipo_produto),
+    ('peso', Entrega.peso),
+    ('valor_declarado', Entrega.valor_declarado),
+    ('status', Entrega.status)
+])
+
+SERIALIZADOR_RASTREIO = Serializador([
+    ('codigo', Entrega.codigo_rastreamento),
+    ('status', Entrega.status),
+    ('destinatario', Entrega.destinatario_nome),
+    ('cidade_destino', Entrega.destinatario_cidade),
+    ('data_criacao', Entrega.data_criacao)
+], conversores={'data_criacao': formato_data_br})
+
+# Colunas extras lidas junto com os serializadores para calcular a previsão de entrega
+COLUNAS_PREVISAO = (Entrega.cidade_origem_id, Entrega.cidade_destino_id)
+
+def anexar_previsoes(dados, linhas):
+    """Inclui 'previsao_entrega' em cada dicionário, calculada a partir da linha correspondente"""
+    for item, previsao in zip(dados, prever_linhas(obter_grafo_rotas, linhas)):
+        item['previsao_entrega'] = previsao
+    return dados
 
 # Rotas do site institucional
 @app.route('/')
@@ -215,13 +363,115 @@ def dashboard():
     
     return render_template('gestao/dashboard.html', stats=stats)
 
+# Paginação da listagem de gestão
+POR_PAGINA_PADRAO = 50
+POR_PAGINA_MAXIMO = 200
+
+# Abaixo desta estimativa a contagem exata é barata e mais útil que a do planejador
+LIMITE_CONTAGEM_EXATA = 10000
+
+COLUNAS_ORDENACAO = {
+    'data_criacao': Entrega.data_criacao,
+    'codigo': Entrega.codigo_rastreamento,
+    'remetente': Entrega.remetente_nome,
+    'destinatario': Entrega.destinatario_nome,
+    'cidade': Entrega.destinatario_cidade,
+    'status': Entrega.status,
+}
+
+def estimar_linhas(consulta):
+    """Estimativa de linhas do planejador do PostgreSQL (None em outros bancos)"""
+    conexao = db.session.connection()
+    if conexao.dialect.name != 'postgresql':
+        return None
+    
+    compilada = consulta.compile(dialect=conexao.dialect)
+    plano = conexao.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compilada}', compilada.params).scalar()
+    if isinstance(plano, str):
+        plano = json.loads(plano)
+    return int(plano[0]['Plan']['Plan Rows'])
+
+def contar_aproximado(consulta):
+    """Conta as linhas da consulta, usando a estimativa do planejador quando grande.
+    
+    Retorna (total, aproximado).
+    """
+    estimativa = estimar_linhas(consulta)
+    if estimativa is not None and estimativa >= LIMITE_CONTAGEM_EXATA:
+        return estimativa, True
+    
+    total = db.session.execute(
+        db.select(func.count()).select_from(consulta.order_by(None).subquery())
+    ).scalar()
+    return total, False
+
+def consultar_pagina_entregas(parametros):
+    """Aplica filtros, ordenação e paginação da listagem de gestão"""
+    try:
+        pagina = max(int(parametros.get('pagina', 1)), 1)
+    except (TypeError, ValueError):
+        pagina = 1
+    try:
+        por_pagina = min(max(int(parametros.get('por_pagina', POR_PAGINA_PADRAO)), 1), POR_PAGINA_MAXIMO)
+    except (TypeError, ValueError):
+        por_pagina = POR_PAGINA_PADRAO
+    
+    ordenar = parametros.get('ordenar', 'data_criacao')
+    if ordenar not in COLUNAS_ORDENACAO:
+        ordenar = 'data_criacao'
+    direcao = 'asc' if parametros.get('direcao') == 'asc' else 'desc'
+    
+    filtros = {
+        'status': (parametros.get('status') or '').strip(),
+        'cidade': (parametros.get('cidade') or '').strip(),
+        'codigo': (parametros.get('codigo') or '').strip().upper(),
+    }
+    
+    consulta = db.select(Entrega)
+    if filtros['status']:
+        consulta = consulta.where(Entrega.status == filtros['status'])
+    if filtros['cidade']:
+        consulta = consulta.where(Entrega.destinatario_cidade.startswith(filtros['cidade'], autoescape=True))
+    if filtros['codigo']:
+        consulta = consulta.where(Entrega.codigo_rastreamento.startswith(filtros['codigo'], autoescape=True))
+    
+    total, aproximado = contar_aproximado(consulta)
+    
+    coluna = COLUNAS_ORDENACAO[ordenar]
+    # O id desempata registros com o mesmo valor e mantém as páginas estáveis
+    if direcao == 'asc':
+        consulta = consulta.order_by(coluna.asc(), Entrega.id.asc())
+    else:
+        consulta = consulta.order_by(coluna.desc(), Entrega.id.desc())
+    
+    entregas = db.session.execute(
+        consulta.limit(por_pagina).offset((pagina - 1) * por_pagina)
+    ).scalars().all()
+    
+    paginas = max((total + por_pagina - 1) // por_pagina, 1)
+    paginacao = {
+        'pagina': pagina,
+        'por_pagina': por_pagina,
+        'total': total,
+        'total_aproximado': aproximado,
+        'paginas': paginas,
+        'tem_anterior': pagina > 1,
+        # Com total aproximado, uma página cheia indica que pode haver mais registros
+        'tem_proxima': pagina < paginas or (aproximado and len(entregas) == por_pagina),
+        'ordenar': ordenar,
+        'direcao': direcao,
+        'filtros': filtros
+    }
+    
+    return entregas, paginacao
+
 @app.route('/gestao/entregas')
 def listar_entregas():
     if 'user_id' not in session:
         return redirect(url_for('gestao_login'))
     
-    entregas = Entrega.query.order_by(Entrega.data_criacao.desc()).all()
-    return render_template('gestao/entregas.html', entregas=entregas)
+    entregas, paginacao = consultar_pagina_entregas(request.args)
+    return render_template('gestao/entregas.html', entregas=entregas, paginacao=paginacao)
 
 @app.route('/gestao/nova-entrega')
 def nova_entrega():
@@ -230,6 +480,13 @@ def nova_entrega():
     
     return render_template('gestao/nova_entrega.html')
 
+def codigo_em_uso(codigo):
+    """Código de rastreamento já usado por uma entrega ativa ou arquivada"""
+    return db.session.execute(db.select(or_(
+        db.exists().where(Entrega.codigo_rastreamento == codigo),
+        db.exists().where(EntregaArquivada.codigo_rastreamento == codigo)
+    ))).scalar()
+
 @app.route('/gestao/criar-entrega', methods=['POST'])
 def criar_entrega():
     if 'user_id' not in session:
@@ -239,6 +496,8 @@ def criar_entrega():
     import random
     import string
     codigo = 'EI' + ''.join(random.choices(string.digits, k=8))
+    while codigo_em_uso(codigo):
+        codigo = 'EI' + ''.join(random.choices(string.digits, k=8))
     
     entrega = Entrega(
         codigo_rastreamento=codigo,
@@ -291,25 +550,143 @@ def relatorios():
 def rastreamento():
     return render_template('rastreamento.html')
 
+# Consultas e montagem do rastreamento público, compartilhadas com a API
+# assíncrona (rastreio_asgi.py)
+LIMITE_LOTE_RASTREIO = 100
+
+def consulta_rastreio(codigos):
+    return db.select(*SERIALIZADOR_RASTREIO.colunas, *COLUNAS_PREVISAO).where(Entrega.codigo_rastreamento.in_(codigos))
+
+def consulta_rastreio_arquivo(codigos):
+    # Entregas encerradas há mais tempo que a retenção ficam no arquivo
+    return db.select(*SERIALIZADOR_RASTREIO_ARQUIVO.colunas).where(EntregaArquivada.codigo_rastreamento.in_(codigos))
+
+def consulta_entrega_detalhe(codigo):
+    return db.select(*SERIALIZADOR_ENTREGA_DETALHE.colunas, *COLUNAS_PREVISAO).where(Entrega.codigo_rastreamento == codigo)
+
+def montar_rastreio(linhas, arquivadas, grafo):
+    """Rastreamento por código a partir das linhas ativas e arquivadas (`grafo` como em prever_linhas)"""
+    rastreios = {}
+    for linha, previsao in zip(linhas, prever_linhas(grafo, linhas)):
+        dados = SERIALIZADOR_RASTREIO.linha(linha)
+        dados['previsao_entrega'] = formato_data_br(previsao)
+        dados['encontrado'] = True
+        rastreios[dados['codigo']] = dados
+    for linha in arquivadas:
+        dados = SERIALIZADOR_RASTREIO_ARQUIVO.linha(linha)
+        dados['previsao_entrega'] = None
+        dados['encontrado'] = True
+        rastreios.setdefault(dados['codigo'], dados)
+    return rastreios
+
+def codigos_lote_rastreio(corpo):
+    """Códigos pedidos em POST /api/rastrear/lote; ValueError se o corpo for inválido"""
+    codigos = corpo.get('codigos') if isinstance(corpo, dict) else None
+    if not isinstance(codigos, list) or not codigos or not all(isinstance(c, str) for c in codigos):
+        raise ValueError('Informe a lista de códigos')
+    if len(codigos) > LIMITE_LOTE_RASTREIO:
+        raise ValueError(f'Máximo de {LIMITE_LOTE_RASTREIO} códigos por lote')
+    return codigos
+
+def resultado_lote_rastreio(codigos, rastreios):
+    return {
+        'success': True,
+        'data': [rastreios.get(codigo, {'codigo': codigo, 'encontrado': False}) for codigo in codigos],
+        'total': len(codigos),
+        'encontrados': sum(codigo in rastreios for codigo in codigos)
+    }
+
 @app.route('/api/rastrear/<codigo>')
 def api_rastrear(codigo):
-    entrega = Entrega.query.filter_by(codigo_rastreamento=codigo).first()
-    if entrega:
-        return jsonify({
-            'encontrado': True,
-            'codigo': entrega.codigo_rastreamento,
-            'status': entrega.status,
-            'destinatario': entrega.destinatario_nome,
-            'cidade_destino': entrega.destinatario_cidade,
-            'data_criacao': entrega.data_criacao.strftime('%d/%m/%Y %H:%M')
-        })
-    else:
-        return jsonify({'encontrado': False})
+    linhas = db.session.execute(consulta_rastreio([codigo])).all()
+    arquivadas = () if linhas else db.session.execute(consulta_rastreio_arquivo([codigo])).all()
+    rastreio = montar_rastreio(linhas, arquivadas, obter_grafo_rotas).get(codigo)
+    return resposta(rastreio or {'encontrado': False})
+
+@app.route('/api/rastrear/lote', methods=['POST'])
+def api_rastrear_lote():
+    """Rastreamento de vários códigos em uma única chamada"""
+    try:
+        try:
+            codigos = codigos_lote_rastreio(request.get_json(silent=True))
+        except ValueError as e:
+            return resposta({'success': False, 'error': str(e)}, 400)
+        
+        unicos = list(dict.fromkeys(codigos))
+        linhas = db.session.execute(consulta_rastreio(unicos)).all()
+        faltando = set(unicos).difference(linha.codigo_rastreamento for linha in linhas)
+        arquivadas = db.session.execute(consulta_rastreio_arquivo(faltando)).all() if faltando else ()
+        return resposta(resultado_lote_rastreio(codigos, montar_rastreio(linhas, arquivadas, obter_grafo_rotas)))
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+# Colunas e índices adicionados depois da criação original das tabelas. O
+# db.create_all() não altera tabelas existentes, então eles são criados aqui.
+COLUNAS_ADICIONAIS = [
+    ('entrega', 'cidade_origem_id', 'INTEGER REFERENCES cidade (id)'),
+    ('entrega', 'cidade_destino_id', 'INTEGER REFERENCES cidade (id)'),
+    ('rota', 'origem_id', 'INTEGER REFERENCES cidade (id)'),
+    ('rota', 'destino_id', 'INTEGER REFERENCES cidade (id)'),
+    ('rota', 'duracao_horas', 'FLOAT'),
+    ('entrega', 'rota_id', 'INTEGER REFERENCES rota (id)'),
+    ('entrega', 'versao', 'INTEGER NOT NULL DEFAULT 1'),
+    ('chave_idempotencia', 'cabecalhos', 'TEXT'),
+]
+
+INDICES_ADICIONAIS = [
+    ('ix_entrega_data_criacao', 'entrega', 'data_criacao'),
+    ('ix_entrega_status', 'entrega', 'status'),
+    ('ix_entrega_cidade_destino_id', 'entrega', 'cidade_destino_id'),
+    ('ix_entrega_rota_status', 'entrega', 'rota_id, status'),
+    ('ix_entrega_data_atualizacao', 'entrega', 'data_atualizacao'),
+    ('ix_entrega_status_data_atualizacao', 'entrega', 'status, data_atualizacao'),
+]
+
+def aplicar_migracoes():
+    """Aplica alterações de esquema em bancos criados por versões anteriores.
+    
+    Roda a cada inicialização, em todos os workers, então só executa DDL
+    idempotente. O preenchimento das linhas existentes fica no comando
+    `flask migrar-dados`, executado uma vez depois da implantação.
+    """
+    conexao = db.session.connection()
+    inspetor = db.inspect(conexao)
+    
+    adicionadas = set()
+    for tabela, coluna, tipo in COLUNAS_ADICIONAIS:
+        if coluna not in {c['name'] for c in inspetor.get_columns(tabela)}:
+            db.session.execute(text(f'ALTER TABLE {tabela} ADD COLUMN {coluna} {tipo}'))
+            adicionadas.add(coluna)
+    
+    for nome, tabela, colunas in INDICES_ADICIONAIS:
+        db.session.execute(text(f'CREATE INDEX IF NOT EXISTS {nome} ON {tabela} ({colunas})'))
+    
+    criar_busca = not busca_textual_configurada(conexao)
+    if criar_busca:
+        configurar_busca_textual(conexao)
+    db.session.commit()
+    
+    if criar_busca or adicionadas & COLUNAS_COM_PREENCHIMENTO:
+        app.logger.warning("Esquema atualizado; execute 'flask migrar-dados' para preencher as linhas existentes")
+
+# Colunas adicionadas cujos valores são calculados para as linhas existentes por `flask migrar-dados`
+COLUNAS_COM_PREENCHIMENTO = {'cidade_origem_id', 'cidade_destino_id', 'origem_id', 'destino_id', 'duracao_horas', 'rota_id'}
+
+@app.cli.command('migrar-dados')
+def comando_migrar_dados():
+    """Preenche as colunas e o índice de busca nas linhas criadas por versões anteriores"""
+    inicio = time.perf_counter()
+    print(f"✅ {normalizar_cidades()} referências de cidade preenchidas")
+    print(f"✅ {preencher_duracao_rotas()} rotas com duração preenchida")
+    print(f"✅ {atribuir_rotas()} entregas com rota atribuída")
+    reconstruir_busca_textual()
+    print(f"✅ Índice de busca reconstruído em {time.perf_counter() - inicio:.2f}s")
 
 def init_db():
     """Inicializar banco de dados"""
     try:
         db.create_all()
+        aplicar_migracoes()
         
         # Criar usuário admin se não existir
         admin = Usuario.query.filter_by(username='admin').first()
@@ -328,10 +705,6 @@ def init_db():
     except Exception as e:
         print(f"Erro ao inicializar banco: {e}")
 
-# Inicializar banco sempre que a aplicação for carregada
-with app.app_context():
-    init_db()
-
 # API: Inicializar dados de exemplo
 @app.route('/api/init-data', methods=['POST', 'GET'])
 def api_init_data():
@@ -393,7 +766,7 @@ def api_init_data():
             
             # Gerar código único
             codigo = 'EI' + ''.join(random.choices(string.digits, k=8))
-            while Entrega.query.filter_by(codigo_rastreamento=codigo).first():
+            while codigo_em_uso(codigo):
                 codigo = 'EI' + ''.join(random.choices(string.digits, k=8))
             
             # Variar alguns dados
@@ -439,6 +812,149 @@ if __name__ == '__main__':
     app.run(host='0.0.0.0', port=port, debug=False)
 
 
+# ============================================================================
+# IDEMPOTÊNCIA
+# ============================================================================
+
+# Integrações repetem POST/PUT depois de timeouts. Com o cabeçalho
+# Idempotency-Key, a primeira resposta fica guardada por IDEMPOTENCIA_HORAS e
+# as repetições a recebem de volta sem executar a rota outra vez.
+IDEMPOTENCIA_HORAS = float(os.environ.get('IDEMPOTENCIA_HORAS', 24))
+TAMANHO_MAXIMO_CHAVE_IDEMPOTENCIA = 255
+
+# Uma reserva sem resposta há mais que isto é de uma requisição interrompida
+# (processo encerrado entre a rota e a gravação da resposta) e pode ser
+# retomada. Deve passar do tempo máximo de uma requisição no servidor.
+CONCESSAO_IDEMPOTENCIA_SEGUNDOS = float(os.environ.get('CONCESSAO_IDEMPOTENCIA_SEGUNDOS', 120))
+
+# Conflitos de concorrência: a mesma requisição pode dar certo na repetição
+STATUS_REPETIVEIS = {409, 412}
+
+# Tamanho e tipo são refeitos na repetição a partir do corpo e do mimetype
+CABECALHOS_NAO_GUARDADOS = {'Content-Length', 'Content-Type'}
+
+class ChaveIdempotencia(db.Model):
+    chave = db.Column(db.String(TAMANHO_MAXIMO_CHAVE_IDEMPOTENCIA), primary_key=True)
+    endpoint = db.Column(db.String(100), primary_key=True)
+    hash_requisicao = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)  # None: primeira requisição ainda em andamento
+    mimetype = db.Column(db.String(100))
+    cabecalhos = db.Column(db.Text)  # JSON: [[nome, valor], ...]
+    corpo = db.Column(db.LargeBinary)
+    criada_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expira_em = db.Column(db.DateTime, nullable=False, index=True)
+
+def hash_requisicao():
+    """Método, caminho e corpo: a mesma chave com outro conteúdo é um erro do cliente"""
+    return hashlib.sha256(b'\n'.join([request.method.encode(), request.path.encode(), request.get_data()])).hexdigest()
+
+def idempotente(rota):
+    """Guarda e repete a resposta de requisições com o cabeçalho Idempotency-Key.
+    
+    A chave é reservada em uma transação própria antes de a rota rodar, então
+    repetições concorrentes recebem 409 em vez de executar a rota de novo.
+    Respostas 5xx e conflitos (409, 412) não são guardados e liberam a chave
+    para nova tentativa. A repetição devolve corpo, status e cabeçalhos (ETag,
+    Location) da primeira resposta.
+    
+    A rota confirma as próprias transações, então a resposta é gravada depois
+    dela; se o processo cair nesse intervalo, a reserva sem resposta é
+    retomada por uma repetição após CONCESSAO_IDEMPOTENCIA_SEGUNDOS. A
+    gravação só vale para a reserva feita por esta requisição (criada_em).
+    """
+    @functools.wraps(rota)
+    def rota_idempotente(*args, **kwargs):
+        chave = request.headers.get('Idempotency-Key')
+        if not chave:
+            return rota(*args, **kwargs)
+        if len(chave) > TAMANHO_MAXIMO_CHAVE_IDEMPOTENCIA:
+            return resposta({'success': False, 'error': 'Idempotency-Key muito longa'}, 400)
+        
+        identificacao = (ChaveIdempotencia.chave == chave, ChaveIdempotencia.endpoint == request.endpoint)
+        resumo = hash_requisicao()
+        agora = datetime.utcnow()
+        db.session.execute(db.delete(ChaveIdempotencia).where(*identificacao, or_(
+            ChaveIdempotencia.expira_em <= agora,
+            and_(ChaveIdempotencia.status_code.is_(None),
+                 ChaveIdempotencia.criada_em <= agora - timedelta(seconds=CONCESSAO_IDEMPOTENCIA_SEGUNDOS))
+        )))
+        reservada = inserir_ou_atualizar(db.session.connection(), ChaveIdempotencia.__table__, [{
+            'chave': chave, 'endpoint': request.endpoint, 'hash_requisicao': resumo,
+            'criada_em': agora, 'expira_em': agora + timedelta(hours=IDEMPOTENCIA_HORAS)
+        }], ['chave', 'endpoint']).rowcount == 1
+        db.session.commit()
+        
+        if not reservada:
+            registro = db.session.execute(db.select(
+                ChaveIdempotencia.hash_requisicao, ChaveIdempotencia.status_code,
+                ChaveIdempotencia.mimetype, ChaveIdempotencia.cabecalhos, ChaveIdempotencia.corpo
+            ).where(*identificacao)).first()
+            if registro is None or registro.status_code is None:
+                response = resposta({'success': False, 'error': 'Requisição com esta Idempotency-Key em andamento'}, 409)
+                response.headers['Retry-After'] = str(int(CONCESSAO_IDEMPOTENCIA_SEGUNDOS))
+                return response
+            if registro.hash_requisicao != resumo:
+                return resposta({
+                    'success': False,
+                    'error': 'Idempotency-Key já usada com outra requisição'
+                }, 422)
+            response = Response(registro.corpo, status=registro.status_code, mimetype=registro.mimetype,
+                                headers=json.loads(registro.cabecalhos or '[]'))
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        # Depois de uma retomada, a requisição original não altera a nova reserva
+        identificacao += (ChaveIdempotencia.criada_em == agora,)
+        try:
+            response = app.make_response(rota(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            db.session.execute(db.delete(ChaveIdempotencia).where(*identificacao))
+            db.session.commit()
+            raise
+        if response.status_code >= 500 or response.status_code in STATUS_REPETIVEIS:
+            db.session.execute(db.delete(ChaveIdempotencia).where(*identificacao))
+        else:
+            cabecalhos = [[nome, valor] for nome, valor in response.headers.items() if nome not in CABECALHOS_NAO_GUARDADOS]
+            db.session.execute(db.update(ChaveIdempotencia).where(*identificacao).values(
+                status_code=response.status_code, mimetype=response.mimetype,
+                cabecalhos=json.dumps(cabecalhos), corpo=response.get_data()
+            ))
+        db.session.commit()
+        return response
+    return rota_idempotente
+
+@app.cli.command('limpar-idempotencia')
+def comando_limpar_idempotencia():
+    """Remove as chaves de idempotência vencidas"""
+    resultado = db.session.execute(db.delete(ChaveIdempotencia).where(ChaveIdempotencia.expira_em <= datetime.utcnow()))
+    db.session.commit()
+    print(f"✅ {resultado.rowcount} chaves vencidas removidas")
+
+
+# Concorrência otimista na atualização de status
+TENTATIVAS_ATUALIZACAO = 5
+ESPERA_CONFLITO_SEGUNDOS = 0.005
+
+def versao_if_match():
+    """Versões aceitas pelo cabeçalho If-Match (ETags da entrega); None sem o cabeçalho ou com '*'"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versoes = set()
+    for etag in request.if_match.as_set(include_weak=True):
+        try:
+            versoes.add(int(etag))
+        except ValueError:
+            pass
+    return versoes
+
+def resposta_precondicao_falhou():
+    return resposta({
+        'success': False,
+        'error': 'A entrega foi alterada por outra requisição (If-Match não confere)'
+    }, 412)
+
+
 # ============================================================================
 # API REST ENDPOINTS
 # ============================================================================
@@ -449,80 +965,51 @@ from flask import jsonify
 @app.route('/api/entregas', methods=['GET'])
 def api_entregas():
     try:
-        entregas = Entrega.query.all()
-        entregas_list = []
+        linhas = db.session.execute(
+            db.select(*SERIALIZADOR_ENTREGA_LISTA.colunas, *COLUNAS_PREVISAO).order_by(Entrega.id)
+        ).all()
+        entregas_list = anexar_previsoes(SERIALIZADOR_ENTREGA_LISTA.lista(linhas), linhas)
         
-        for entrega in entregas:
-            entregas_list.append({
-                'id': entrega.id,
-                'codigo_rastreamento': entrega.codigo_rastreamento,
-                'remetente_nome': entrega.remetente_nome,
-                'remetente_cidade': entrega.remetente_cidade,
-                'destinatario_nome': entrega.destinatario_nome,
-                'destinatario_cidade': entrega.destinatario_cidade,
-                'tipo_produto': entrega.tipo_produto,
-                'peso': entrega.peso,
-                'valor_declarado': entrega.valor_declarado,
-                'status': entrega.status,
-                'data_criacao': entrega.data_criacao.isoformat() if entrega.data_criacao else None,
-                'data_atualizacao': entrega.data_atualizacao.isoformat() if entrega.data_atualizacao else None
-            })
-        
-        return jsonify({
+        return resposta({
             'success': True,
             'data': entregas_list,
             'total': len(entregas_list)
         })
     
     except Exception as e:
-        return jsonify({
+        return resposta({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 # API: Buscar entrega por código de rastreamento
 @app.route('/api/entregas/<codigo_rastreamento>', methods=['GET'])
 def api_entrega_por_codigo(codigo_rastreamento):
     try:
-        entrega = Entrega.query.filter_by(codigo_rastreamento=codigo_rastreamento).first()
+        linha = db.session.execute(consulta_entrega_detalhe(codigo_rastreamento)).first()
         
-        if not entrega:
-            return jsonify({
+        if not linha:
+            return resposta({
                 'success': False,
                 'error': 'Entrega não encontrada'
-            }), 404
-        
-        entrega_data = {
-            'id': entrega.id,
-            'codigo_rastreamento': entrega.codigo_rastreamento,
-            'remetente_nome': entrega.remetente_nome,
-            'remetente_endereco': entrega.remetente_endereco,
-            'remetente_cidade': entrega.remetente_cidade,
-            'destinatario_nome': entrega.destinatario_nome,
-            'destinatario_endereco': entrega.destinatario_endereco,
-            'destinatario_cidade': entrega.destinatario_cidade,
-            'tipo_produto': entrega.tipo_produto,
-            'peso': entrega.peso,
-            'valor_declarado': entrega.valor_declarado,
-            'observacoes': entrega.observacoes,
-            'status': entrega.status,
-            'data_criacao': entrega.data_criacao.isoformat() if entrega.data_criacao else None,
-            'data_atualizacao': entrega.data_atualizacao.isoformat() if entrega.data_atualizacao else None
-        }
+            }, 404)
         
-        return jsonify({
+        response = resposta({
             'success': True,
-            'data': entrega_data
+            'data': anexar_previsoes([SERIALIZADOR_ENTREGA_DETALHE.linha(linha)], [linha])[0]
         })
+        response.set_etag(str(linha.versao))
+        return response
     
     except Exception as e:
-        return jsonify({
+        return resposta({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 # API: Criar nova entrega
 @app.route('/api/entregas', methods=['POST'])
+@idempotente
 def api_criar_entrega():
     try:
         data = request.get_json()
@@ -534,18 +1021,18 @@ def api_criar_entrega():
         
         for field in required_fields:
             if not data.get(field):
-                return jsonify({
+                return resposta({
                     'success': False,
                     'error': f'Campo obrigatório: {field}'
-                }), 400
+                }, 400)
         
         # Gerar código de rastreamento único
         import random
         import string
         codigo = 'EI' + ''.join(random.choices(string.digits, k=10))
         
-        # Verificar se código já existe
-        while Entrega.query.filter_by(codigo_rastreamento=codigo).first():
+        # Verificar se código já existe (inclusive no arquivo)
+        while codigo_em_uso(codigo):
             codigo = 'EI' + ''.join(random.choices(string.digits, k=10))
         
         # Criar nova entrega
@@ -565,74 +1052,106 @@ def api_criar_entrega():
         )
         
         db.session.add(nova_entrega)
+        db.session.flush()
+        
+        # Montar a resposta antes do commit evita recarregar a linha em seguida
+        entrega_data = {
+            'id': nova_entrega.id,
+            'codigo_rastreamento': nova_entrega.codigo_rastreamento,
+            'status': nova_entrega.status
+        }
         db.session.commit()
         
-        return jsonify({
+        return resposta({
             'success': True,
-            'data': {
-                'id': nova_entrega.id,
-                'codigo_rastreamento': nova_entrega.codigo_rastreamento,
-                'status': nova_entrega.status
-            },
+            'data': entrega_data,
             'message': 'Entrega criada com sucesso'
-        }), 201
+        }, 201)
     
     except Exception as e:
         db.session.rollback()
-        return jsonify({
+        return resposta({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 # API: Atualizar status da entrega
 @app.route('/api/entregas/<codigo_rastreamento>/status', methods=['PUT'])
+@idempotente
 def api_atualizar_status(codigo_rastreamento):
     try:
         data = request.get_json()
         novo_status = data.get('status')
         
         if not novo_status:
-            return jsonify({
+            return resposta({
                 'success': False,
                 'error': 'Status é obrigatório'
-            }), 400
+            }, 400)
         
         # Validar status
         status_validos = ['pendente', 'coletado', 'em_transito', 'entregue', 'cancelado']
         if novo_status not in status_validos:
-            return jsonify({
+            return resposta({
                 'success': False,
                 'error': f'Status inválido. Valores aceitos: {", ".join(status_validos)}'
-            }), 400
+            }, 400)
         
-        entrega = Entrega.query.filter_by(codigo_rastreamento=codigo_rastreamento).first()
-        
-        if not entrega:
-            return jsonify({
-                'success': False,
-                'error': 'Entrega não encontrada'
-            }), 404
-        
-        entrega.status = novo_status
-        entrega.data_atualizacao = datetime.utcnow()
-        db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'data': {
+        # Sem If-Match, um conflito com outra escrita é resolvido relendo a entrega
+        versao_esperada = versao_if_match()
+        for tentativa in range(TENTATIVAS_ATUALIZACAO):
+            entrega = Entrega.query.filter_by(codigo_rastreamento=codigo_rastreamento).first()
+            
+            if not entrega:
+                return resposta({
+                    'success': False,
+                    'error': 'Entrega não encontrada'
+                }, 404)
+            
+            if versao_esperada is not None and entrega.versao not in versao_esperada:
+                db.session.rollback()
+                return resposta_precondicao_falhou()
+            
+            entrega.status = novo_status
+            entrega.data_atualizacao = datetime.utcnow()
+            try:
+                db.session.flush()
+            except StaleDataError:
+                # Outra escrita mudou a versão entre a leitura e o UPDATE
+                db.session.rollback()
+                if versao_esperada is not None:
+                    return resposta_precondicao_falhou()
+                # Espera aleatória e crescente para as escritas concorrentes não colidirem de novo
+                time.sleep(random.uniform(0, ESPERA_CONFLITO_SEGUNDOS * 2 ** tentativa))
+                continue
+            
+            entrega_data = {
                 'codigo_rastreamento': entrega.codigo_rastreamento,
                 'status': entrega.status,
-                'data_atualizacao': entrega.data_atualizacao.isoformat()
-            },
-            'message': 'Status atualizado com sucesso'
-        })
+                'data_atualizacao': entrega.data_atualizacao,
+                'versao': entrega.versao
+            }
+            db.session.commit()
+            
+            response = resposta({
+                'success': True,
+                'data': entrega_data,
+                'message': 'Status atualizado com sucesso'
+            })
+            response.set_etag(str(entrega_data['versao']))
+            return response
+        
+        return resposta({
+            'success': False,
+            'error': 'Conflito com atualizações simultâneas da entrega; tente novamente'
+        }, 409)
     
     except Exception as e:
         db.session.rollback()
-        return jsonify({
+        return resposta({
             'success': False,
             'error': str(e)
-        }), 500
+        }, 500)
 
 # API: Estatísticas gerais
 @app.route('/api/estatisticas', methods=['GET'])
@@ -650,12 +1169,14 @@ def api_estatisticas():
         else:
             taxa_sucesso = 0
         
-        # Entregas por cidade (top 5)
-        from sqlalchemy import func
+        # Entregas por cidade (top 5), agrupadas pela cidade canônica
         cidades_destino = db.session.query(
-            Entrega.destinatario_cidade,
+            Cidade.nome,
+            Cidade.uf,
             func.count(Entrega.id).label('total')
-        ).group_by(Entrega.destinatario_cidade).order_by(func.count(Entrega.id).desc()).limit(5).all()
+        ).join(Cidade, Cidade.id == Entrega.cidade_destino_id).group_by(
+            Entrega.cidade_destino_id, Cidade.nome, Cidade.uf
+        ).order_by(func.count(Entrega.id).desc()).limit(5).all()
         
         estatisticas = {
             'total_entregas': total_entregas,
@@ -667,8 +1188,8 @@ def api_estatisticas():
             },
             'taxa_sucesso': taxa_sucesso,
             'top_cidades_destino': [
-                {'cidade': cidade[0], 'total': cidade[1]} 
-                for cidade in cidades_destino
+                {'cidade': rotulo_cidade(nome, uf), 'total': total}
+                for nome, uf, total in cidades_destino
             ]
         }
         
@@ -683,6 +1204,223 @@ def api_estatisticas():
             'error': str(e)
         }), 500
 
+# ============================================================================
+# BUSCA TEXTUAL EM ENTREGAS
+# ============================================================================
+
+# Colunas indexadas e pesos de relevância (nomes > cidades > endereços/observações)
+COLUNAS_BUSCA = [
+    ('remetente_nome', 3.0),
+    ('remetente_endereco', 1.0),
+    ('remetente_cidade', 2.0),
+    ('destinatario_nome', 3.0),
+    ('destinatario_endereco', 1.0),
+    ('destinatario_cidade', 2.0),
+    ('observacoes', 1.0),
+]
+LIMITE_BUSCA_PADRAO = 20
+LIMITE_BUSCA_MAXIMO = 100
+
+def _ddl_busca_sqlite():
+    """Tabela FTS5 com conteúdo externo e gatilhos de sincronização (SQLite)"""
+    colunas = ', '.join(nome for nome, _ in COLUNAS_BUSCA)
+    novos = ', '.join(f'new.{nome}' for nome, _ in COLUNAS_BUSCA)
+    antigos = ', '.join(f'old.{nome}' for nome, _ in COLUNAS_BUSCA)
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS entrega_fts USING fts5(
+            {colunas}, content='entrega', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2')""",
+        f"""CREATE TRIGGER IF NOT EXISTS entrega_fts_ai AFTER INSERT ON entrega BEGIN
+            INSERT INTO entrega_fts(rowid, {colunas}) VALUES (new.id, {novos});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS entrega_fts_ad AFTER DELETE ON entrega BEGIN
+            INSERT INTO entrega_fts(entrega_fts, rowid, {colunas}) VALUES ('delete', old.id, {antigos});
+        END""",
+        # Somente alterações nas colunas indexadas reindexam a linha (mudanças de status não)
+        f"""CREATE TRIGGER IF NOT EXISTS entrega_fts_au AFTER UPDATE OF {colunas} ON entrega BEGIN
+            INSERT INTO entrega_fts(entrega_fts, rowid, {colunas}) VALUES ('delete', old.id, {antigos});
+            INSERT INTO entrega_fts(rowid, {colunas}) VALUES (new.id, {novos});
+        END""",
+    ]
+
+def _ddl_busca_postgresql():
+    """Coluna tsvector mantida por gatilho, com índice GIN (PostgreSQL)"""
+    pesos = {3.0: 'A', 2.0: 'B', 1.0: 'C'}
+    partes = ' || '.join(
+        f"setweight(to_tsvector('simple', unaccent(coalesce(NEW.{nome}, ''))), '{pesos[peso]}')"
+        for nome, peso in COLUNAS_BUSCA
+    )
+    colunas = ', '.join(nome for nome, _ in COLUNAS_BUSCA)
+    return [
+        "CREATE EXTENSION IF NOT EXISTS unaccent",
+        "ALTER TABLE entrega ADD COLUMN IF NOT EXISTS busca tsvector",
+        f"""CREATE OR REPLACE FUNCTION entrega_busca_atualizar() RETURNS trigger AS $$
+        BEGIN
+            NEW.busca := {partes};
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS entrega_busca_gatilho ON entrega",
+        f"""CREATE TRIGGER entrega_busca_gatilho BEFORE INSERT OR UPDATE OF {colunas}
+            ON entrega FOR EACH ROW EXECUTE FUNCTION entrega_busca_atualizar()""",
+        "CREATE INDEX IF NOT EXISTS ix_entrega_busca ON entrega USING GIN (busca)",
+    ]
+
+def configurar_busca_textual(conexao, reconstruir=False):
+    """Cria a estrutura de busca textual do banco; `reconstruir` indexa linhas existentes.
+    
+    A busca é opcional (FTS5 ou unaccent podem faltar): cada etapa roda em um
+    savepoint, e uma falha desfaz só a etapa, sem abortar a transação de quem
+    chamou (no PostgreSQL, um erro invalida a transação inteira). A estrutura
+    é uma etapa só, para não deixar um gatilho que chama uma extensão ausente.
+    """
+    dialeto = conexao.dialect.name
+    if dialeto == 'sqlite':
+        ddls = _ddl_busca_sqlite()
+        reconstrucao = "INSERT INTO entrega_fts(entrega_fts) VALUES ('rebuild')"
+    elif dialeto == 'postgresql':
+        ddls = _ddl_busca_postgresql()
+        # Dispara o gatilho para preencher a coluna nas linhas antigas
+        reconstrucao = "UPDATE entrega SET observacoes = observacoes WHERE busca IS NULL"
+    else:
+        return
+    try:
+        with conexao.begin_nested():
+            for ddl in ddls:
+                conexao.exec_driver_sql(ddl)
+        if reconstruir:
+            with conexao.begin_nested():
+                conexao.exec_driver_sql(reconstrucao)
+    except Exception as e:
+        app.logger.warning(f"Busca textual indisponível ({dialeto}): {e}")
+    finally:
+        _busca_textual_por_engine.pop(conexao.engine, None)
+
+# Resultado de busca_textual_configurada por engine. A estrutura só muda em
+# configurar_busca_textual e na remoção da tabela, que descartam o resultado.
+_busca_textual_por_engine = {}
+
+def busca_textual_configurada(conexao):
+    """Verifica (uma vez por engine) se o banco já possui a estrutura de busca textual"""
+    configurada = _busca_textual_por_engine.get(conexao.engine)
+    if configurada is None:
+        configurada = _busca_textual_no_banco(conexao)
+        _busca_textual_por_engine[conexao.engine] = configurada
+    return configurada
+
+def _busca_textual_no_banco(conexao):
+    if conexao.dialect.name == 'sqlite':
+        return conexao.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entrega_fts'"
+        ).first() is not None
+    if conexao.dialect.name == 'postgresql':
+        return 'busca' in {c['name'] for c in db.inspect(conexao).get_columns('entrega')}
+    return False
+
+def reconstruir_busca_textual():
+    """Cria a estrutura de busca, se faltar, e indexa as entregas existentes"""
+    configurar_busca_textual(db.session.connection(), reconstruir=True)
+    db.session.commit()
+
+@app.cli.command('reconstruir-busca')
+def comando_reconstruir_busca():
+    """Reindexa todas as entregas na busca textual"""
+    inicio = time.perf_counter()
+    reconstruir_busca_textual()
+    print(f"✅ Índice de busca reconstruído em {time.perf_counter() - inicio:.2f}s")
+
+@event.listens_for(Entrega.__table__, 'after_create')
+def _criar_busca_textual(target, conexao, **kw):
+    configurar_busca_textual(conexao)
+
+@event.listens_for(Entrega.__table__, 'before_drop')
+def _remover_busca_textual(target, conexao, **kw):
+    _busca_textual_por_engine.pop(conexao.engine, None)
+    if conexao.dialect.name == 'sqlite':
+        conexao.exec_driver_sql("DROP TABLE IF EXISTS entrega_fts")
+
+def termos_busca(consulta):
+    """Palavras da consulta do usuário, sem operadores da sintaxe de busca"""
+    return re.findall(r'\w+', consulta or '')[:10]
+
+def buscar_entregas(consulta, limite=LIMITE_BUSCA_PADRAO):
+    """Entregas que contêm todos os termos (por prefixo), ordenadas por relevância"""
+    termos = termos_busca(consulta)
+    if not termos:
+        return []
+    
+    conexao = db.session.connection()
+    colunas = SERIALIZADOR_ENTREGA_LISTA.colunas
+    
+    if conexao.dialect.name == 'sqlite' and busca_textual_configurada(conexao):
+        fts = table('entrega_fts', column('rowid'))
+        pesos = ', '.join(str(peso) for _, peso in COLUNAS_BUSCA)
+        expressao = ' '.join(f'"{termo}"*' for termo in termos)
+        relevancia = literal_column(f'bm25(entrega_fts, {pesos})')
+        consulta_sql = (
+            db.select(*colunas, (-relevancia).label('relevancia'))
+            .select_from(Entrega)
+            .join(fts, fts.c.rowid == Entrega.id)
+            .where(literal_column('entrega_fts').op('MATCH')(expressao))
+            .order_by(relevancia)
+        )
+    elif conexao.dialect.name == 'postgresql' and busca_textual_configurada(conexao):
+        vetor = literal_column('entrega.busca')
+        tsquery = func.to_tsquery('simple', func.unaccent(' & '.join(f'{termo}:*' for termo in termos)))
+        relevancia = func.ts_rank(vetor, tsquery)
+        consulta_sql = (
+            db.select(*colunas, relevancia.label('relevancia'))
+            .where(vetor.op('@@')(tsquery))
+            .order_by(relevancia.desc())
+        )
+    else:
+        # Sem índice textual: busca simples por substring em todas as colunas
+        condicoes = [
+            db.or_(*[getattr(Entrega, nome).ilike(f'%{termo}%') for nome, _ in COLUNAS_BUSCA])
+            for termo in termos
+        ]
+        consulta_sql = (
+            db.select(*colunas, literal_column('0').label('relevancia'))
+            .where(*condicoes)
+            .order_by(Entrega.data_criacao.desc())
+        )
+    
+    resultados = []
+    for linha in db.session.execute(consulta_sql.limit(limite)):
+        item = SERIALIZADOR_ENTREGA_LISTA.linha(linha)
+        item['relevancia'] = round(float(linha[-1]), 4)
+        resultados.append(item)
+    return resultados
+
+# API: Busca textual de entregas
+@app.route('/api/entregas/busca', methods=['GET'])
+def api_buscar_entregas():
+    try:
+        consulta = request.args.get('q', '')
+        if not termos_busca(consulta):
+            return resposta({
+                'success': False,
+                'error': 'Informe o termo de busca no parâmetro q'
+            }, 400)
+        
+        try:
+            limite = min(max(int(request.args.get('limite', LIMITE_BUSCA_PADRAO)), 1), LIMITE_BUSCA_MAXIMO)
+        except ValueError:
+            limite = LIMITE_BUSCA_PADRAO
+        
+        resultados = buscar_entregas(consulta, limite)
+        return resposta({
+            'success': True,
+            'data': resultados,
+            'total': len(resultados)
+        })
+    
+    except Exception as e:
+        return resposta({
+            'success': False,
+            'error': str(e)
+        }, 500)
+
 # API: Processar formulário de contato via AJAX
 @app.route('/api/contato', methods=['POST'])
 def api_processar_contato():
@@ -723,8 +1461,11 @@ class Rota(db.Model):
     nome = db.Column(db.String(100), nullable=False)
     origem = db.Column(db.String(100), nullable=False)
     destino = db.Column(db.String(100), nullable=False)
+    origem_id = db.Column(db.Integer, db.ForeignKey('cidade.id'))
+    destino_id = db.Column(db.Integer, db.ForeignKey('cidade.id'))
     distancia = db.Column(db.Float, nullable=False)
     tempo_estimado = db.Column(db.String(50), nullable=False)
+    duracao_horas = db.Column(db.Float)
     status = db.Column(db.String(20), default='ativa')
     data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -745,6 +1486,193 @@ class Empresa(db.Model):
     endereco = db.Column(db.Text, nullable=False)
     data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow)
 
+# Versão dos dados de referência, incrementada a cada escrita
+class VersaoReferencia(db.Model):
+    chave = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
+class CacheReferencia:
+    """Cache local do processo para dados de referência (configurações, empresa...).
+    
+    Cada conjunto é guardado junto com a versão lida do banco. As versões são
+    relidas em uma única consulta no máximo a cada `intervalo` segundos, então
+    uma escrita feita em outro worker é percebida dentro desse intervalo.
+    
+    Os valores em cache são compartilhados pelas threads do processo e nunca
+    são alterados no lugar: uma transação que invalida um conjunto só troca a
+    cópia local depois do commit, e até lá lê direto do banco.
+    """
+    
+    def __init__(self, intervalo=2.0):
+        self.intervalo = intervalo
+        self._itens = {}
+        self._versoes = {}
+        self._verificado_em = None
+        self._trava = threading.Lock()
+    
+    def versoes(self):
+        agora = time.monotonic()
+        if self._verificado_em is None or agora - self._verificado_em >= self.intervalo:
+            self._versoes = dict(db.session.execute(
+                db.select(VersaoReferencia.chave, VersaoReferencia.versao)
+            ).all())
+            self._verificado_em = agora
+        return self._versoes
+    
+    def obter(self, nome, carregar):
+        """Valor em cache para `nome`, recarregado com `carregar()` se a versão mudou"""
+        if db.session.info.get('referencias_pendentes'):
+            # A transação vê versões e dados ainda não confirmados, que não podem ir para o cache
+            return carregar()
+        
+        versao = self.versoes().get(nome, 0)
+        item = self._itens.get(nome)
+        if item is not None and item[0] == versao:
+            return item[1]
+        
+        valor = carregar()
+        self._itens[nome] = (versao, valor)
+        return valor
+    
+    def invalidar(self, nome, aplicar=None):
+        """Incrementa a versão na transação corrente; a cópia local muda após o commit.
+        
+        Com `aplicar`, a cópia local é substituída por `aplicar(valor)`, que
+        deve devolver um valor novo sem alterar o recebido, desde que
+        estivesse na versão anterior à transação; se outro worker escreveu
+        nesse meio tempo, ela é recarregada.
+        """
+        tabela = VersaoReferencia.__table__
+        conexao = db.session.connection()
+        inserir_ou_atualizar(conexao, tabela, {'chave': nome, 'versao': 1}, ['chave'],
+                             atualizar={'versao': tabela.c.versao + 1})
+        pendentes = db.session.info.setdefault('referencias_pendentes', {})
+        if aplicar is None:
+            # Sem `aplicar` a cópia local é só descartada; a versão nova não importa
+            pendentes[nome] = (None, None, [None])
+            return
+        
+        versao = conexao.execute(db.select(tabela.c.versao).where(tabela.c.chave == nome)).scalar()
+        anterior, _, funcoes = pendentes.get(nome, (versao - 1, None, []))
+        pendentes[nome] = (anterior, versao, funcoes + [aplicar])
+    
+    def confirmar(self, pendentes):
+        """Publica na cópia local as invalidações de uma transação confirmada"""
+        with self._trava:
+            for nome, (anterior, versao, funcoes) in pendentes.items():
+                item = self._itens.pop(nome, None)
+                if item is None or item[0] != anterior or None in funcoes:
+                    continue
+                try:
+                    valor = item[1]
+                    for aplicar in funcoes:
+                        valor = aplicar(valor)
+                except Exception as e:
+                    app.logger.warning(f"Cache de '{nome}' descartado: {e}")
+                    continue
+                self._itens[nome] = (versao, valor)
+            self._verificado_em = None
+    
+    def limpar(self):
+        self._itens.clear()
+        self._versoes = {}
+        self._verificado_em = None
+
+cache_referencia = CacheReferencia(float(os.environ.get('CACHE_REFERENCIA_INTERVALO', 2)))
+
+@event.listens_for(VersaoReferencia.__table__, 'after_create')
+def _limpar_cache_referencia(target, conexao, **kw):
+    cache_referencia.limpar()
+
+@event.listens_for(db.session, 'after_commit')
+def _confirmar_cache_referencia(sessao):
+    pendentes = sessao.info.pop('referencias_pendentes', None)
+    if pendentes:
+        cache_referencia.confirmar(pendentes)
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _descartar_cache_referencia(sessao, transacao):
+    # Invalidações de uma transação que não chegou ao banco não valem mais
+    sessao.info.pop('referencias_pendentes', None)
+
+# Valores padrão das configurações que não existirem no banco
+CONFIGURACOES_PADRAO = {
+    'notificacoes': 'true',
+    'rastreamento': 'true',
+    'modo_escuro': 'false',
+    'logout_automatico': 'true'
+}
+
+def carregar_configuracoes():
+    configs = dict(CONFIGURACOES_PADRAO)
+    configs.update(db.session.execute(db.select(Configuracao.chave, Configuracao.valor)).all())
+    return configs
+
+def carregar_empresa():
+    empresa = Empresa.query.first()
+    if not empresa:
+        return None
+    return {
+        'nome': empresa.nome,
+        'cnpj': empresa.cnpj,
+        'telefone': empresa.telefone,
+        'email': empresa.email,
+        'endereco': empresa.endereco
+    }
+
+def trecho_da_rota(rota):
+    return Trecho(rota.id, rota.nome, rota.origem_id, rota.destino_id, rota.origem, rota.destino,
+                  rota.distancia, rota.duracao_horas, rota.tempo_estimado)
+
+def consulta_grafo_rotas():
+    """Rotas ativas com as duas cidades, nas colunas usadas por trecho_da_rota"""
+    return db.select(
+        Rota.id, Rota.nome, Rota.origem_id, Rota.destino_id, Rota.origem, Rota.destino,
+        Rota.distancia, Rota.duracao_horas, Rota.tempo_estimado
+    ).where(Rota.status == 'ativa', Rota.origem_id.isnot(None), Rota.destino_id.isnot(None))
+
+def carregar_grafo_rotas():
+    return GrafoRotas(trecho_da_rota(r) for r in db.session.execute(consulta_grafo_rotas()))
+
+def obter_grafo_rotas():
+    return cache_referencia.obter('rotas', carregar_grafo_rotas)
+
+@event.listens_for(Rota, 'before_insert')
+def _rota_duracao_inicial(mapper, conexao, rota):
+    if rota.duracao_horas is None:
+        rota.duracao_horas = interpretar_duracao(rota.tempo_estimado)
+
+@event.listens_for(Rota, 'before_update')
+def _rota_atualizar_duracao(mapper, conexao, rota):
+    # Duração informada explicitamente prevalece sobre o texto
+    if _alterado(rota, 'tempo_estimado') and not _alterado(rota, 'duracao_horas'):
+        rota.duracao_horas = interpretar_duracao(rota.tempo_estimado)
+
+def preencher_duracao_rotas():
+    """Converte o tempo estimado (texto) das rotas sem duração numérica"""
+    rotas = db.session.execute(
+        db.select(Rota.id, Rota.tempo_estimado).where(Rota.duracao_horas.is_(None))
+    ).all()
+    valores = [{'id': rota_id, 'duracao_horas': interpretar_duracao(tempo)} for rota_id, tempo in rotas]
+    valores = [v for v in valores if v['duracao_horas'] is not None]
+    if valores:
+        db.session.execute(db.update(Rota), valores)
+    db.session.commit()
+    return len(valores)
+
+def aplicar_rota(rota, excluida=False):
+    """Função para `cache_referencia.invalidar`: cópia do grafo em cache com a rota atualizada"""
+    trecho = trecho_da_rota(rota) if rota.status == 'ativa' and not excluida else None
+    rota_id = rota.id
+    
+    def aplicar(grafo):
+        novo = grafo.copia()
+        novo.remover(rota_id)
+        if trecho is not None and trecho.origem_id and trecho.destino_id:
+            novo.adicionar(trecho)
+        return novo
+    return aplicar
+
 # API - Rotas
 @app.route('/api/rotas', methods=['GET'])
 def api_listar_rotas():
@@ -758,6 +1686,7 @@ def api_listar_rotas():
             'destino': r.destino,
             'distancia': r.distancia,
             'tempo_estimado': r.tempo_estimado,
+            'duracao_horas': r.duracao_horas,
             'status': r.status
         } for r in rotas])
     except Exception as e:
@@ -775,10 +1704,13 @@ def api_criar_rota():
             destino=data['destino'],
             distancia=float(data['distancia']),
             tempo_estimado=data['tempo_estimado'],
+            duracao_horas=float(data['duracao_horas']) if data.get('duracao_horas') is not None else None,
             status=data.get('status', 'ativa')
         )
         
         db.session.add(nova_rota)
+        db.session.flush()
+        cache_referencia.invalidar('rotas', aplicar_rota(nova_rota))
         db.session.commit()
         
         return jsonify({'message': 'Rota criada com sucesso', 'id': nova_rota.id}), 201
@@ -798,8 +1730,12 @@ def api_atualizar_rota(rota_id):
         rota.destino = data.get('destino', rota.destino)
         rota.distancia = float(data.get('distancia', rota.distancia))
         rota.tempo_estimado = data.get('tempo_estimado', rota.tempo_estimado)
+        if data.get('duracao_horas') is not None:
+            rota.duracao_horas = float(data['duracao_horas'])
         rota.status = data.get('status', rota.status)
         
+        db.session.flush()
+        cache_referencia.invalidar('rotas', aplicar_rota(rota))
         db.session.commit()
         return jsonify({'message': 'Rota atualizada com sucesso'})
     except Exception as e:
@@ -811,36 +1747,120 @@ def api_excluir_rota(rota_id):
     """Excluir rota"""
     try:
         rota = Rota.query.get_or_404(rota_id)
+        # Entregas da rota ficam sem rota até a próxima atribuição
+        db.session.execute(
+            db.update(Entrega).where(Entrega.rota_id == rota_id).values(rota_id=None, versao=Entrega.versao + 1)
+            .execution_options(synchronize_session=False)
+        )
         db.session.delete(rota)
+        cache_referencia.invalidar('rotas', aplicar_rota(rota, excluida=True))
         db.session.commit()
         return jsonify({'message': 'Rota excluída com sucesso'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# Previsões de todas as entregas em trânsito. Entregas gravadas sem passar pelo
+# ORM precisam preencher data_atualizacao para serem percebidas.
+previsao_entregas = PrevisaoEntregas(cache_referencia.intervalo)
+
+@event.listens_for(Entrega.__table__, 'after_create')
+def _limpar_previsoes(target, conexao, **kw):
+    previsao_entregas.limpar()
+
+def obter_previsoes():
+    """Previsões em trânsito, relendo só as entregas alteradas desde a última leitura"""
+    grafo = obter_grafo_rotas()
+    if previsao_entregas.vencida():
+        marca = datetime.utcnow()
+        consulta = db.select(Entrega.id, Entrega.status, Entrega.cidade_origem_id,
+                             Entrega.cidade_destino_id, Entrega.data_criacao)
+        desde = previsao_entregas.desde()
+        if desde is None:
+            consulta = consulta.where(Entrega.status.in_(STATUS_PREVISAO))
+        else:
+            consulta = consulta.where(Entrega.data_atualizacao >= desde)
+        return previsao_entregas.atualizar(db.session.execute(consulta).all(), grafo, marca)
+    return previsao_entregas.atualizar((), grafo)
+
+@app.route('/api/entregas/previsoes', methods=['GET'])
+def api_previsoes_entregas():
+    """Entregas em trânsito ordenadas pela previsão de entrega"""
+    try:
+        try:
+            limite = min(max(int(request.args.get('limite', POR_PAGINA_PADRAO)), 1), POR_PAGINA_MAXIMO)
+        except ValueError:
+            limite = POR_PAGINA_PADRAO
+        somente_atrasadas = request.args.get('atrasadas', '').lower() in ('1', 'true', 'sim')
+        
+        previsoes = obter_previsoes()
+        agora = datetime.utcnow()
+        proximas = previsoes.proximas(agora, limite, somente_atrasadas)
+        
+        linhas = {linha.id: linha for linha in db.session.execute(
+            db.select(Entrega.id, Entrega.codigo_rastreamento, Entrega.status, Entrega.destinatario_cidade)
+            .where(Entrega.id.in_([entrega_id for entrega_id, _, _ in proximas]))
+        )}
+        
+        return resposta({
+            'success': True,
+            'data': [{
+                'codigo_rastreamento': linhas[entrega_id].codigo_rastreamento,
+                'status': linhas[entrega_id].status,
+                'destinatario_cidade': linhas[entrega_id].destinatario_cidade,
+                'previsao_entrega': previsao,
+                'atrasada': atrasada
+            } for entrega_id, previsao, atrasada in proximas if entrega_id in linhas],
+            'resumo': previsoes.resumo(agora)
+        })
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+@app.route('/api/rotas/caminho', methods=['GET'])
+def api_caminho_rotas():
+    """Menor caminho entre duas cidades pelas rotas ativas, com um ou mais trechos"""
+    try:
+        criterio = request.args.get('criterio', 'distancia')
+        if criterio not in CRITERIOS:
+            return jsonify({'error': f"Critério inválido. Use: {', '.join(CRITERIOS)}"}), 400
+        
+        textos = request.args.get('origem', '').strip(), request.args.get('destino', '').strip()
+        if not all(textos):
+            return jsonify({'error': 'Parâmetros origem e destino são obrigatórios'}), 400
+        
+        cidades = [localizar_cidade(texto) for texto in textos]
+        if None in cidades:
+            return jsonify({'error': 'Cidade não encontrada'}), 404
+        (origem_id, origem), (destino_id, destino) = cidades
+        
+        caminho = obter_grafo_rotas().caminho(origem_id, destino_id, criterio)
+        if caminho is None:
+            return jsonify({'error': 'Nenhuma rota ativa liga as cidades informadas'}), 404
+        
+        return jsonify({
+            'origem': origem,
+            'destino': destino,
+            'criterio': criterio,
+            'distancia_total': caminho.distancia,
+            'tempo_total_horas': caminho.horas,
+            'trechos': [{
+                'rota_id': t.rota_id,
+                'nome': t.nome,
+                'origem': t.origem,
+                'destino': t.destino,
+                'distancia': t.distancia,
+                'tempo_estimado': t.tempo_estimado
+            } for t in caminho.trechos]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # API - Configurações
 @app.route('/api/configuracoes', methods=['GET'])
 def api_obter_configuracoes():
     """Obter todas as configurações"""
     try:
-        configs = {}
-        configuracoes = Configuracao.query.all()
-        
-        for config in configuracoes:
-            configs[config.chave] = config.valor
-        
-        # Valores padrão se não existirem no banco
-        defaults = {
-            'notificacoes': 'true',
-            'rastreamento': 'true',
-            'modo_escuro': 'false',
-            'logout_automatico': 'true'
-        }
-        
-        for chave, valor in defaults.items():
-            if chave not in configs:
-                configs[chave] = valor
-        
+        configs = cache_referencia.obter('configuracoes', carregar_configuracoes)
         return jsonify(configs)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -851,14 +1871,17 @@ def api_salvar_configuracoes():
     try:
         data = request.get_json()
         
-        for chave, valor in data.items():
-            config = Configuracao.query.filter_by(chave=chave).first()
-            if config:
-                config.valor = str(valor)
-                config.data_atualizacao = datetime.utcnow()
-            else:
-                config = Configuracao(chave=chave, valor=str(valor))
-                db.session.add(config)
+        # Um único INSERT ... ON CONFLICT para todas as chaves
+        if data:
+            agora = datetime.utcnow()
+            inserir_ou_atualizar(
+                db.session.connection(),
+                Configuracao.__table__,
+                [{'chave': chave, 'valor': str(valor), 'data_atualizacao': agora} for chave, valor in data.items()],
+                ['chave'],
+                atualizar=('valor', 'data_atualizacao')
+            )
+            cache_referencia.invalidar('configuracoes')
         
         db.session.commit()
         return jsonify({'message': 'Configurações salvas com sucesso'})
@@ -871,16 +1894,10 @@ def api_salvar_configuracoes():
 def api_obter_empresa():
     """Obter dados da empresa"""
     try:
-        empresa = Empresa.query.first()
+        empresa = cache_referencia.obter('empresa', carregar_empresa)
         
         if empresa:
-            return jsonify({
-                'nome': empresa.nome,
-                'cnpj': empresa.cnpj,
-                'telefone': empresa.telefone,
-                'email': empresa.email,
-                'endereco': empresa.endereco
-            })
+            return jsonify(empresa)
         else:
             # Dados padrão
             return jsonify({
@@ -917,6 +1934,7 @@ def api_atualizar_empresa():
             )
             db.session.add(empresa)
         
+        cache_referencia.invalidar('empresa')
         db.session.commit()
         return jsonify({'message': 'Dados da empresa atualizados com sucesso'})
     except Exception as e:
@@ -943,6 +1961,8 @@ def api_inicializar_dados():
             
             for rota in rotas_padrao:
                 db.session.add(rota)
+            db.session.flush()
+            cache_referencia.invalidar('rotas')
         
         # Verificar se já existe empresa
         if Empresa.query.count() == 0:
@@ -954,6 +1974,7 @@ def api_inicializar_dados():
                 endereco='Rod PB-372, S/N - Sítio Malhada Grande, Itaporanga/PB'
             )
             db.session.add(empresa_padrao)
+            cache_referencia.invalidar('empresa')
         
         # Verificar se já existem entregas
         if Entrega.query.count() == 0:
@@ -984,6 +2005,557 @@ def api_inicializar_dados():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# ============================================================================
+# CIDADES CANÔNICAS
+# ============================================================================
+
+# Cache do processo: chave da cidade -> id (cidades nunca são excluídas)
+_cache_cidades = {}
+
+def resolver_cidade(conexao, texto):
+    """Id da cidade canônica correspondente ao texto livre, criando-a se necessário.
+    
+    Recebe a conexão em uso para poder ser chamada durante o flush do ORM.
+    """
+    nome, uf = interpretar_cidade(texto)
+    if not nome:
+        return None
+    
+    chave = chave_cidade(nome, uf)
+    if chave in _cache_cidades:
+        return _cache_cidades[chave]
+    
+    tabela = Cidade.__table__
+    nome_chave = dobrar(nome)
+    
+    if uf:
+        cidade_id = conexao.execute(db.select(tabela.c.id).where(tabela.c.chave == chave)).scalar()
+        if cidade_id is None:
+            # Completa a UF de uma cidade cadastrada sem ela (ex.: origem de uma rota)
+            cidade_id = conexao.execute(
+                db.select(tabela.c.id).where(tabela.c.nome_chave == nome_chave, tabela.c.uf.is_(None)).limit(1)
+            ).scalar()
+            if cidade_id is not None:
+                conexao.execute(tabela.update().where(tabela.c.id == cidade_id).values(uf=uf, chave=chave))
+    else:
+        cidade_id = conexao.execute(
+            db.select(tabela.c.id).where(tabela.c.nome_chave == nome_chave).order_by(tabela.c.id).limit(1)
+        ).scalar()
+    
+    if cidade_id is None:
+        inserir_ou_atualizar(conexao, tabela, {'nome': nome, 'uf': uf, 'nome_chave': nome_chave, 'chave': chave}, ['chave'])
+        cidade_id = conexao.execute(db.select(tabela.c.id).where(tabela.c.chave == chave)).scalar()
+    
+    _cache_cidades[chave] = cidade_id
+    return cidade_id
+
+def localizar_cidade(texto):
+    """(id, rótulo) da cidade cadastrada correspondente ao texto, sem criá-la"""
+    nome, uf = interpretar_cidade(texto)
+    if uf:
+        condicao = Cidade.chave == chave_cidade(nome, uf)
+    else:
+        condicao = Cidade.nome_chave == dobrar(nome)
+    cidade = db.session.execute(
+        db.select(Cidade.id, Cidade.nome, Cidade.uf).where(condicao).order_by(Cidade.id).limit(1)
+    ).first()
+    return (cidade.id, rotulo_cidade(cidade.nome, cidade.uf)) if cidade else None
+
+@event.listens_for(Cidade.__table__, 'after_create')
+def _limpar_cache_cidades(target, conexao, **kw):
+    _cache_cidades.clear()
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _limpar_cache_cidades_rollback(sessao, transacao):
+    # Cidades inseridas na transação desfeita deixam de existir
+    _cache_cidades.clear()
+
+def _alterado(objeto, atributo):
+    return db.inspect(objeto).attrs[atributo].history.has_changes()
+
+@event.listens_for(Entrega, 'before_insert')
+def _entrega_resolver_cidades(mapper, conexao, entrega):
+    if entrega.cidade_origem_id is None:
+        entrega.cidade_origem_id = resolver_cidade(conexao, entrega.remetente_cidade)
+    if entrega.cidade_destino_id is None:
+        entrega.cidade_destino_id = resolver_cidade(conexao, entrega.destinatario_cidade)
+
+@event.listens_for(Entrega, 'before_update')
+def _entrega_atualizar_cidades(mapper, conexao, entrega):
+    if _alterado(entrega, 'remetente_cidade'):
+        entrega.cidade_origem_id = resolver_cidade(conexao, entrega.remetente_cidade)
+    if _alterado(entrega, 'destinatario_cidade'):
+        entrega.cidade_destino_id = resolver_cidade(conexao, entrega.destinatario_cidade)
+
+@event.listens_for(Rota, 'before_insert')
+def _rota_resolver_cidades(mapper, conexao, rota):
+    rota.origem_id = resolver_cidade(conexao, rota.origem)
+    rota.destino_id = resolver_cidade(conexao, rota.destino)
+
+@event.listens_for(Rota, 'before_update')
+def _rota_atualizar_cidades(mapper, conexao, rota):
+    if _alterado(rota, 'origem'):
+        rota.origem_id = resolver_cidade(conexao, rota.origem)
+    if _alterado(rota, 'destino'):
+        rota.destino_id = resolver_cidade(conexao, rota.destino)
+
+def normalizar_cidades():
+    """Preenche as referências de cidade de entregas e rotas ainda sem normalização.
+    
+    Resolve cada texto distinto uma única vez, grava o mapa texto -> cidade
+    em uma tabela temporária e preenche cada coluna com uma única instrução
+    junto com ela, em uma só transação. Retorna o número de linhas atualizadas.
+    """
+    pares = [
+        (Entrega, Entrega.remetente_cidade, Entrega.cidade_origem_id),
+        (Entrega, Entrega.destinatario_cidade, Entrega.cidade_destino_id),
+        (Rota, Rota.origem, Rota.origem_id),
+        (Rota, Rota.destino, Rota.destino_id),
+    ]
+    conexao = db.session.connection()
+    
+    cidades = {}
+    for _, coluna_texto, coluna_id in pares:
+        textos = db.session.execute(
+            db.select(coluna_texto).where(coluna_id.is_(None), coluna_texto.isnot(None)).distinct()
+        ).scalars().all()
+        for texto in textos:
+            if texto not in cidades:
+                cidades[texto] = resolver_cidade(conexao, texto)
+    
+    mapa = [{'texto': texto, 'cidade_id': cidade_id} for texto, cidade_id in cidades.items() if cidade_id]
+    if not mapa:
+        db.session.commit()
+        return 0
+    
+    temporaria = db.Table(
+        'mapa_cidades', db.MetaData(),
+        db.Column('texto', db.String, primary_key=True),
+        db.Column('cidade_id', db.Integer, nullable=False),
+        prefixes=['TEMPORARY']
+    )
+    temporaria.create(conexao)
+    conexao.execute(temporaria.insert(), mapa)
+    
+    atualizadas = 0
+    for modelo, coluna_texto, coluna_id in pares:
+        cidade_id = db.select(temporaria.c.cidade_id).where(temporaria.c.texto == coluna_texto).scalar_subquery()
+        valores = {coluna_id.key: cidade_id}
+        if modelo is Entrega:
+            # As cidades mudam a previsão exibida: nova versão (ETag)
+            valores['versao'] = Entrega.versao + 1
+        resultado = db.session.execute(
+            db.update(modelo)
+            .where(coluna_id.is_(None), coluna_texto.in_(db.select(temporaria.c.texto)))
+            .values(valores)
+            .execution_options(synchronize_session=False)
+        )
+        atualizadas += resultado.rowcount
+    
+    temporaria.drop(conexao)
+    db.session.commit()
+    return atualizadas
+
+@app.cli.command('normalizar-cidades')
+def comando_normalizar_cidades():
+    """Normaliza as cidades de entregas e rotas existentes"""
+    total = normalizar_cidades()
+    print(f"✅ {total} referências de cidade preenchidas")
+
+# API - Autocompletar cidades
+@app.route('/api/cidades', methods=['GET'])
+def api_autocompletar_cidades():
+    """Cidades cujo nome começa com o prefixo informado (sem acentos)"""
+    try:
+        try:
+            limite = min(max(int(request.args.get('limite', 10)), 1), 50)
+        except ValueError:
+            limite = 10
+        
+        consulta = db.select(Cidade.id, Cidade.nome, Cidade.uf)
+        intervalo = intervalo_prefixo(request.args.get('prefixo', ''))
+        if intervalo:
+            consulta = consulta.where(Cidade.nome_chave >= intervalo[0], Cidade.nome_chave < intervalo[1])
+        
+        cidades = db.session.execute(consulta.order_by(Cidade.nome_chave, Cidade.uf).limit(limite))
+        return resposta({
+            'success': True,
+            'data': [
+                {'id': cidade_id, 'nome': nome, 'uf': uf, 'rotulo': rotulo_cidade(nome, uf)}
+                for cidade_id, nome, uf in cidades
+            ]
+        })
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+# ============================================================================
+# ROTA DAS ENTREGAS
+# ============================================================================
+
+# Entregas ainda não embarcadas
+STATUS_PLANEJAMENTO = ('pendente', 'coletado')
+
+# Status listados por padrão no manifesto da rota
+STATUS_MANIFESTO = ('pendente', 'coletado', 'em_transito')
+
+@event.listens_for(db.session, 'before_flush')
+def _atribuir_rota_entregas(sessao, contexto, instancias):
+    """Atribui a rota de entregas novas ou com cidades alteradas.
+    
+    Roda antes do flush (e não em before_insert) porque carregar o grafo de
+    rotas pode exigir consultas pela sessão.
+    """
+    entregas = [e for e in sessao.new if isinstance(e, Entrega) and e.rota_id is None]
+    entregas += [
+        e for e in sessao.dirty
+        if isinstance(e, Entrega) and not _alterado(e, 'rota_id')
+        and (_alterado(e, 'remetente_cidade') or _alterado(e, 'destinatario_cidade'))
+    ]
+    if not entregas:
+        return
+    
+    conexao = sessao.connection()
+    grafo = obter_grafo_rotas()
+    for entrega in entregas:
+        entrega.cidade_origem_id = resolver_cidade(conexao, entrega.remetente_cidade)
+        entrega.cidade_destino_id = resolver_cidade(conexao, entrega.destinatario_cidade)
+        if entrega.cidade_origem_id and entrega.cidade_destino_id:
+            entrega.rota_id = grafo.proxima_rota(entrega.cidade_origem_id, entrega.cidade_destino_id)
+
+def atribuir_rotas(reatribuir=False):
+    """Preenche a rota das entregas gravadas sem ela (cargas em lote, bancos antigos).
+    
+    Com `reatribuir`, recalcula também as entregas aguardando embarque, para
+    refletir rotas criadas, desativadas ou excluídas. Cada par de cidades é
+    resolvido uma vez e atualizado em uma única instrução. Retorna o número
+    de entregas atualizadas.
+    """
+    condicao = Entrega.status.in_(STATUS_PLANEJAMENTO) if reatribuir else Entrega.rota_id.is_(None)
+    pares = db.session.execute(
+        db.select(Entrega.cidade_origem_id, Entrega.cidade_destino_id).where(
+            condicao, Entrega.cidade_origem_id.isnot(None), Entrega.cidade_destino_id.isnot(None)
+        ).distinct()
+    ).all()
+    
+    grafo = obter_grafo_rotas()
+    atualizadas = 0
+    for origem_id, destino_id in pares:
+        rota_id = grafo.proxima_rota(origem_id, destino_id)
+        if rota_id is None and not reatribuir:
+            continue
+        resultado = db.session.execute(
+            db.update(Entrega)
+            .where(condicao, Entrega.cidade_origem_id == origem_id, Entrega.cidade_destino_id == destino_id)
+            .values(rota_id=rota_id, versao=Entrega.versao + 1)
+            .execution_options(synchronize_session=False)
+        )
+        atualizadas += resultado.rowcount
+    db.session.commit()
+    return atualizadas
+
+@app.cli.command('atribuir-rotas')
+@click.option('--reatribuir', is_flag=True, help='Recalcular também entregas aguardando embarque que já têm rota')
+def comando_atribuir_rotas(reatribuir):
+    """Atribui rotas às entregas existentes"""
+    total = atribuir_rotas(reatribuir)
+    print(f"✅ {total} entregas com rota atribuída")
+
+@app.route('/api/rotas/<int:rota_id>/manifesto', methods=['GET'])
+def api_manifesto_rota(rota_id):
+    """Entregas atribuídas à rota, agrupadas por cidade de destino, para o motorista"""
+    try:
+        rota = db.session.execute(
+            db.select(Rota.id, Rota.nome, Rota.origem, Rota.destino).where(Rota.id == rota_id)
+        ).first()
+        if not rota:
+            return resposta({'success': False, 'error': 'Rota não encontrada'}, 404)
+        
+        status = [s for s in request.args.get('status', '').split(',') if s] or list(STATUS_MANIFESTO)
+        linhas = db.session.execute(
+            db.select(*SERIALIZADOR_MANIFESTO.colunas)
+            .where(Entrega.rota_id == rota_id, Entrega.status.in_(status))
+            .order_by(Entrega.destinatario_cidade, Entrega.id)
+        ).all()
+        
+        return resposta({
+            'success': True,
+            'rota': {'id': rota.id, 'nome': rota.nome, 'origem': rota.origem, 'destino': rota.destino},
+            'data': SERIALIZADOR_MANIFESTO.lista(linhas),
+            'total_entregas': len(linhas),
+            'peso_total': round(sum(l.peso or 0 for l in linhas), 3),
+            'valor_total': round(sum(l.valor_declarado or 0 for l in linhas), 2)
+        })
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+# ============================================================================
+# PLANEJAMENTO DE CARGA
+# ============================================================================
+
+def volumes_por_rota(status=STATUS_PLANEJAMENTO, rota_id=None):
+    """Agrupa as entregas pela rota atribuída. Retorna ({rota_id: [Volume]}, sem_rota)"""
+    consulta = db.select(Entrega.codigo_rastreamento, Entrega.peso, Entrega.valor_declarado, Entrega.rota_id)
+    if rota_id is not None:
+        consulta = consulta.where(Entrega.rota_id == rota_id)
+    linhas = db.session.execute(consulta.where(Entrega.status.in_(status)).order_by(Entrega.id)).all()
+    
+    grupos = {} if rota_id is None else {rota_id: []}
+    sem_rota = []
+    for codigo, peso, valor, rota in linhas:
+        if rota is None:
+            sem_rota.append(codigo)
+        else:
+            grupos.setdefault(rota, []).append(Volume(codigo, peso, valor))
+    return grupos, sem_rota
+
+def planejar_cargas(capacidade_peso, capacidade_valor=None, rota_id=None, melhorar=True, status=STATUS_PLANEJAMENTO):
+    """Plano de carregamento de cada rota com entregas aguardando embarque"""
+    grupos, sem_rota = volumes_por_rota(status, rota_id)
+    
+    nomes = dict(db.session.execute(db.select(Rota.id, Rota.nome).where(Rota.id.in_(list(grupos)))).all())
+    planos = []
+    for rota, volumes in sorted(grupos.items()):
+        plano = planejar(volumes, capacidade_peso, capacidade_valor, melhorar)
+        planos.append({
+            'rota_id': rota,
+            'rota': nomes.get(rota),
+            'total_volumes': len(volumes),
+            'total_veiculos': len(plano.veiculos),
+            'limite_inferior': plano.limite_inferior,
+            'veiculos': plano.resumo(),
+            'nao_alocados': [v.id for v in plano.nao_alocados]
+        })
+    return planos, sem_rota
+
+@app.route('/api/planejamento/carga', methods=['POST'])
+def api_planejamento_carga():
+    """Distribui as entregas pendentes/coletadas de cada rota entre veículos"""
+    try:
+        data = request.get_json() or {}
+        try:
+            capacidade_peso = float(data['capacidade_peso'])
+            capacidade_valor = float(data['capacidade_valor']) if data.get('capacidade_valor') is not None else None
+            rota_id = int(data['rota_id']) if data.get('rota_id') is not None else None
+        except KeyError:
+            return jsonify({'success': False, 'error': 'Campo obrigatório: capacidade_peso'}), 400
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Capacidades e rota devem ser numéricas'}), 400
+        
+        status = data.get('status', STATUS_PLANEJAMENTO)
+        if isinstance(status, str):
+            status = [status]
+        
+        try:
+            planos, sem_rota = planejar_cargas(capacidade_peso, capacidade_valor, rota_id,
+                                               bool(data.get('melhorar', True)), status)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        return resposta({'success': True, 'data': planos, 'sem_rota': sem_rota})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.cli.command('planejar-carga')
+@click.option('--capacidade', type=float, required=True, help='Capacidade de peso do veículo (kg)')
+@click.option('--capacidade-valor', type=float, default=None, help='Limite de valor declarado por veículo (R$)')
+@click.option('--rota', 'rota_id', type=int, default=None, help='Planejar somente esta rota')
+@click.option('--sem-melhoria', is_flag=True, help='Não aplicar a busca local após o first-fit decreasing')
+def comando_planejar_carga(capacidade, capacidade_valor, rota_id, sem_melhoria):
+    """Planeja o carregamento das entregas aguardando embarque"""
+    inicio = time.perf_counter()
+    planos, sem_rota = planejar_cargas(capacidade, capacidade_valor, rota_id, not sem_melhoria)
+    duracao = time.perf_counter() - inicio
+    
+    for plano in planos:
+        print(f"🚚 {plano['rota'] or plano['rota_id']}: {plano['total_volumes']} volumes em "
+              f"{plano['total_veiculos']} veículos (mínimo teórico {plano['limite_inferior']})")
+        for i, veiculo in enumerate(plano['veiculos'], 1):
+            print(f"   Veículo {i}: {len(veiculo['volumes'])} volumes, {veiculo['peso']} kg "
+                  f"({veiculo['ocupacao']:.0%}), R$ {veiculo['valor']:.2f}")
+        if plano['nao_alocados']:
+            print(f"   ⚠️  Excedem a capacidade: {', '.join(plano['nao_alocados'])}")
+    if sem_rota:
+        print(f"⚠️  {len(sem_rota)} entregas sem rota ativa")
+    print(f"✅ Planejamento concluído em {duracao:.2f}s")
+
+# ============================================================================
+# COTAÇÃO DE FRETE
+# ============================================================================
+
+LIMITE_LOTE_COTACAO = 10000
+
+# Tabela compilada junto com o texto de origem (None: tabela padrão)
+_tabela_frete = [None, TabelaFrete()]
+
+def obter_tabela_frete():
+    """Tabela de frete vigente: a da configuração 'tabela_frete' ou a padrão"""
+    texto = cache_referencia.obter('configuracoes', carregar_configuracoes).get('tabela_frete')
+    if texto != _tabela_frete[0]:
+        try:
+            tabela = TabelaFrete.de_json(texto) if texto else TabelaFrete()
+        except ValueError as e:
+            app.logger.warning(f"{e}; usando a tabela padrão")
+            tabela = TabelaFrete()
+        _tabela_frete[:] = [texto, tabela]
+    return _tabela_frete[1]
+
+def localizar_cidades(textos):
+    """{texto: id} das cidades cadastradas, em no máximo duas consultas"""
+    chaves, nomes = {}, {}
+    for texto in set(textos):
+        nome, uf = interpretar_cidade(texto)
+        if uf:
+            chaves[chave_cidade(nome, uf)] = texto
+        elif nome:
+            nomes.setdefault(dobrar(nome), []).append(texto)
+    
+    encontradas = {}
+    if chaves:
+        for cidade_id, chave in db.session.execute(
+            db.select(Cidade.id, Cidade.chave).where(Cidade.chave.in_(list(chaves)))
+        ):
+            encontradas[chaves[chave]] = cidade_id
+    if nomes:
+        for cidade_id, nome_chave in db.session.execute(
+            db.select(Cidade.id, Cidade.nome_chave).where(Cidade.nome_chave.in_(list(nomes))).order_by(Cidade.id.desc())
+        ):
+            # Ordem decrescente: o menor id de cada nome prevalece, como em resolver_cidade
+            for texto in nomes[nome_chave]:
+                encontradas[texto] = cidade_id
+    return encontradas
+
+def distancias_cotacao(itens):
+    """Distância de cada item: a informada ou a do menor caminho entre origem e destino (None se não houver)"""
+    textos = [t for item in itens if item.get('distancia') is None for t in (item.get('origem'), item.get('destino')) if t]
+    cidades = localizar_cidades(textos) if textos else {}
+    grafo = obter_grafo_rotas() if cidades else None
+    
+    memo = {}
+    distancias = []
+    for item in itens:
+        if item.get('distancia') is not None:
+            distancias.append(float(item['distancia']))
+            continue
+        par = (cidades.get(item.get('origem')), cidades.get(item.get('destino')))
+        if par not in memo:
+            caminho = grafo.caminho(*par) if None not in par else None
+            memo[par] = caminho.distancia if caminho and caminho.trechos else None
+        distancias.append(memo[par])
+    return distancias
+
+@app.route('/api/cotacao', methods=['POST'])
+def api_cotacao():
+    """Cotação de frete de uma remessa, por distância ou por cidades de origem e destino"""
+    try:
+        data = request.get_json() or {}
+        try:
+            distancia = distancias_cotacao([data])[0]
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'Distância deve ser numérica'}), 400
+        if distancia is None:
+            return jsonify({'success': False, 'error': 'Informe a distância ou cidades ligadas por rotas ativas'}), 400
+        
+        try:
+            cotacao = obter_tabela_frete().cotar(data.get('peso'), distancia, data.get('valor_declarado'),
+                                                 data.get('tipo_produto'))
+        except (TypeError, ValueError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        cotacao['distancia'] = distancia
+        return resposta({'success': True, 'data': cotacao})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def erro_item_cotacao(item):
+    """Mensagem do primeiro problema de tipo em um item do lote de cotação (None se válido)"""
+    if not isinstance(item, dict):
+        return 'Cada item deve ser um objeto'
+    for campo in ('peso', 'valor_declarado', 'distancia'):
+        valor = item.get(campo)
+        if valor is not None and (isinstance(valor, bool) or not isinstance(valor, (int, float, str))):
+            return 'Peso, valor declarado e distância devem ser numéricos'
+        try:
+            float(valor or 0)
+        except ValueError:
+            return 'Peso, valor declarado e distância devem ser numéricos'
+    for campo in ('tipo_produto', 'origem', 'destino'):
+        if item.get(campo) is not None and not isinstance(item[campo], str):
+            return 'Tipo de produto, origem e destino devem ser texto'
+    return None
+
+@app.route('/api/cotacao/lote', methods=['POST'])
+def api_cotacao_lote():
+    """Cotação de frete de várias remessas em uma única chamada"""
+    try:
+        itens = (request.get_json() or {}).get('itens')
+        if not isinstance(itens, list) or not itens:
+            return jsonify({'success': False, 'error': 'Informe a lista de itens'}), 400
+        if len(itens) > LIMITE_LOTE_COTACAO:
+            return jsonify({'success': False, 'error': f'Máximo de {LIMITE_LOTE_COTACAO} itens por lote'}), 400
+        
+        # Os itens são validados um a um: o cálculo vetorizado não aponta qual item tem problema
+        pesos, valores = [], []
+        for indice, item in enumerate(itens):
+            erro = erro_item_cotacao(item)
+            if erro is None:
+                pesos.append(float(item.get('peso') or 0))
+                valores.append(float(item.get('valor_declarado') or 0))
+                if pesos[-1] < 0 or valores[-1] < 0 or float(item.get('distancia') or 0) < 0:
+                    erro = 'Peso, distância e valor declarado não podem ser negativos'
+            if erro is not None:
+                return jsonify({'success': False, 'error': f'Item {indice}: {erro}', 'indice': indice}), 400
+        
+        distancias = distancias_cotacao(itens)
+        cotaveis = [i for i, d in enumerate(distancias) if d is not None]
+        totais = obter_tabela_frete().cotar_lote(
+            [pesos[i] for i in cotaveis],
+            [distancias[i] for i in cotaveis],
+            [valores[i] for i in cotaveis],
+            [itens[i].get('tipo_produto') for i in cotaveis]
+        ).tolist()
+        
+        resultado = [{'distancia': None, 'total': None, 'erro': 'Sem rota entre as cidades'}] * len(itens)
+        for i, total in zip(cotaveis, totais):
+            resultado[i] = {'distancia': distancias[i], 'total': total}
+        
+        return resposta({
+            'success': True,
+            'data': resultado,
+            'total_itens': len(itens),
+            'valor_total': round(sum(totais), 2)
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/cotacao/tabela', methods=['GET'])
+def api_obter_tabela_frete():
+    """Tabela de frete vigente"""
+    return jsonify(obter_tabela_frete().dados)
+
+@app.route('/api/cotacao/tabela', methods=['PUT'])
+def api_salvar_tabela_frete():
+    """Substituir a tabela de frete (validada antes de salvar)"""
+    try:
+        texto = json.dumps(request.get_json(), ensure_ascii=False)
+        try:
+            TabelaFrete.de_json(texto)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        inserir_ou_atualizar(
+            db.session.connection(),
+            Configuracao.__table__,
+            {'chave': 'tabela_frete', 'valor': texto, 'data_atualizacao': datetime.utcnow()},
+            ['chave'],
+            atualizar=('valor', 'data_atualizacao')
+        )
+        cache_referencia.invalidar('configuracoes')
+        db.session.commit()
+        return jsonify({'message': 'Tabela de frete salva com sucesso'})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/docs', methods=['GET'])
 def api_docs():
     """Documentação da API"""
@@ -993,21 +2565,41 @@ def api_docs():
         'endpoints': {
             'GET /api/entregas': 'Listar todas as entregas',
             'GET /api/entregas/<codigo>': 'Buscar entrega por código de rastreamento',
+            'GET /api/rastrear/<codigo>': 'Rastreamento público de uma entrega',
+            'POST /api/rastrear/lote': 'Rastreamento de vários códigos ({"codigos": [...]}) em uma chamada',
             'POST /api/entregas': 'Criar nova entrega',
             'PUT /api/entregas/<codigo>/status': 'Atualizar status da entrega',
+            'GET /api/entregas/busca?q=': 'Busca textual de entregas por nome, endereço, cidade ou observações',
+            'GET /api/entregas/previsoes?atrasadas=&limite=': 'Entregas em trânsito ordenadas pela previsão de entrega',
             'GET /api/estatisticas': 'Obter estatísticas gerais',
+            'GET /api/estatisticas/tempos?agrupar=status|rota|rota_status&quantis=&inicio=&fim=&status=&rota_id=': 'Percentis do tempo de entrega por status e rota',
+            'GET /api/estatisticas/serie?granularidade=dia|semana|mes&inicio=&fim=&status=&tipo_produto=&destino=': 'Série de entregas a partir dos resumos diários',
             'POST /api/contato': 'Processar formulário de contato',
             'GET /api/rotas': 'Listar todas as rotas',
             'POST /api/rotas': 'Criar nova rota',
             'PUT /api/rotas/<id>': 'Atualizar rota',
             'DELETE /api/rotas/<id>': 'Excluir rota',
+            'GET /api/rotas/caminho?origem=&destino=&criterio=distancia|tempo': 'Menor caminho entre cidades pelas rotas ativas',
+            'GET /api/rotas/<id>/manifesto?status=': 'Entregas atribuídas à rota',
+            'GET /api/anomalias?desde=&tipo=queda|pico&destino=&tipo_produto=&limite=': 'Quedas e picos no volume diário por cidade e produto',
+            'GET /api/alertas/sla?todos=&limite=': 'Entregas paradas além da duração prevista da rota',
+            'GET /api/cidades?prefixo=': 'Autocompletar cidades por prefixo',
+            'POST /api/planejamento/carga': 'Distribuir entregas aguardando embarque entre veículos',
+            'POST /api/cotacao': 'Cotação de frete (peso, valor_declarado, tipo_produto e distancia ou origem/destino)',
+            'POST /api/cotacao/lote': 'Cotação de frete de vários itens em uma chamada',
+            'GET /api/cotacao/tabela': 'Tabela de frete vigente',
+            'PUT /api/cotacao/tabela': 'Substituir a tabela de frete',
             'GET /api/configuracoes': 'Obter configurações',
             'POST /api/configuracoes': 'Salvar configurações',
             'GET /api/empresa': 'Obter dados da empresa',
             'POST /api/empresa': 'Atualizar dados da empresa',
             'POST /api/init-data': 'Inicializar dados padrão',
+            'GET /gestao/analytics/dados': 'Resumo pré-calculado das análises de entregas (requer login)',
             'GET /api/docs': 'Esta documentação'
         },
+        'cabecalhos': {
+            'Idempotency-Key': 'Em POST /api/entregas e PUT /api/entregas/<codigo>/status: repetições com a mesma chave recebem a resposta original'
+        },
         'status_validos': ['pendente', 'coletado', 'em_transito', 'entregue', 'cancelado'],
         'exemplo_entrega': {
             'remetente_nome': 'João Silva',
@@ -1025,6 +2617,25 @@ def api_docs():
     
     return jsonify(docs)
 
+# ============================================================================
+# ANÁLISES PRÉ-CALCULADAS
+# ============================================================================
+
+# Resumo das análises (o mesmo do relatório de análise avançada), calculado
+# pelo comando `flask atualizar-analytics`, agendado no cron. O comando
+# mantém o estado incremental em ANALYTICS_ESTADO e grava o resumo pronto no
+# banco; os workers só leem esse dicionário, pelo cache de referência.
+ANALYTICS_ESTADO = os.environ.get('ANALYTICS_ESTADO', os.path.join(app.instance_path, 'analytics.estado.npz'))
+
+class ResumoAnalytics(db.Model):
+    id = db.Column(db.Integer, primary_key=True)  # Linha única
+    dados = db.Column(db.Text, nullable=False)  # JSON do resumo
+    gerado_em = db.Column(db.DateTime, nullable=False)
+
+def carregar_resumo_analytics():
+    dados = db.session.execute(db.select(ResumoAnalytics.dados).where(ResumoAnalytics.id == 1)).scalar()
+    return json.loads(dados) if dados else None
+
 # Rota para análise de dados
 @app.route('/gestao/analytics')
 def analytics():
@@ -1032,6 +2643,674 @@ def analytics():
         return redirect(url_for('gestao_login'))
     return render_template('gestao/analytics.html')
 
+@app.route('/gestao/analytics/dados', methods=['GET'])
+def analytics_dados():
+    """Resumo pré-calculado das análises de entregas"""
+    if 'user_id' not in session:
+        return resposta({'success': False, 'error': 'Login necessário'}, 401)
+    try:
+        dados = cache_referencia.obter('analytics', carregar_resumo_analytics)
+        if dados is None:
+            return resposta({'success': False, 'error': 'Resumo ainda não calculado (flask atualizar-analytics)'}, 503)
+        response = resposta(dados)
+        response.headers['Cache-Control'] = f'private, max-age={int(cache_referencia.intervalo)}'
+        return response
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+@app.cli.command('atualizar-analytics')
+@click.option('--estado', default=None, help='Arquivo do estado (padrão: ANALYTICS_ESTADO)')
+@click.option('--reconstruir', is_flag=True, help='Ignora o estado salvo e relê todas as entregas')
+def comando_atualizar_analytics(estado, reconstruir):
+    """Atualiza o estado das análises e grava o resumo servido pela aplicação"""
+    caminho = estado or ANALYTICS_ESTADO
+    inicio = time.perf_counter()
+    atual = EstadoAnalitico() if reconstruir else EstadoAnalitico.carregar(caminho)
+    relidas = atual.atualizar(ConsultasAnaliticas(db.engine))
+    os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+    atual.salvar(caminho)
+    
+    dados = resumo_analises(atual)
+    dados['gerado_em'] = atual.marca.isoformat()
+    inserir_ou_atualizar(
+        db.session.connection(), ResumoAnalytics.__table__,
+        {'id': 1, 'dados': json.dumps(dados, ensure_ascii=False), 'gerado_em': atual.marca},
+        ['id'], atualizar=('dados', 'gerado_em')
+    )
+    cache_referencia.invalidar('analytics')
+    db.session.commit()
+    print(f"✅ {relidas} entregas relidas, {len(atual)} no estado, em {time.perf_counter() - inicio:.2f}s")
+
+
+# ============================================================================
+# RESUMOS DIÁRIOS
+# ============================================================================
+
+# Agregados por dia de criação × status × cidade de destino × produto. Séries
+# longas somam algumas centenas de linhas em vez de ler todas as entregas.
+# O comando `flask atualizar-resumos`, agendado no cron, recalcula só os dias
+# que têm entregas alteradas desde a execução anterior.
+class ResumoDiario(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    dia = db.Column(db.Date, nullable=False, index=True)
+    status = db.Column(db.String(20))
+    cidade_destino_id = db.Column(db.Integer, db.ForeignKey('cidade.id'))
+    tipo_produto = db.Column(db.String(50))
+    quantidade = db.Column(db.Integer, nullable=False)
+    peso_total = db.Column(db.Float, nullable=False, default=0)
+    valor_total = db.Column(db.Float, nullable=False, default=0)
+    # Marca da execução que calculou a linha: a maior é a da última execução
+    atualizado_em = db.Column(db.DateTime, nullable=False, index=True)
+
+FOLGA_RESUMOS = timedelta(seconds=60)
+DIAS_POR_LOTE_RESUMOS = 100
+GRANULARIDADES_SERIE = ('dia', 'semana', 'mes')
+
+def _dia_criacao(coluna=Entrega.data_criacao):
+    return func.date(coluna, type_=db.Date)
+
+def _recalcular_resumos(marca, dias=None):
+    """Substitui os resumos dos `dias` (todos, se None) pelo agregado atual das
+    entregas, ativas e arquivadas"""
+    partes = []
+    for modelo in (Entrega, EntregaArquivada):
+        parte = db.select(
+            modelo.data_criacao, modelo.status, modelo.cidade_destino_id, modelo.tipo_produto,
+            modelo.peso, modelo.valor_declarado
+        ).where(modelo.data_criacao.is_not(None))
+        if dias is not None:
+            # Intervalos de data_criacao usam o índice da coluna
+            parte = parte.where(or_(*(
+                and_(modelo.data_criacao >= inicio, modelo.data_criacao < inicio + timedelta(days=1))
+                for inicio in (datetime(d.year, d.month, d.day) for d in dias)
+            )))
+        partes.append(parte)
+    entregas = db.union_all(*partes).subquery()
+    
+    dia = _dia_criacao(entregas.c.data_criacao)
+    agregado = db.select(
+        dia, entregas.c.status, entregas.c.cidade_destino_id, entregas.c.tipo_produto, func.count(),
+        func.coalesce(func.sum(entregas.c.peso), 0.0), func.coalesce(func.sum(entregas.c.valor_declarado), 0.0),
+        literal(marca, db.DateTime)
+    ).group_by(dia, entregas.c.status, entregas.c.cidade_destino_id, entregas.c.tipo_produto)
+    remocao = db.delete(ResumoDiario)
+    if dias is not None:
+        remocao = remocao.where(ResumoDiario.dia.in_(dias))
+    db.session.execute(remocao)
+    db.session.execute(db.insert(ResumoDiario).from_select(
+        ['dia', 'status', 'cidade_destino_id', 'tipo_produto', 'quantidade', 'peso_total', 'valor_total',
+         'atualizado_em'],
+        agregado
+    ))
+
+def atualizar_resumos_diarios(completo=False):
+    """Recalcula os resumos dos dias com entregas alteradas desde a última execução.
+    
+    Sem resumos anteriores (ou com `completo`), recalcula todos os dias.
+    Retorna o número de dias recalculados.
+    """
+    marca = datetime.utcnow()
+    ultima = db.session.scalar(db.select(func.max(ResumoDiario.atualizado_em)))
+    if completo or ultima is None:
+        _recalcular_resumos(marca)
+        db.session.commit()
+        return db.session.scalar(db.select(func.count(ResumoDiario.dia.distinct())))
+    
+    dia = _dia_criacao()
+    dias = sorted(d for d in db.session.scalars(
+        db.select(dia).where(Entrega.data_atualizacao >= ultima - FOLGA_RESUMOS).distinct()
+    ) if d is not None)
+    for inicio in range(0, len(dias), DIAS_POR_LOTE_RESUMOS):
+        _recalcular_resumos(marca, dias[inicio:inicio + DIAS_POR_LOTE_RESUMOS])
+    db.session.commit()
+    return len(dias)
+
+def periodo_serie(dia, granularidade):
+    """Rótulo do período: o dia, a segunda-feira da semana ou AAAA-MM"""
+    if granularidade == 'semana':
+        dia = dia - timedelta(days=dia.weekday())
+    elif granularidade == 'mes':
+        return dia.strftime('%Y-%m')
+    return dia.isoformat()
+
+@app.cli.command('atualizar-resumos')
+@click.option('--completo', is_flag=True, help='Recalcula todos os dias')
+def comando_atualizar_resumos(completo):
+    """Atualiza os resumos diários das entregas"""
+    inicio = time.perf_counter()
+    dias = atualizar_resumos_diarios(completo)
+    print(f"✅ {dias} dias recalculados em {time.perf_counter() - inicio:.2f}s")
+
+@app.route('/api/estatisticas/serie', methods=['GET'])
+def api_serie_estatisticas():
+    """Série de entregas por dia, semana ou mês de criação, a partir dos resumos diários"""
+    try:
+        granularidade = request.args.get('granularidade', 'dia')
+        if granularidade not in GRANULARIDADES_SERIE:
+            return resposta({'success': False, 'error': 'granularidade deve ser dia, semana ou mes'}, 400)
+        try:
+            inicio = date.fromisoformat(request.args['inicio']) if request.args.get('inicio') else None
+            fim = date.fromisoformat(request.args['fim']) if request.args.get('fim') else None
+        except ValueError:
+            return resposta({'success': False, 'error': 'inicio e fim devem estar no formato AAAA-MM-DD'}, 400)
+        
+        consulta = db.select(
+            ResumoDiario.dia, ResumoDiario.status, func.sum(ResumoDiario.quantidade).label('quantidade'),
+            func.sum(ResumoDiario.peso_total).label('peso'), func.sum(ResumoDiario.valor_total).label('valor')
+        ).group_by(ResumoDiario.dia, ResumoDiario.status).order_by(ResumoDiario.dia)
+        if inicio:
+            consulta = consulta.where(ResumoDiario.dia >= inicio)
+        if fim:
+            consulta = consulta.where(ResumoDiario.dia <= fim)
+        if request.args.get('status'):
+            consulta = consulta.where(ResumoDiario.status == request.args['status'])
+        if request.args.get('tipo_produto'):
+            consulta = consulta.where(ResumoDiario.tipo_produto == request.args['tipo_produto'])
+        if request.args.get('destino'):
+            cidade = localizar_cidade(request.args['destino'])
+            # Cidade desconhecida não corresponde a nenhum resumo (nem aos sem cidade de destino)
+            consulta = consulta.where(ResumoDiario.cidade_destino_id == cidade[0] if cidade else false())
+        
+        periodos = {}
+        for linha in db.session.execute(consulta):
+            chave = periodo_serie(linha.dia, granularidade)
+            periodo = periodos.setdefault(chave, {
+                'periodo': chave, 'total': 0, 'peso_total': 0.0, 'valor_total': 0.0, 'por_status': {}
+            })
+            periodo['total'] += linha.quantidade
+            periodo['peso_total'] += linha.peso
+            periodo['valor_total'] += linha.valor
+            periodo['por_status'][linha.status] = periodo['por_status'].get(linha.status, 0) + linha.quantidade
+        for periodo in periodos.values():
+            periodo['peso_total'] = round(periodo['peso_total'], 2)
+            periodo['valor_total'] = round(periodo['valor_total'], 2)
+        
+        return resposta({
+            'success': True,
+            'granularidade': granularidade,
+            'atualizado_em': db.session.scalar(db.select(func.max(ResumoDiario.atualizado_em))),
+            'data': list(periodos.values())
+        })
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+
+# ============================================================================
+# PERCENTIS DE TEMPO DE ENTREGA
+# ============================================================================
+
+# Cada mudança de status registra o tempo desde a criação da entrega em um
+# esboço de quantis (DDSketch) por dia × rota × status, guardado como uma
+# contagem por balde. Combinar dias, rotas ou processos é somar contagens, então
+# p50/p90/p99 leem algumas centenas de linhas, qualquer que seja o volume.
+class EsbocoTempo(db.Model):
+    dia = db.Column(db.Date, primary_key=True)
+    rota_id = db.Column(db.Integer, primary_key=True)  # 0: entrega sem rota
+    status = db.Column(db.String(20), primary_key=True)
+    indice = db.Column(db.Integer, primary_key=True)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+
+ESBOCO_TEMPO = EsbocoQuantis()
+AGRUPAMENTOS_TEMPO = {'status': ('status',), 'rota': ('rota_id',), 'rota_status': ('rota_id', 'status')}
+
+def registrar_tempo(conexao, linhas):
+    """Soma observações (dia, rota_id, status, indice, quantidade) aos esboços"""
+    tabela = EsbocoTempo.__table__
+    return inserir_ou_atualizar(conexao, tabela, linhas, ['dia', 'rota_id', 'status', 'indice'],
+                                atualizar={'quantidade': tabela.c.quantidade + literal_column('excluded.quantidade')})
+
+@event.listens_for(Entrega, 'after_update')
+def _entrega_registrar_tempo(mapper, conexao, entrega):
+    if not _alterado(entrega, 'status'):
+        return
+    # Lidos do estado carregado: dentro do flush não se pode recarregar atributos
+    valores = db.inspect(entrega).dict
+    atualizacao = valores.get('data_atualizacao') or datetime.utcnow()
+    criacao = valores.get('data_criacao')
+    if criacao is None:
+        return
+    registrar_tempo(conexao, [{
+        'dia': atualizacao.date(),
+        'rota_id': valores.get('rota_id') or 0,
+        'status': entrega.status,
+        'indice': ESBOCO_TEMPO.indice((atualizacao - criacao).total_seconds() / 3600),
+        'quantidade': 1
+    }])
+
+def reconstruir_esbocos_tempo(tamanho_lote=100000):
+    """Refaz os esboços a partir do status atual de cada entrega.
+    
+    O banco não guarda o histórico de status: cada entrega contribui só com o
+    tempo até a última alteração. A partir daí, cada mudança de status feita
+    pela aplicação acrescenta uma observação. Retorna o número de entregas lidas.
+    """
+    db.session.execute(db.delete(EsbocoTempo))
+    consulta = db.select(Entrega.rota_id, Entrega.status, Entrega.data_criacao, Entrega.data_atualizacao).where(
+        Entrega.data_criacao.is_not(None), Entrega.data_atualizacao.is_not(None), Entrega.status.is_not(None)
+    )
+    contagens = {}
+    lidas = 0
+    resultado = db.session.execute(consulta, execution_options={'yield_per': tamanho_lote})
+    for linhas in resultado.partitions():
+        for rota_id, status, criacao, atualizacao in linhas:
+            chave = (atualizacao.date(), rota_id or 0, status,
+                     ESBOCO_TEMPO.indice((atualizacao - criacao).total_seconds() / 3600))
+            contagens[chave] = contagens.get(chave, 0) + 1
+        lidas += len(linhas)
+    
+    colunas = ('dia', 'rota_id', 'status', 'indice')
+    linhas = [dict(zip(colunas, chave), quantidade=quantidade) for chave, quantidade in contagens.items()]
+    for inicio in range(0, len(linhas), 5000):
+        db.session.execute(db.insert(EsbocoTempo), linhas[inicio:inicio + 5000])
+    db.session.commit()
+    return lidas
+
+def percentis_tempo(agrupar='status', quantis=QUANTIS_PADRAO, inicio=None, fim=None, status=None, rota_id=None):
+    """Percentis do tempo (horas desde a criação) por grupo, somando os esboços do período"""
+    grupo = [getattr(EsbocoTempo, coluna) for coluna in AGRUPAMENTOS_TEMPO[agrupar]]
+    consulta = db.select(*grupo, EsbocoTempo.indice, func.sum(EsbocoTempo.quantidade)).group_by(
+        *grupo, EsbocoTempo.indice
+    )
+    if inicio:
+        consulta = consulta.where(EsbocoTempo.dia >= inicio)
+    if fim:
+        consulta = consulta.where(EsbocoTempo.dia <= fim)
+    if status:
+        consulta = consulta.where(EsbocoTempo.status == status)
+    if rota_id is not None:
+        consulta = consulta.where(EsbocoTempo.rota_id == rota_id)
+    
+    esbocos = {}
+    for *chave, indice, quantidade in db.session.execute(consulta):
+        esbocos.setdefault(tuple(chave), EsbocoQuantis()).contagens[indice] = quantidade
+    
+    grupos = []
+    for chave, esboco in sorted(esbocos.items()):
+        linha = dict(zip(AGRUPAMENTOS_TEMPO[agrupar], chave), quantidade=len(esboco))
+        linha.update({nome: round(valor, 2) for nome, valor in esboco.quantis(quantis).items()})
+        grupos.append(linha)
+    return grupos
+
+@app.cli.command('reconstruir-esbocos')
+def comando_reconstruir_esbocos():
+    """Refaz os esboços de tempo de entrega a partir do banco"""
+    inicio = time.perf_counter()
+    lidas = reconstruir_esbocos_tempo()
+    print(f"✅ {lidas} entregas lidas em {time.perf_counter() - inicio:.2f}s")
+
+@app.route('/api/estatisticas/tempos', methods=['GET'])
+def api_percentis_tempo():
+    """Percentis do tempo desde a criação até cada mudança de status"""
+    try:
+        agrupar = request.args.get('agrupar', 'status')
+        if agrupar not in AGRUPAMENTOS_TEMPO:
+            return resposta({'success': False, 'error': 'agrupar deve ser status, rota ou rota_status'}, 400)
+        try:
+            quantis = tuple(float(q) for q in request.args['quantis'].split(',')) \
+                if request.args.get('quantis') else QUANTIS_PADRAO
+            if not all(0 <= q <= 1 for q in quantis):
+                raise ValueError
+            inicio = date.fromisoformat(request.args['inicio']) if request.args.get('inicio') else None
+            fim = date.fromisoformat(request.args['fim']) if request.args.get('fim') else None
+            rota_id = int(request.args['rota_id']) if request.args.get('rota_id') else None
+        except ValueError:
+            return resposta({'success': False, 'error': 'Parâmetros inválidos: quantis entre 0 e 1, datas AAAA-MM-DD'}, 400)
+        
+        return resposta({
+            'success': True,
+            'precisao_relativa': ESBOCO_TEMPO.precisao,
+            'data': percentis_tempo(agrupar, quantis, inicio, fim, request.args.get('status'), rota_id)
+        })
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+
+# ============================================================================
+# ALERTAS DE SLA
+# ============================================================================
+
+# Entregas paradas no mesmo status por mais tempo que a duração prevista da
+# rota atribuída. Para cada (status, duração de rota) a busca percorre só a
+# faixa do índice (status, data_atualizacao) que venceu desde a verificação
+# anterior. Se a duração de uma rota mudar, use --completo para reavaliar tudo.
+STATUS_SLA = ('em_transito',)
+SLA_PADRAO_HORAS = 72.0  # entregas sem rota ou com rota sem duração
+LOTE_ALERTAS_SLA = 1000
+FOLGA_SLA = timedelta(seconds=60)
+
+class AlertaSla(db.Model):
+    __table_args__ = (
+        # Uma entrega parada gera um único alerta até mudar de status
+        db.UniqueConstraint('entrega_id', 'data_referencia', name='uq_alerta_sla_entrega_referencia'),
+        # Listagem dos abertos já na ordem do prazo
+        db.Index('ix_alerta_sla_aberto_prazo', 'resolvido_em', 'prazo'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    entrega_id = db.Column(db.Integer, db.ForeignKey('entrega.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    data_referencia = db.Column(db.DateTime, nullable=False)  # data_atualizacao da entrega
+    prazo = db.Column(db.DateTime, nullable=False)
+    detectado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    resolvido_em = db.Column(db.DateTime)
+
+# Histórico das verificações; a última delimita a faixa lida pela próxima
+class VerificacaoSla(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    executada_em = db.Column(db.DateTime, nullable=False, index=True)
+    completa = db.Column(db.Boolean, nullable=False, default=False)
+    alertas_novos = db.Column(db.Integer, nullable=False, default=0)
+    alertas_resolvidos = db.Column(db.Integer, nullable=False, default=0)
+
+def verificar_sla(completo=False, agora=None):
+    """Registra alertas das entregas que passaram do prazo e resolve os que deixaram de estar.
+    
+    Retorna (alertas novos, alertas resolvidos).
+    """
+    agora = agora or datetime.utcnow()
+    anterior = None if completo else db.session.scalar(db.select(func.max(VerificacaoSla.executada_em)))
+    
+    # Rotas agrupadas pela duração: uma faixa do índice por (status, duração)
+    rotas_por_duracao = {}
+    for rota_id, duracao in db.session.execute(db.select(Rota.id, Rota.duracao_horas)):
+        rotas_por_duracao.setdefault(duracao or SLA_PADRAO_HORAS, []).append(rota_id)
+    faixas = [(duracao, Entrega.rota_id.in_(rota_ids))
+              for duracao, rota_ids in rotas_por_duracao.items() if duracao != SLA_PADRAO_HORAS]
+    faixas.append((SLA_PADRAO_HORAS, or_(Entrega.rota_id.is_(None),
+                                         Entrega.rota_id.in_(rotas_por_duracao.get(SLA_PADRAO_HORAS, [])))))
+    
+    linhas = []
+    for status in STATUS_SLA:
+        for duracao, condicao in faixas:
+            limite = timedelta(hours=duracao)
+            consulta = db.select(Entrega.id, Entrega.data_atualizacao).where(
+                Entrega.status == status, Entrega.data_atualizacao < agora - limite, condicao
+            )
+            if anterior is not None:
+                consulta = consulta.where(Entrega.data_atualizacao >= anterior - limite - FOLGA_SLA)
+            linhas.extend({
+                'entrega_id': entrega_id, 'status': status, 'data_referencia': referencia,
+                'prazo': referencia + limite, 'detectado_em': agora
+            } for entrega_id, referencia in db.session.execute(consulta))
+    
+    novos = 0
+    conexao = db.session.connection()
+    for inicio in range(0, len(linhas), LOTE_ALERTAS_SLA):
+        resultado = inserir_ou_atualizar(conexao, AlertaSla.__table__, linhas[inicio:inicio + LOTE_ALERTAS_SLA],
+                                         ['entrega_id', 'data_referencia'])
+        novos += max(resultado.rowcount, 0)
+    
+    # Alertas abertos de entregas que mudaram de status ou foram atualizadas depois
+    parada = db.select(Entrega.id).where(
+        Entrega.id == AlertaSla.entrega_id,
+        Entrega.status == AlertaSla.status,
+        Entrega.data_atualizacao <= AlertaSla.data_referencia
+    ).exists()
+    resolucao = db.update(AlertaSla).where(AlertaSla.resolvido_em.is_(None), ~parada)
+    if anterior is not None:
+        # Só entregas alteradas desde a verificação anterior podem ter saído do alerta
+        resolucao = resolucao.where(AlertaSla.entrega_id.in_(
+            db.select(Entrega.id).where(Entrega.data_atualizacao >= anterior - FOLGA_SLA)
+        ))
+    resolvidos = db.session.execute(
+        resolucao.values(resolvido_em=agora).execution_options(synchronize_session=False)
+    ).rowcount
+    
+    db.session.add(VerificacaoSla(executada_em=agora, completa=anterior is None,
+                                  alertas_novos=novos, alertas_resolvidos=resolvidos))
+    db.session.commit()
+    return novos, resolvidos
+
+@app.cli.command('verificar-sla')
+@click.option('--completo', is_flag=True, help='Reavalia todas as entregas, não só as que venceram desde a última verificação')
+def comando_verificar_sla(completo):
+    """Registra alertas de entregas paradas além da duração prevista da rota"""
+    inicio = time.perf_counter()
+    novos, resolvidos = verificar_sla(completo)
+    print(f"✅ {novos} alertas novos, {resolvidos} resolvidos em {time.perf_counter() - inicio:.2f}s")
+
+@app.route('/api/alertas/sla', methods=['GET'])
+def api_alertas_sla():
+    """Alertas de SLA, abertos por padrão, dos mais atrasados para os mais recentes"""
+    try:
+        try:
+            limite = min(max(int(request.args.get('limite', POR_PAGINA_PADRAO)), 1), POR_PAGINA_MAXIMO)
+        except ValueError:
+            limite = POR_PAGINA_PADRAO
+        todos = request.args.get('todos', '').lower() in ('1', 'true', 'sim')
+        
+        consulta = db.select(
+            AlertaSla.id, AlertaSla.status, AlertaSla.prazo, AlertaSla.detectado_em, AlertaSla.resolvido_em,
+            Entrega.codigo_rastreamento, Entrega.destinatario_cidade, Entrega.rota_id
+        ).join(Entrega, Entrega.id == AlertaSla.entrega_id).order_by(AlertaSla.prazo, AlertaSla.id).limit(limite)
+        if not todos:
+            consulta = consulta.where(AlertaSla.resolvido_em.is_(None))
+        
+        agora = datetime.utcnow()
+        return resposta({
+            'success': True,
+            'data': [{
+                'id': alerta.id,
+                'codigo_rastreamento': alerta.codigo_rastreamento,
+                'status': alerta.status,
+                'destinatario_cidade': alerta.destinatario_cidade,
+                'rota_id': alerta.rota_id,
+                'prazo': alerta.prazo,
+                'atraso_horas': round(((alerta.resolvido_em or agora) - alerta.prazo).total_seconds() / 3600, 1),
+                'detectado_em': alerta.detectado_em,
+                'resolvido_em': alerta.resolvido_em
+            } for alerta in db.session.execute(consulta)],
+            'abertos': db.session.scalar(
+                db.select(func.count()).select_from(AlertaSla).where(AlertaSla.resolvido_em.is_(None))
+            ),
+            'verificado_em': db.session.scalar(db.select(func.max(VerificacaoSla.executada_em)))
+        })
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+
+# ============================================================================
+# ANOMALIAS DE VOLUME
+# ============================================================================
+
+# Quedas e picos no número diário de entregas por cidade de destino (total e
+# por produto), comparados à linha de base dos dias anteriores. As contagens
+# vêm dos resumos diários; o job recalcula todo o histórico e substitui a tabela.
+class AnomaliaVolume(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    dia = db.Column(db.Date, nullable=False, index=True)
+    cidade_destino_id = db.Column(db.Integer, db.ForeignKey('cidade.id'))
+    tipo_produto = db.Column(db.String(50))  # None: todos os produtos da cidade
+    tipo = db.Column(db.String(10), nullable=False)  # queda ou pico
+    observado = db.Column(db.Integer, nullable=False)
+    esperado = db.Column(db.Float, nullable=False)
+    escore = db.Column(db.Float, nullable=False)
+    detectado_em = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+def detectar_anomalias_volume(janela=anomalias.JANELA_PADRAO, limiar=anomalias.LIMIAR_PADRAO):
+    """Recalcula as anomalias de todos os dias completos. Retorna o número encontrado."""
+    atualizar_resumos_diarios()
+    hoje = datetime.utcnow().date()
+    consulta = db.select(
+        ResumoDiario.dia, ResumoDiario.cidade_destino_id, ResumoDiario.tipo_produto,
+        func.sum(ResumoDiario.quantidade)
+    ).where(ResumoDiario.dia < hoje).group_by(
+        ResumoDiario.dia, ResumoDiario.cidade_destino_id, ResumoDiario.tipo_produto
+    )
+    linhas = []
+    for dia, cidade_id, produto, quantidade in db.session.execute(consulta):
+        linhas.append((dia, (cidade_id, produto), quantidade))
+        linhas.append((dia, (cidade_id, None), quantidade))
+    
+    chaves, inicio, matriz = anomalias.matriz_diaria(linhas)
+    series, dias, observados, esperados, escores = anomalias.detectar(matriz, janela, limiar)
+    agora = datetime.utcnow()
+    registros = [{
+        'dia': (inicio + dia).item(),
+        'cidade_destino_id': chaves[serie][0],
+        'tipo_produto': chaves[serie][1],
+        'tipo': 'pico' if escore > 0 else 'queda',
+        'observado': int(observado),
+        'esperado': round(float(esperado), 2),
+        'escore': round(float(escore), 2),
+        'detectado_em': agora
+    } for serie, dia, observado, esperado, escore in zip(
+        series.tolist(), dias.tolist(), observados, esperados, escores
+    )]
+    
+    db.session.execute(db.delete(AnomaliaVolume))
+    for posicao in range(0, len(registros), 5000):
+        db.session.execute(db.insert(AnomaliaVolume), registros[posicao:posicao + 5000])
+    db.session.commit()
+    return len(registros)
+
+@app.cli.command('detectar-anomalias')
+@click.option('--janela', type=int, default=anomalias.JANELA_PADRAO, help='Dias de histórico da linha de base')
+@click.option('--limiar', type=float, default=anomalias.LIMIAR_PADRAO, help='Escore robusto mínimo para alertar')
+def comando_detectar_anomalias(janela, limiar):
+    """Recalcula as anomalias de volume diário por cidade e produto"""
+    inicio = time.perf_counter()
+    total = detectar_anomalias_volume(janela, limiar)
+    print(f"✅ {total} anomalias encontradas em {time.perf_counter() - inicio:.2f}s")
+
+@app.route('/api/anomalias', methods=['GET'])
+def api_anomalias_volume():
+    """Anomalias de volume, das mais recentes para as mais antigas"""
+    try:
+        try:
+            limite = min(max(int(request.args.get('limite', POR_PAGINA_PADRAO)), 1), POR_PAGINA_MAXIMO)
+            desde = date.fromisoformat(request.args['desde']) if request.args.get('desde') else None
+        except ValueError:
+            return resposta({'success': False, 'error': 'desde deve estar no formato AAAA-MM-DD'}, 400)
+        
+        consulta = db.select(AnomaliaVolume, Cidade.nome, Cidade.uf).outerjoin(
+            Cidade, Cidade.id == AnomaliaVolume.cidade_destino_id
+        ).order_by(AnomaliaVolume.dia.desc(), func.abs(AnomaliaVolume.escore).desc()).limit(limite)
+        if desde:
+            consulta = consulta.where(AnomaliaVolume.dia >= desde)
+        if request.args.get('tipo'):
+            consulta = consulta.where(AnomaliaVolume.tipo == request.args['tipo'])
+        if request.args.get('tipo_produto'):
+            consulta = consulta.where(AnomaliaVolume.tipo_produto == request.args['tipo_produto'])
+        if request.args.get('destino'):
+            cidade = localizar_cidade(request.args['destino'])
+            # Cidade desconhecida não corresponde a nenhuma série (nem às sem cidade de destino)
+            consulta = consulta.where(AnomaliaVolume.cidade_destino_id == cidade[0] if cidade else false())
+        
+        return resposta({
+            'success': True,
+            'data': [{
+                'dia': anomalia.dia.isoformat(),
+                'destino': rotulo_cidade(nome, uf) if nome else None,
+                'tipo_produto': anomalia.tipo_produto,
+                'tipo': anomalia.tipo,
+                'observado': anomalia.observado,
+                'esperado': anomalia.esperado,
+                'escore': anomalia.escore
+            } for anomalia, nome, uf in db.session.execute(consulta)]
+        })
+    except Exception as e:
+        return resposta({'success': False, 'error': str(e)}, 500)
+
+
+# ============================================================================
+# ARQUIVAMENTO DE ENTREGAS
+# ============================================================================
+
+# Entregas encerradas (entregues ou canceladas) há mais de RETENCAO_DIAS saem da
+# tabela entrega, que listagens, painéis e previsões consultam, e vão para
+# entrega_arquivada com o mesmo id. O rastreamento procura no arquivo quando
+# não encontra o código, e os resumos diários somam as duas tabelas.
+STATUS_ARQUIVAVEIS = ('entregue', 'cancelado')
+RETENCAO_DIAS = int(os.environ.get('RETENCAO_DIAS', 180))
+LOTE_ARQUIVAMENTO = 1000
+
+class EntregaArquivada(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    codigo_rastreamento = db.Column(db.String(20), unique=True, nullable=False)
+    remetente_nome = db.Column(db.String(100), nullable=False)
+    remetente_endereco = db.Column(db.Text, nullable=False)
+    remetente_cidade = db.Column(db.String(100), nullable=False)
+    cidade_origem_id = db.Column(db.Integer, db.ForeignKey('cidade.id'))
+    destinatario_nome = db.Column(db.String(100), nullable=False)
+    destinatario_endereco = db.Column(db.Text, nullable=False)
+    destinatario_cidade = db.Column(db.String(100), nullable=False)
+    cidade_destino_id = db.Column(db.Integer, db.ForeignKey('cidade.id'))
+    tipo_produto = db.Column(db.String(50), nullable=False)
+    peso = db.Column(db.Float)
+    valor_declarado = db.Column(db.Float)
+    observacoes = db.Column(db.Text)
+    rota_id = db.Column(db.Integer)
+    status = db.Column(db.String(20))
+    data_criacao = db.Column(db.DateTime, index=True)
+    data_atualizacao = db.Column(db.DateTime)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
+    data_arquivamento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# Colunas copiadas da entrega para o arquivo
+COLUNAS_ARQUIVADAS = [coluna.key for coluna in EntregaArquivada.__table__.columns if coluna.key != 'data_arquivamento']
+
+SERIALIZADOR_RASTREIO_ARQUIVO = Serializador([
+    ('codigo', EntregaArquivada.codigo_rastreamento),
+    ('status', EntregaArquivada.status),
+    ('destinatario', EntregaArquivada.destinatario_nome),
+    ('cidade_destino', EntregaArquivada.destinatario_cidade),
+    ('data_criacao', EntregaArquivada.data_criacao)
+], conversores={'data_criacao': formato_data_br})
+
+def arquivar_entregas(dias=None, lote=LOTE_ARQUIVAMENTO, limite_lotes=None):
+    """Move as entregas encerradas há mais de `dias` para o arquivo, em lotes.
+    
+    Cada lote é uma transação curta (copiar, excluir, confirmar) sobre no
+    máximo `lote` linhas, localizadas pela faixa do índice (status,
+    data_atualizacao), para não bloquear as demais escritas. Retorna o
+    número de entregas arquivadas.
+    """
+    corte = datetime.utcnow() - timedelta(days=RETENCAO_DIAS if dias is None else dias)
+    arquivadas = 0
+    lotes = 0
+    pendentes = list(STATUS_ARQUIVAVEIS)
+    while pendentes and (limite_lotes is None or lotes < limite_lotes):
+        # Um status por vez: a consulta é uma faixa do índice, sem ordenação. As
+        # linhas ficam travadas até o commit (PostgreSQL); as que outra transação
+        # está alterando ficam para o próximo lote.
+        ids = db.session.scalars(
+            db.select(Entrega.id).where(Entrega.status == pendentes[0], Entrega.data_atualizacao < corte)
+            .limit(lote).with_for_update(skip_locked=True)
+        ).all()
+        if len(ids) < lote:
+            pendentes.pop(0)
+        if not ids:
+            db.session.rollback()
+            continue
+        
+        # O critério é repetido na cópia e nas exclusões: uma entrega alterada
+        # depois da leitura dos ids não é arquivada
+        arquivavel = and_(Entrega.id.in_(ids), Entrega.status.in_(STATUS_ARQUIVAVEIS), Entrega.data_atualizacao < corte)
+        agora = datetime.utcnow()
+        db.session.execute(db.insert(EntregaArquivada).from_select(
+            COLUNAS_ARQUIVADAS + ['data_arquivamento'],
+            db.select(*(getattr(Entrega, coluna) for coluna in COLUNAS_ARQUIVADAS), literal(agora, db.DateTime))
+            .where(arquivavel)
+        ))
+        db.session.execute(db.delete(AlertaSla).where(AlertaSla.entrega_id.in_(db.select(Entrega.id).where(arquivavel))))
+        resultado = db.session.execute(
+            db.delete(Entrega).where(arquivavel).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        arquivadas += resultado.rowcount
+        lotes += 1
+    return arquivadas
+
+@app.cli.command('arquivar-entregas')
+@click.option('--dias', type=int, default=None, help='Idade mínima, em dias desde a última atualização (padrão: RETENCAO_DIAS)')
+@click.option('--lote', type=int, default=LOTE_ARQUIVAMENTO, help='Entregas por transação')
+def comando_arquivar_entregas(dias, lote):
+    """Move entregas encerradas antigas para o arquivo"""
+    inicio = time.perf_counter()
+    total = arquivar_entregas(dias, lote)
+    print(f"✅ {total} entregas arquivadas em {time.perf_counter() - inicio:.2f}s")
+
 
 # ============================================================================
 # MELHORIAS DE SEGURANÇA
@@ -1153,3 +3432,7 @@ def validate_login_input(username, password):
 # ============================================================================
 # FIM DAS MELHORIAS DE SEGURANÇA
 # ============================================================================
+
+# Inicializar banco sempre que a aplicação for carregada (após a definição de todos os modelos)
+with app.app_context():
+    init_db()
@@ -0,0 +1,57 @@
+"""
+Normalização de nomes de cidades
+
+Interpreta os formatos livres usados no sistema ('São Paulo/SP',
+'São Paulo - SP', 'São Paulo') e gera as chaves sem acentos usadas para
+agrupar cidades e para o autocompletar por prefixo.
+"""
+
+import re
+import unicodedata
+
+UFS = {
+    'AC', 'AL', 'AP', 'AM', 'BA', 'CE', 'DF', 'ES', 'GO', 'MA', 'MT', 'MS', 'MG', 'PA',
+    'PB', 'PR', 'PE', 'PI', 'RJ', 'RN', 'RS', 'RO', 'RR', 'SC', 'SP', 'SE', 'TO'
+}
+
+# "Nome/UF", "Nome - UF", "Nome, UF" ou "Nome (UF)"
+_PADRAO_UF = re.compile(r'^(?P<nome>.+?)\s*(?:/|-|,|\()\s*(?P<uf>[A-Za-z]{2})\)?\s*$')
+
+
+def dobrar(texto):
+    """Minúsculas, sem acentos e com espaços simples: 'São  Paulo' -> 'sao paulo'"""
+    decomposto = unicodedata.normalize('NFKD', texto or '')
+    sem_acentos = ''.join(c for c in decomposto if not unicodedata.combining(c))
+    return ' '.join(sem_acentos.lower().split())
+
+
+def interpretar_cidade(texto):
+    """Separa nome e UF de um texto livre. Retorna (nome, uf) com uf None se ausente"""
+    texto = ' '.join((texto or '').split())
+    m = _PADRAO_UF.match(texto)
+    if m and m.group('uf').upper() in UFS:
+        return m.group('nome').strip(), m.group('uf').upper()
+    return texto, None
+
+
+def chave_cidade(nome, uf=None):
+    """Chave única da cidade: nome dobrado, seguido da UF quando conhecida"""
+    nome_chave = dobrar(nome)
+    return f'{nome_chave}/{uf.lower()}' if uf else nome_chave
+
+
+def rotulo_cidade(nome, uf=None):
+    """Nome de exibição canônico: 'São Paulo/SP'"""
+    return f'{nome}/{uf}' if uf else nome
+
+
+def intervalo_prefixo(prefixo):
+    """Limites [inicio, fim) que cobrem todas as chaves começando com o prefixo.
+
+    Uma comparação por intervalo usa o índice da coluna em qualquer banco, ao
+    contrário de LIKE, que depende de collation no SQLite e no PostgreSQL.
+    """
+    inicio = dobrar(prefixo)
+    if not inicio:
+        return None
+    return inicio, inicio[:-1] + chr(ord(inicio[-1]) + 1)
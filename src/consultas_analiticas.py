@@ -0,0 +1,657 @@
+"""
+Consultas analíticas sobre as entregas
+
+Agregações usadas nos relatórios, escritas com SQLAlchemy Core para rodar
+tanto no SQLite local quanto no PostgreSQL de produção. Contagens e
+agrupamentos são feitos pelo banco; só as estatísticas que exigem todos os
+valores (mediana e desvio padrão do tempo de processamento) leem as linhas,
+em lotes e com tipos compactos. Não depende do Flask, então pode ser usado
+por scripts e pela aplicação.
+"""
+
+import json
+import math
+import os
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import (BigInteger, Date, DateTime, Float, Integer, String, and_, case, column, create_engine, func,
+                        literal, or_, select, table, union_all)
+from sqlalchemy.engine import Engine
+
+try:
+    from .esboco_quantis import EsbocoQuantis
+except ImportError:
+    from esboco_quantis import EsbocoQuantis
+
+TAMANHO_LOTE = 200_000
+
+# Margem na releitura incremental para alterações gravadas por transações que
+# começaram antes da última leitura
+FOLGA_MARCA = timedelta(seconds=60)
+
+# Dias de criação relidos por consulta na atualização do estado
+DIAS_POR_LOTE = 100
+
+# Versão do formato do estado salvo; estados de outra versão são reconstruídos
+VERSAO_ESTADO = 2
+
+# Dia das entregas sem data de criação, no lugar do número do dia
+DIA_NULO = np.iinfo(np.int64).min
+
+# Esboço de referência para os índices dos baldes dos tempos de processamento
+ESBOCO = EsbocoQuantis()
+VALOR_MINIMO_ESBOCO = 1 / 60  # Mesmo limite do balde zero do esboço
+
+# Mesma numeração no SQLite (%w) e no PostgreSQL (DOW): 0 = domingo
+DIAS_SEMANA = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+COLUNAS_ENTREGA = (
+    ('id', Integer),
+    ('codigo_rastreamento', String),
+    ('remetente_cidade', String),
+    ('destinatario_cidade', String),
+    ('cidade_origem_id', Integer),
+    ('cidade_destino_id', Integer),
+    ('rota_id', Integer),
+    ('tipo_produto', String),
+    ('peso', Float),
+    ('valor_declarado', Float),
+    ('status', String),
+    ('data_criacao', DateTime),
+    ('data_atualizacao', DateTime),
+)
+
+
+def _tabela_entregas(nome):
+    return table(nome, *(column(coluna, tipo) for coluna, tipo in COLUNAS_ENTREGA))
+
+
+# Entregas ativas e arquivadas: o arquivamento move as linhas sem alterá-las,
+# então as análises cobrem todo o histórico, como os resumos diários
+ENTREGA = union_all(
+    select(_tabela_entregas('entrega')),
+    select(_tabela_entregas('entrega_arquivada')),
+).subquery('entregas')
+
+CIDADE = table('cidade', column('id', Integer), column('nome', String), column('uf', String))
+
+
+def url_banco(url=None):
+    """URL do banco: a informada, a de DATABASE_URL ou o SQLite local da aplicação"""
+    url = url or os.environ.get('DATABASE_URL')
+    if not url:
+        caminho = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'expresso_itaporanga.db')
+        return f'sqlite:///{caminho}'
+    if url.startswith('postgres://'):
+        url = url.replace('postgres://', 'postgresql://', 1)
+    return url
+
+
+def mes(coluna, dialeto):
+    """Expressão 'AAAA-MM' de uma data"""
+    if dialeto == 'postgresql':
+        return func.to_char(coluna, 'YYYY-MM')
+    return func.strftime('%Y-%m', coluna)
+
+
+def dia_semana(coluna, dialeto):
+    """Expressão do dia da semana (0 = domingo)"""
+    if dialeto == 'postgresql':
+        return func.extract('dow', coluna).cast(Integer)
+    return func.strftime('%w', coluna).cast(Integer)
+
+
+def horas_entre(fim, inicio, dialeto):
+    """Expressão da diferença em horas entre duas datas"""
+    if dialeto == 'postgresql':
+        return func.extract('epoch', fim - inicio) / 3600.0
+    return (func.julianday(fim) - func.julianday(inicio)) * 24.0
+
+
+def segundos_epoca(coluna, dialeto):
+    """Expressão dos segundos desde 1970-01-01 de uma data (sem fuso)"""
+    if dialeto == 'postgresql':
+        return func.extract('epoch', coluna).cast(BigInteger)
+    return func.strftime('%s', coluna).cast(BigInteger)
+
+
+def rotulo_cidade(alias, texto):
+    """Nome canônico 'Cidade/UF' da cidade ou, sem normalização, o texto original"""
+    return func.coalesce(alias.c.nome + literal('/') + alias.c.uf, alias.c.nome, texto)
+
+
+class ConsultasAnaliticas:
+    """Agregações das entregas sobre um Engine ou uma Connection do SQLAlchemy"""
+
+    def __init__(self, banco, tamanho_lote=TAMANHO_LOTE):
+        self.banco = banco
+        self.tamanho_lote = tamanho_lote
+        self.dialeto = banco.dialect.name
+
+    def _executar(self, consulta):
+        if isinstance(self.banco, Engine):
+            with self.banco.connect() as conexao:
+                return conexao.execute(consulta).all()
+        return self.banco.execute(consulta).all()
+
+    def _contagem(self, chave, ordenar_por_chave=False):
+        total = func.count().label('total')
+        consulta = select(chave.label('chave'), total).group_by(chave)
+        consulta = consulta.order_by(chave) if ordenar_por_chave else consulta.order_by(total.desc(), chave)
+        linhas = self._executar(consulta)
+        return pd.Series([t for _, t in linhas], index=[c for c, _ in linhas], dtype='int64')
+
+    def contagem_status(self):
+        return self._contagem(ENTREGA.c.status)
+
+    def contagem_produtos(self):
+        return self._contagem(ENTREGA.c.tipo_produto)
+
+    def com_cidades(self):
+        """Junção das entregas com as cidades e os rótulos de origem e destino"""
+        origem = CIDADE.alias('co')
+        destino = CIDADE.alias('cd')
+        juncao = (
+            ENTREGA
+            .outerjoin(origem, origem.c.id == ENTREGA.c.cidade_origem_id)
+            .outerjoin(destino, destino.c.id == ENTREGA.c.cidade_destino_id)
+        )
+        return (juncao, rotulo_cidade(origem, ENTREGA.c.remetente_cidade),
+                rotulo_cidade(destino, ENTREGA.c.destinatario_cidade))
+
+    def contagem_rotas(self, limite=None):
+        """Entregas por par origem → destino, das rotas mais usadas para as menos usadas"""
+        juncao, rotulo_origem, rotulo_destino = self.com_cidades()
+        total = func.count().label('total')
+
+        consulta = (
+            select(rotulo_origem, rotulo_destino, total)
+            .select_from(juncao)
+            .group_by(rotulo_origem, rotulo_destino)
+            .order_by(total.desc(), rotulo_origem, rotulo_destino)
+        )
+        if limite:
+            consulta = consulta.limit(limite)
+        linhas = self._executar(consulta)
+        return pd.Series([t for _, _, t in linhas], index=[f'{o} → {d}' for o, d, _ in linhas], dtype='int64')
+
+    def por_dia_semana(self):
+        contagem = self._contagem(dia_semana(ENTREGA.c.data_criacao, self.dialeto))
+        contagem.index = [DIAS_SEMANA[int(dia)] for dia in contagem.index]
+        return contagem
+
+    def por_mes(self):
+        return self._contagem(mes(ENTREGA.c.data_criacao, self.dialeto), ordenar_por_chave=True)
+
+    def indicadores(self):
+        """Totais gerais em uma única consulta"""
+        e = ENTREGA.c
+        linha = self._executar(select(
+            func.count().label('total'),
+            func.sum(case((e.status == 'entregue', 1), else_=0)).label('entregues'),
+            func.sum(e.valor_declarado).label('valor_total'),
+            func.sum(e.peso).label('peso_total'),
+            func.avg(horas_entre(e.data_atualizacao, e.data_criacao, self.dialeto)).label('tempo_medio'),
+            func.min(e.data_criacao).label('inicio'),
+            func.max(e.data_criacao).label('fim'),
+        ))[0]
+        return {
+            'total': linha.total,
+            'entregues': linha.entregues or 0,
+            'valor_total': float(linha.valor_total or 0),
+            'peso_total': float(linha.peso_total or 0),
+            'tempo_medio': float(linha.tempo_medio) if linha.tempo_medio is not None else float('nan'),
+            'inicio': pd.to_datetime(linha.inicio) if linha.inicio is not None else None,
+            'fim': pd.to_datetime(linha.fim) if linha.fim is not None else None,
+        }
+
+    def valor_peso(self):
+        """Médias e totais de valor e peso das entregas com ambos preenchidos, e valor por produto"""
+        e = ENTREGA.c
+        completos = (e.valor_declarado.isnot(None), e.peso.isnot(None))
+        geral = self._executar(select(
+            func.count(), func.avg(e.valor_declarado), func.sum(e.valor_declarado), func.avg(e.peso), func.sum(e.peso)
+        ).where(*completos))[0]
+
+        linhas = self._executar(
+            select(e.tipo_produto, func.avg(e.valor_declarado), func.sum(e.valor_declarado), func.count())
+            .where(*completos).group_by(e.tipo_produto).order_by(e.tipo_produto)
+        )
+        por_produto = pd.DataFrame(
+            [(m, s, c) for _, m, s, c in linhas], index=[p for p, _, _, _ in linhas], columns=['mean', 'sum', 'count']
+        ).round(2)
+        por_produto.index.name = 'tipo_produto'
+
+        return {
+            'total': geral[0],
+            'valor_medio': geral[1],
+            'valor_total': geral[2],
+            'peso_medio': geral[3],
+            'peso_total': geral[4],
+            'por_produto': por_produto,
+        }
+
+    def ler_em_lotes(self, consulta, dtype):
+        """Itera sobre DataFrames de até `tamanho_lote` linhas com os tipos de `dtype`.
+
+        Os lotes vêm de `partitions` do SQLAlchemy (com stream_results o
+        driver do PostgreSQL usa cursor no servidor), então o resultado
+        nunca fica inteiro em memória.
+        """
+        def lotes(conexao):
+            resultado = conexao.execution_options(stream_results=True, yield_per=self.tamanho_lote).execute(consulta)
+            nomes = list(resultado.keys())
+            for linhas in resultado.partitions():
+                yield pd.DataFrame.from_records(linhas, columns=nomes).astype(dtype)
+
+        if isinstance(self.banco, Engine):
+            with self.banco.connect() as conexao:
+                yield from lotes(conexao)
+        else:
+            yield from lotes(self.banco)
+
+    def tempo_por_status(self):
+        """Estatísticas do tempo de processamento (horas) por status.
+
+        A mediana precisa de todos os valores: eles são lidos em lotes com
+        apenas duas colunas (status categórico e tempo em float32).
+        """
+        e = ENTREGA.c
+        consulta = select(
+            e.status, horas_entre(e.data_atualizacao, e.data_criacao, self.dialeto).label('tempo')
+        ).where(e.data_atualizacao.isnot(None), e.data_criacao.isnot(None))
+
+        valores = {}
+        for lote in self.ler_em_lotes(consulta, dtype={'status': 'category', 'tempo': 'float32'}):
+            for status, grupo in lote.groupby('status', observed=True)['tempo']:
+                valores.setdefault(status, []).append(grupo.to_numpy())
+
+        return _tabela_tempos(valores)
+
+    def dias_alterados(self, desde):
+        """Dias de criação (date; None para entregas sem data) com entregas alteradas a partir de `desde`"""
+        e = ENTREGA.c
+        dia = func.date(e.data_criacao, type_=Date)
+        return [d for d, in self._executar(select(dia).where(e.data_atualizacao >= desde).distinct())]
+
+    def linhas_dos_dias(self, dias=None):
+        """Lotes com todas as entregas criadas nos `dias` (todas, se None), nas
+        colunas usadas pelo `EstadoAnalitico`"""
+        e = ENTREGA.c
+        juncao, rotulo_origem, rotulo_destino = self.com_cidades()
+        consulta = select(
+            e.status, e.tipo_produto,
+            (rotulo_origem + literal(' → ') + rotulo_destino).label('rota'),
+            segundos_epoca(e.data_criacao, self.dialeto).label('criacao'),
+            horas_entre(e.data_atualizacao, e.data_criacao, self.dialeto).label('tempo'),
+            e.valor_declarado.label('valor'), e.peso,
+        ).select_from(juncao)
+        dtype = {'criacao': 'float64', 'tempo': 'float64', 'valor': 'float64', 'peso': 'float64'}
+        if dias is None:
+            yield from self.ler_em_lotes(consulta, dtype)
+            return
+
+        dias = sorted(dias, key=lambda d: (d is not None, d))
+        for inicio in range(0, len(dias), DIAS_POR_LOTE):
+            condicoes = []
+            for d in dias[inicio:inicio + DIAS_POR_LOTE]:
+                if d is None:
+                    condicoes.append(e.data_criacao.is_(None))
+                else:
+                    # Intervalos de data_criacao usam o índice da coluna
+                    dia = datetime(d.year, d.month, d.day)
+                    condicoes.append(and_(e.data_criacao >= dia, e.data_criacao < dia + timedelta(days=1)))
+            yield from self.ler_em_lotes(consulta.where(or_(*condicoes)), dtype)
+
+
+def _tabela_tempos(valores):
+    """Estatísticas por status a partir de listas de arrays de tempos"""
+    estatisticas = {}
+    for status in sorted(valores):
+        tempos = np.concatenate(valores[status]).astype(np.float64)
+        estatisticas[status] = {
+            'mean': tempos.mean(),
+            'median': np.median(tempos),
+            'std': tempos.std(ddof=1) if len(tempos) > 1 else np.nan,
+            'min': tempos.min(),
+            'max': tempos.max(),
+        }
+    resultado = pd.DataFrame.from_dict(estatisticas, orient='index', columns=['mean', 'median', 'std', 'min', 'max'])
+    resultado.index.name = 'status'
+    return resultado.round(2)
+
+
+def _codificar(valores, categorias):
+    """Códigos de `valores` em `categorias`, acrescentando as novas.
+
+    Valores nulos recebem o código da categoria None. Um Categorical é
+    convertido pelas suas categorias, sem percorrer os valores.
+    """
+    valores = pd.Categorical(valores)
+    conhecidas = set(categorias)
+    categorias.extend(c for c in valores.categories if c not in conhecidas)
+    if (valores.codes < 0).any() and None not in conhecidas:
+        categorias.append(None)
+    # O código -1 (nulo) do Categorical pega o último item do mapa: None
+    mapa = pd.Index(categorias, dtype=object).get_indexer([*valores.categories, None])
+    return mapa[valores.codes].astype(np.int32)
+
+
+class EstadoAnalitico:
+    """Agregados das entregas por dia de criação × status × produto × rota,
+    atualizados de forma incremental.
+
+    Cada célula guarda contagens, somas, mínimo e máximo (quantidade, valor,
+    peso, tempo de processamento e o seu quadrado); as medianas saem de um
+    esboço de quantis (EsbocoQuantis) por dia × status. `atualizar` recalcula
+    só os dias de criação com entregas alteradas desde a marca da última
+    leitura, relendo as entregas desses dias, como os resumos diários da
+    aplicação. O estado cresce com os dias e as combinações, não com o número
+    de entregas. Uma exclusão só é percebida quando outra entrega do mesmo dia
+    é alterada ou o estado é reconstruído.
+    """
+
+    CHAVES = ('dia', 'status', 'produto', 'rota')
+    # Coluna da célula -> função que combina lotes
+    AGREGADOS = {
+        'quantidade': 'sum', 'valor_soma': 'sum', 'peso_soma': 'sum',
+        'completos': 'sum', 'completos_valor': 'sum', 'completos_peso': 'sum',
+        'tempo_quantidade': 'sum', 'tempo_soma': 'sum', 'tempo_quadrados': 'sum',
+        'tempo_min': 'min', 'tempo_max': 'max', 'criacao_min': 'min', 'criacao_max': 'max',
+    }
+    CHAVES_ESBOCO = ('dia', 'status', 'indice')
+
+    def __init__(self):
+        self.celulas = self._vazio(self.CHAVES, self.AGREGADOS)
+        self.esbocos = self._vazio(self.CHAVES_ESBOCO, ['quantidade'], np.int64)
+        self.categorias = {'status': [], 'produtos': [], 'rotas': []}
+        self.marca = None
+
+    @staticmethod
+    def _vazio(chaves, valores, tipo=np.float64):
+        colunas = {nome: np.empty(0, dtype=np.int64 if nome in ('dia', 'indice') else np.int32) for nome in chaves}
+        colunas.update({nome: np.empty(0, dtype=tipo) for nome in valores})
+        return pd.DataFrame(colunas)
+
+    def __len__(self):
+        return int(self.celulas['quantidade'].sum())
+
+    def desde(self):
+        """Data a partir da qual as alterações devem ser procuradas (None: relê tudo)"""
+        return None if self.marca is None else self.marca - FOLGA_MARCA
+
+    def atualizar(self, consultas, marca=None):
+        """Recalcula os dias de criação com entregas alteradas desde a última leitura.
+
+        Retorna o número de entregas relidas.
+        """
+        marca = marca or datetime.utcnow()
+        dias = None if self.marca is None else consultas.dias_alterados(self.desde())
+        relidas = 0
+        if dias is None or dias:
+            # Cada lote é agregado ao chegar; só as células ficam em memória
+            partes = []
+            for lote in consultas.linhas_dos_dias(dias):
+                partes.append(self._agregar(lote))
+                relidas += len(lote)
+            self._substituir(None if dias is None else [_numero_dia(d) for d in dias], partes)
+        self.marca = marca
+        return relidas
+
+    def aplicar(self, linhas):
+        """Substitui os dias presentes em um DataFrame no formato de `linhas_dos_dias`
+        (com todas as entregas desses dias) pelos seus agregados"""
+        if not linhas.empty:
+            celulas, esbocos = self._agregar(linhas)
+            self._substituir(np.unique(celulas['dia']).tolist(), [(celulas, esbocos)])
+
+    def _agregar(self, linhas):
+        """Células e esboços de um lote de linhas"""
+        criacao = linhas['criacao'].to_numpy(np.float64)
+        tempo = linhas['tempo'].to_numpy(np.float64)
+        valor = linhas['valor'].to_numpy(np.float64)
+        peso = linhas['peso'].to_numpy(np.float64)
+        com_tempo = ~np.isnan(tempo)
+        completos = ~np.isnan(valor) & ~np.isnan(peso)
+        tempo_conhecido = np.where(com_tempo, tempo, 0.0)
+
+        df = pd.DataFrame({
+            'dia': np.where(np.isnan(criacao), DIA_NULO, np.floor(np.nan_to_num(criacao) / 86400)).astype(np.int64),
+            'status': _codificar(linhas['status'], self.categorias['status']),
+            'produto': _codificar(linhas['tipo_produto'], self.categorias['produtos']),
+            'rota': _codificar(linhas['rota'], self.categorias['rotas']),
+            'quantidade': 1.0,
+            'valor_soma': np.nan_to_num(valor),
+            'peso_soma': np.nan_to_num(peso),
+            'completos': completos.astype(np.float64),
+            'completos_valor': np.where(completos, valor, 0.0),
+            'completos_peso': np.where(completos, peso, 0.0),
+            'tempo_quantidade': com_tempo.astype(np.float64),
+            'tempo_soma': tempo_conhecido,
+            'tempo_quadrados': tempo_conhecido ** 2,
+            'tempo_min': np.where(com_tempo, tempo, np.inf),
+            'tempo_max': np.where(com_tempo, tempo, -np.inf),
+            'criacao_min': np.where(np.isnan(criacao), np.inf, criacao),
+            'criacao_max': np.where(np.isnan(criacao), -np.inf, criacao),
+        })
+        celulas = df.groupby(list(self.CHAVES), sort=False).agg(self.AGREGADOS).reset_index()
+
+        # Mesmos baldes de EsbocoQuantis.indice, calculados para o lote inteiro
+        tempos = tempo[com_tempo]
+        indices = np.where(tempos < VALOR_MINIMO_ESBOCO, ESBOCO.indice_zero,
+                           np.ceil(np.log(np.maximum(tempos, VALOR_MINIMO_ESBOCO)) / math.log(ESBOCO.gama)))
+        esbocos = pd.DataFrame({
+            'dia': df['dia'].to_numpy()[com_tempo],
+            'status': df['status'].to_numpy()[com_tempo],
+            'indice': indices.astype(np.int64),
+            'quantidade': 1,
+        }).groupby(list(self.CHAVES_ESBOCO), sort=False)['quantidade'].sum().reset_index()
+        return celulas, esbocos
+
+    def _substituir(self, dias, partes):
+        """Troca as células e esboços dos `dias` (todos, se None) pelos agregados dos lotes"""
+        celulas = [c for c, _ in partes]
+        esbocos = [e for _, e in partes]
+        if dias is not None:
+            celulas.insert(0, self.celulas[~self.celulas['dia'].isin(dias)])
+            esbocos.insert(0, self.esbocos[~self.esbocos['dia'].isin(dias)])
+        celulas = [c for c in celulas if len(c)] or [self._vazio(self.CHAVES, self.AGREGADOS)]
+        esbocos = [e for e in esbocos if len(e)] or [self._vazio(self.CHAVES_ESBOCO, ['quantidade'], np.int64)]
+        # Um dia pode vir em mais de um lote: as partes são combinadas de novo
+        self.celulas = pd.concat(celulas, ignore_index=True).groupby(
+            list(self.CHAVES), sort=False).agg(self.AGREGADOS).reset_index()
+        self.esbocos = pd.concat(esbocos, ignore_index=True).groupby(
+            list(self.CHAVES_ESBOCO), sort=False)['quantidade'].sum().reset_index()
+
+    def salvar(self, caminho):
+        """Grava o estado em um arquivo .npz (colunas das células e dos esboços, metadados em JSON)"""
+        metadados = {
+            'versao': VERSAO_ESTADO,
+            'marca': self.marca.isoformat() if self.marca else None,
+            'categorias': self.categorias,
+        }
+        colunas = {f'celulas_{nome}': self.celulas[nome].to_numpy() for nome in self.celulas.columns}
+        colunas.update({f'esbocos_{nome}': self.esbocos[nome].to_numpy() for nome in self.esbocos.columns})
+        temporario = f'{caminho}.tmp'
+        with open(temporario, 'wb') as arquivo:
+            np.savez(arquivo, metadados=np.array(json.dumps(metadados, ensure_ascii=False)), **colunas)
+        # Substituição atômica: uma execução interrompida não corrompe o estado anterior
+        os.replace(temporario, caminho)
+
+    @classmethod
+    def carregar(cls, caminho):
+        """Estado salvo em `caminho`; vazio se o arquivo não existir ou for de outra versão"""
+        estado = cls()
+        if not os.path.exists(caminho):
+            return estado
+        with np.load(caminho, allow_pickle=False) as arquivo:
+            metadados = json.loads(str(arquivo['metadados']))
+            if metadados.get('versao') != VERSAO_ESTADO:
+                return estado
+            estado.celulas = pd.DataFrame({nome: arquivo[f'celulas_{nome}'] for nome in estado.celulas.columns})
+            estado.esbocos = pd.DataFrame({nome: arquivo[f'esbocos_{nome}'] for nome in estado.esbocos.columns})
+        estado.categorias = metadados['categorias']
+        estado.marca = datetime.fromisoformat(metadados['marca']) if metadados['marca'] else None
+        return estado
+
+    # Análises, com a mesma interface de ConsultasAnaliticas
+
+    def _contagem(self, codigos, categorias, pesos, ordenar_por_chave=False):
+        contagens = np.bincount(codigos, weights=pesos, minlength=len(categorias))
+        pares = [(c, int(n)) for c, n in zip(categorias, contagens) if n and c is not None]
+        pares.sort(key=(lambda p: p[0]) if ordenar_por_chave else (lambda p: (-p[1], p[0])))
+        return pd.Series([n for _, n in pares], index=[c for c, _ in pares], dtype='int64')
+
+    def _por_coluna(self, coluna, categorias):
+        return self._contagem(self.celulas[coluna].to_numpy(), categorias, self.celulas['quantidade'].to_numpy())
+
+    def contagem_status(self):
+        return self._por_coluna('status', self.categorias['status'])
+
+    def contagem_produtos(self):
+        return self._por_coluna('produto', self.categorias['produtos'])
+
+    def contagem_rotas(self, limite=None):
+        contagem = self._por_coluna('rota', self.categorias['rotas'])
+        return contagem.head(limite) if limite else contagem
+
+    def _dias(self):
+        """Números dos dias com data e a quantidade de entregas de cada célula"""
+        com_data = self.celulas['dia'].to_numpy() != DIA_NULO
+        return self.celulas['dia'].to_numpy()[com_data], self.celulas['quantidade'].to_numpy()[com_data]
+
+    def por_dia_semana(self):
+        # 1970-01-01 foi uma quinta-feira (4, com 0 = domingo)
+        dias, quantidades = self._dias()
+        return self._contagem((dias + 4) % 7, DIAS_SEMANA, quantidades)
+
+    def por_mes(self):
+        dias, quantidades = self._dias()
+        if not len(dias):
+            return pd.Series(dtype='int64')
+        meses = dias.astype('datetime64[D]').astype('datetime64[M]')
+        primeiro = meses.min()
+        deslocamentos = (meses - primeiro).astype(np.int64)
+        rotulos = [str(primeiro + i) for i in range(int(deslocamentos.max()) + 1)]
+        return self._contagem(deslocamentos, rotulos, quantidades, ordenar_por_chave=True)
+
+    def indicadores(self):
+        c = self.celulas
+        entregue = self.categorias['status'].index('entregue') if 'entregue' in self.categorias['status'] else -1
+        tempos = c['tempo_quantidade'].sum()
+        inicio, fim = c['criacao_min'].min(), c['criacao_max'].max()
+        return {
+            'total': len(self),
+            'entregues': int(c.loc[c['status'] == entregue, 'quantidade'].sum()),
+            'valor_total': float(c['valor_soma'].sum()),
+            'peso_total': float(c['peso_soma'].sum()),
+            'tempo_medio': float(c['tempo_soma'].sum() / tempos) if tempos else float('nan'),
+            'inicio': pd.Timestamp(inicio, unit='s') if np.isfinite(inicio) else None,
+            'fim': pd.Timestamp(fim, unit='s') if np.isfinite(fim) else None,
+        }
+
+    def valor_peso(self):
+        c = self.celulas
+        produtos = c['produto'].to_numpy()
+        tamanho = len(self.categorias['produtos'])
+        quantidades = np.bincount(produtos, weights=c['completos'].to_numpy(), minlength=tamanho)
+        somas = np.bincount(produtos, weights=c['completos_valor'].to_numpy(), minlength=tamanho)
+        linhas = sorted((p, somas[i] / quantidades[i], somas[i], int(quantidades[i]))
+                        for i, p in enumerate(self.categorias['produtos']) if quantidades[i])
+        por_produto = pd.DataFrame(
+            [(m, s, c) for _, m, s, c in linhas], index=[p for p, _, _, _ in linhas], columns=['mean', 'sum', 'count']
+        ).round(2)
+        por_produto.index.name = 'tipo_produto'
+
+        total = int(c['completos'].sum())
+        valor, peso = c['completos_valor'].sum(), c['completos_peso'].sum()
+        return {
+            'total': total,
+            'valor_medio': valor / total if total else None,
+            'valor_total': valor if total else None,
+            'peso_medio': peso / total if total else None,
+            'peso_total': peso if total else None,
+            'por_produto': por_produto,
+        }
+
+    def tempo_por_status(self):
+        """Estatísticas do tempo por status; a mediana vem do esboço (valor de posição
+        inferior, com erro relativo de até 1%)"""
+        celulas = self.celulas.groupby('status').agg(
+            {'tempo_quantidade': 'sum', 'tempo_soma': 'sum', 'tempo_quadrados': 'sum',
+             'tempo_min': 'min', 'tempo_max': 'max'})
+        estatisticas = {}
+        for codigo, linha in celulas.iterrows():
+            nome = self.categorias['status'][codigo]
+            n = linha['tempo_quantidade']
+            if nome is None or not n:
+                continue
+            media = linha['tempo_soma'] / n
+            variancia = max(linha['tempo_quadrados'] - n * media ** 2, 0.0) / (n - 1) if n > 1 else np.nan
+            baldes = self.esbocos[self.esbocos['status'] == codigo]
+            esboco = EsbocoQuantis(zip(baldes['indice'].tolist(), baldes['quantidade'].tolist()))
+            estatisticas[nome] = {
+                'mean': media,
+                'median': esboco.quantil(0.5),
+                'std': math.sqrt(variancia) if n > 1 else np.nan,
+                'min': linha['tempo_min'],
+                'max': linha['tempo_max'],
+            }
+        resultado = pd.DataFrame.from_dict(estatisticas, orient='index', columns=['mean', 'median', 'std', 'min', 'max'])
+        resultado = resultado.sort_index()
+        resultado.index.name = 'status'
+        return resultado.round(2)
+
+
+def _numero_dia(dia):
+    """Número do dia desde 1970-01-01, como nas células do estado"""
+    return DIA_NULO if dia is None else (dia - date(1970, 1, 1)).days
+
+
+def _nativo(valor):
+    """Número do NumPy/pandas como tipo nativo do Python; NaN vira None"""
+    if hasattr(valor, 'item'):
+        valor = valor.item()
+    if isinstance(valor, float) and math.isnan(valor):
+        return None
+    return valor
+
+
+def _serie(contagem):
+    return {str(chave): _nativo(valor) for chave, valor in contagem.items()}
+
+
+def resumo(fonte, limite_rotas=5):
+    """Todas as análises de uma fonte (`ConsultasAnaliticas` ou `EstadoAnalitico`)
+    em um dicionário serializável, com as chaves do relatório de análise"""
+    indicadores = fonte.indicadores()
+    total = indicadores['total']
+    return {
+        'total_entregas': total,
+        'periodo': {
+            'inicio': indicadores['inicio'].isoformat() if indicadores['inicio'] is not None else None,
+            'fim': indicadores['fim'].isoformat() if indicadores['fim'] is not None else None,
+        },
+        'distribuicao_status': _serie(fonte.contagem_status()),
+        'distribuicao_produtos': _serie(fonte.contagem_produtos()),
+        'rotas_principais': _serie(fonte.contagem_rotas(limite_rotas)),
+        'entregas_por_dia_semana': _serie(fonte.por_dia_semana()),
+        'entregas_por_mes': _serie(fonte.por_mes()),
+        'tempo_processamento': {
+            str(status): {nome: _nativo(valor) for nome, valor in linha.items()}
+            for status, linha in fonte.tempo_por_status().iterrows()
+        },
+        'indicadores': {
+            'taxa_sucesso': indicadores['entregues'] / total * 100 if total else 0.0,
+            'tempo_medio_processamento': _nativo(indicadores['tempo_medio']),
+            'total_valor_declarado': indicadores['valor_total'],
+            'peso_total': indicadores['peso_total'],
+        },
+    }
+
+
+def conectar(url=None):
+    """Engine para a URL informada (ou a padrão, ver `url_banco`)"""
+    return create_engine(url_banco(url))
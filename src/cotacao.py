@@ -0,0 +1,137 @@
+"""
+Cotação de frete
+
+A tabela de frete é formada por faixas de peso × faixas de distância, um
+adicional percentual por tipo de produto e o ad valorem sobre o valor
+declarado. Ela é compilada uma vez em listas ordenadas (para cotações
+avulsas com bisect, sem NumPy) e em arrays (para cotações em lote com
+searchsorted, em uma única passada vetorizada).
+"""
+
+import json
+from bisect import bisect_left
+
+import numpy as np
+
+try:
+    from .cidades import dobrar
+except ImportError:
+    from cidades import dobrar
+
+# Limites superiores das faixas (inclusive). Acima da última faixa de peso o
+# excedente é cobrado por kg; acima da última faixa de distância vale o preço
+# da última faixa.
+TABELA_PADRAO = {
+    'faixas_peso': [1, 5, 10, 30, 50, 100],
+    'faixas_distancia': [300, 800, 1500, 2500, 3500],
+    'precos': [
+        [18.0, 24.0, 32.0, 41.0, 52.0],
+        [26.0, 35.0, 47.0, 60.0, 76.0],
+        [38.0, 51.0, 68.0, 88.0, 110.0],
+        [72.0, 97.0, 130.0, 168.0, 212.0],
+        [105.0, 141.0, 189.0, 245.0, 309.0],
+        [180.0, 242.0, 324.0, 420.0, 530.0],
+    ],
+    'excedente_kg': [1.4, 1.9, 2.6, 3.4, 4.3],
+    'adicional_produto': {
+        'Eletrônicos': 0.15,
+        'Frágil': 0.20,
+        'Medicamentos': 0.10,
+        'Documentos': 0.0,
+    },
+    'ad_valorem': 0.003,
+    'minimo': 20.0,
+}
+
+
+def _crescente(valores, nome):
+    if not valores or any(b <= a for a, b in zip(valores, valores[1:])):
+        raise ValueError(f'{nome} deve ser uma lista crescente não vazia')
+    return [float(v) for v in valores]
+
+
+class TabelaFrete:
+    """Tabela de frete compilada para consulta rápida"""
+
+    def __init__(self, dados=None):
+        dados = dados if dados is not None else TABELA_PADRAO
+        self.dados = dados
+
+        self.faixas_peso = _crescente(dados['faixas_peso'], 'faixas_peso')
+        self.faixas_distancia = _crescente(dados['faixas_distancia'], 'faixas_distancia')
+        self.precos = [[float(p) for p in linha] for linha in dados['precos']]
+        self.excedente_kg = [float(v) for v in dados['excedente_kg']]
+        if len(self.precos) != len(self.faixas_peso) or any(len(l) != len(self.faixas_distancia) for l in self.precos):
+            raise ValueError('precos deve ter uma linha por faixa de peso e uma coluna por faixa de distância')
+        if len(self.excedente_kg) != len(self.faixas_distancia):
+            raise ValueError('excedente_kg deve ter um valor por faixa de distância')
+
+        self.adicional_produto = {dobrar(k): float(v) for k, v in dados.get('adicional_produto', {}).items()}
+        self.ad_valorem = float(dados.get('ad_valorem', 0))
+        self.minimo = float(dados.get('minimo', 0))
+
+        self._array_peso = np.array(self.faixas_peso)
+        self._array_distancia = np.array(self.faixas_distancia)
+        self._array_precos = np.array(self.precos)
+        self._array_excedente = np.array(self.excedente_kg)
+
+    @classmethod
+    def de_json(cls, texto):
+        """Tabela a partir do JSON salvo nas configurações; ValueError se inválido"""
+        try:
+            return cls(json.loads(texto))
+        except (TypeError, KeyError, json.JSONDecodeError) as e:
+            raise ValueError(f'Tabela de frete inválida: {e}') from e
+
+    def adicional(self, tipo_produto):
+        return self.adicional_produto.get(dobrar(tipo_produto), 0.0)
+
+    def cotar(self, peso, distancia, valor_declarado=0.0, tipo_produto=None):
+        """Cotação avulsa com a composição do preço"""
+        peso = float(peso or 0)
+        valor_declarado = float(valor_declarado or 0)
+        if peso < 0 or distancia < 0 or valor_declarado < 0:
+            raise ValueError('Peso, distância e valor declarado não podem ser negativos')
+
+        coluna = min(bisect_left(self.faixas_distancia, distancia), len(self.faixas_distancia) - 1)
+        linha = bisect_left(self.faixas_peso, peso)
+        if linha < len(self.faixas_peso):
+            frete_peso = self.precos[linha][coluna]
+        else:
+            linha = len(self.faixas_peso) - 1
+            frete_peso = self.precos[linha][coluna] + (peso - self.faixas_peso[-1]) * self.excedente_kg[coluna]
+
+        adicional = frete_peso * self.adicional(tipo_produto)
+        ad_valorem = valor_declarado * self.ad_valorem
+        return {
+            'faixa_peso': linha,
+            'faixa_distancia': coluna,
+            'frete_peso': round(frete_peso, 2),
+            'adicional_produto': round(adicional, 2),
+            'ad_valorem': round(ad_valorem, 2),
+            'total': round(max(frete_peso + adicional + ad_valorem, self.minimo), 2)
+        }
+
+    def cotar_lote(self, pesos, distancias, valores, tipos):
+        """Totais de um lote inteiro em uma passada vetorizada"""
+        pesos = np.nan_to_num(np.asarray(pesos, dtype=float))
+        distancias = np.asarray(distancias, dtype=float)
+        valores = np.nan_to_num(np.asarray(valores, dtype=float))
+        if (pesos < 0).any() or (distancias < 0).any() or (valores < 0).any():
+            raise ValueError('Peso, distância e valor declarado não podem ser negativos')
+
+        colunas = np.minimum(np.searchsorted(self._array_distancia, distancias, side='left'),
+                             len(self.faixas_distancia) - 1)
+        linhas = np.searchsorted(self._array_peso, pesos, side='left')
+        excedente = linhas >= len(self.faixas_peso)
+        linhas = np.minimum(linhas, len(self.faixas_peso) - 1)
+
+        frete_peso = self._array_precos[linhas, colunas]
+        frete_peso += np.where(excedente, (pesos - self.faixas_peso[-1]) * self._array_excedente[colunas], 0.0)
+
+        # Tipos repetidos são dobrados uma vez só
+        tipos_unicos, inverso = np.unique(np.asarray([t or '' for t in tipos], dtype=object), return_inverse=True)
+        adicionais = np.array([self.adicional(t) for t in tipos_unicos])[inverso.reshape(-1)]
+
+        total = frete_peso + frete_peso * adicionais + valores * self.ad_valorem
+        return np.round(np.maximum(total, self.minimo), 2)
@@ -0,0 +1,82 @@
+"""
+Esboço de quantis (DDSketch)
+
+Uma distribuição de tempos é guardada como contagens em baldes
+logarítmicos: o valor x cai no balde ceil(log_γ x), com
+γ = (1 + α) / (1 - α), e qualquer quantil estimado tem erro relativo de no
+máximo α. Como o esboço é só uma contagem por balde, esboços de dias, rotas
+ou processos diferentes se combinam somando as contagens, inclusive no
+banco (SUM ... GROUP BY indice). O número de baldes depende da faixa de
+valores, não da quantidade de observações.
+"""
+
+import math
+
+# Erro relativo máximo dos quantis estimados
+PRECISAO_RELATIVA = 0.01
+
+# Valores abaixo deste (menos de um minuto, em horas) contam no balde zero
+VALOR_MINIMO = 1 / 60
+
+QUANTIS_PADRAO = (0.5, 0.9, 0.99)
+
+
+def rotulo_quantil(q):
+    """Nome do quantil: 0.5 -> 'p50', 0.999 -> 'p99.9'"""
+    return f'p{q * 100:g}'
+
+
+class EsbocoQuantis:
+    """Contagens por balde logarítmico de uma distribuição de valores não negativos"""
+
+    def __init__(self, contagens=(), precisao=PRECISAO_RELATIVA):
+        self.precisao = precisao
+        self.gama = (1 + precisao) / (1 - precisao)
+        self._log_gama = math.log(self.gama)
+        self.indice_zero = math.ceil(math.log(VALOR_MINIMO) / self._log_gama) - 1
+        self.contagens = {}
+        for indice, quantidade in contagens:
+            self.contagens[indice] = self.contagens.get(indice, 0) + quantidade
+
+    def __len__(self):
+        return sum(self.contagens.values())
+
+    def indice(self, valor):
+        if valor < VALOR_MINIMO:
+            return self.indice_zero
+        return math.ceil(math.log(valor) / self._log_gama)
+
+    def valor(self, indice):
+        """Representante do balde, com erro relativo de no máximo `precisao`"""
+        if indice == self.indice_zero:
+            return 0.0
+        return 2 * self.gama ** indice / (self.gama + 1)
+
+    def adicionar(self, valor, quantidade=1):
+        indice = self.indice(valor)
+        self.contagens[indice] = self.contagens.get(indice, 0) + quantidade
+
+    def mesclar(self, outro):
+        if outro.precisao != self.precisao:
+            raise ValueError('Esboços com precisões diferentes não podem ser combinados')
+        for indice, quantidade in outro.contagens.items():
+            self.contagens[indice] = self.contagens.get(indice, 0) + quantidade
+        return self
+
+    def quantil(self, q):
+        """Valor estimado do quantil `q` (0 a 1); None se o esboço estiver vazio"""
+        if not 0 <= q <= 1:
+            raise ValueError('O quantil deve estar entre 0 e 1')
+        total = len(self)
+        if not total:
+            return None
+        posicao = q * (total - 1)
+        acumulado = 0
+        for indice in sorted(self.contagens):
+            acumulado += self.contagens[indice]
+            if acumulado > posicao:
+                return self.valor(indice)
+        return self.valor(max(self.contagens))
+
+    def quantis(self, quantis=QUANTIS_PADRAO):
+        return {rotulo_quantil(q): self.quantil(q) for q in quantis}
@@ -0,0 +1,173 @@
+"""
+Grafo de rotas
+
+Mantém em memória o grafo dirigido formado pelas rotas ativas (cidade de
+origem -> cidade de destino) e responde consultas de menor caminho por
+distância ou por tempo, com vários trechos. Os resultados de Dijkstra são
+memorizados por cidade de origem e só são descartados quando uma alteração
+no grafo pode de fato mudá-los.
+"""
+
+import heapq
+import re
+from collections import namedtuple
+
+CRITERIOS = ('distancia', 'tempo')
+
+Trecho = namedtuple('Trecho', 'rota_id nome origem_id destino_id origem destino distancia horas tempo_estimado')
+
+# "36h", "2 dias", "1d 4h", "2h30", "90 min"
+_PADRAO_DURACAO = re.compile(r'(\d+(?:[.,]\d+)?)\s*(dias?|d|horas?|hrs?|h|minutos?|min|m)?', re.IGNORECASE)
+_HORAS_POR_UNIDADE = {'d': 24.0, 'h': 1.0, 'm': 1 / 60}
+
+
+def interpretar_duracao(texto):
+    """Converte o texto livre de `tempo_estimado` em horas. Retorna None se não reconhecido"""
+    total = None
+    unidade_anterior = None
+    for numero, unidade in _PADRAO_DURACAO.findall(texto or ''):
+        valor = float(numero.replace(',', '.'))
+        if unidade:
+            unidade = unidade[0].lower()
+        else:
+            # Número solto após horas ("2h30") são minutos; sozinho, são horas
+            unidade = 'm' if unidade_anterior == 'h' else 'h'
+        total = (total or 0.0) + valor * _HORAS_POR_UNIDADE[unidade]
+        unidade_anterior = unidade
+    return total
+
+
+class Caminho:
+    """Resultado de uma consulta: trechos em ordem e totais acumulados"""
+
+    def __init__(self, trechos):
+        self.trechos = trechos
+        self.distancia = sum(t.distancia for t in trechos)
+        horas = [t.horas for t in trechos]
+        self.horas = None if None in horas else sum(horas)
+
+
+class GrafoRotas:
+    """Grafo dirigido de rotas com menores caminhos memorizados.
+
+    Os vértices são ids de cidade e cada rota é uma aresta identificada pelo
+    seu id, então há espaço para várias rotas entre o mesmo par de cidades.
+    """
+
+    def __init__(self, trechos=()):
+        # Incrementada a cada alteração, para quem guarda resultados derivados do grafo
+        self.revisao = 0
+        self._trechos = {}
+        self._saidas = {}
+        self._memo = {}
+        for trecho in trechos:
+            self.adicionar(trecho)
+
+    def copia(self):
+        """Grafo independente com as mesmas arestas e resultados memorizados.
+
+        Os trechos e as árvores memorizadas nunca são alterados depois de
+        criados, então só os dicionários que os guardam são copiados.
+        """
+        novo = GrafoRotas()
+        novo.revisao = self.revisao
+        novo._trechos = dict(self._trechos)
+        novo._saidas = {origem: dict(saidas) for origem, saidas in self._saidas.items()}
+        novo._memo = dict(self._memo)
+        return novo
+
+    def __len__(self):
+        return len(self._trechos)
+
+    def __contains__(self, rota_id):
+        return rota_id in self._trechos
+
+    @staticmethod
+    def _peso(trecho, criterio):
+        return trecho.distancia if criterio == 'distancia' else trecho.horas
+
+    def adicionar(self, trecho):
+        """Inclui (ou substitui) a aresta de uma rota"""
+        if trecho.rota_id in self._trechos:
+            self.remover(trecho.rota_id)
+        self._trechos[trecho.rota_id] = trecho
+        self.revisao += 1
+        self._saidas.setdefault(trecho.origem_id, {})[trecho.rota_id] = trecho
+
+        # Uma aresta nova só invalida as árvores em que ela encurta algum caminho
+        for chave, (distancias, _) in list(self._memo.items()):
+            peso = self._peso(trecho, chave[1])
+            if peso is None or trecho.origem_id not in distancias:
+                continue
+            if distancias[trecho.origem_id] + peso < distancias.get(trecho.destino_id, float('inf')):
+                del self._memo[chave]
+
+    def remover(self, rota_id):
+        """Retira a aresta de uma rota, se existir"""
+        trecho = self._trechos.pop(rota_id, None)
+        if trecho is None:
+            return
+        self.revisao += 1
+        saidas = self._saidas.get(trecho.origem_id, {})
+        saidas.pop(rota_id, None)
+        if not saidas:
+            self._saidas.pop(trecho.origem_id, None)
+
+        # Só as árvores que usavam a aresta ficam desatualizadas
+        for chave, (_, anteriores) in list(self._memo.items()):
+            if anteriores.get(trecho.destino_id) is trecho:
+                del self._memo[chave]
+
+    def _arvore(self, origem, criterio):
+        """Dijkstra a partir de `origem`: distâncias e o trecho que chega em cada cidade"""
+        chave = (origem, criterio)
+        if chave in self._memo:
+            return self._memo[chave]
+
+        distancias = {origem: 0.0}
+        anteriores = {}
+        fila = [(0.0, origem)]
+        while fila:
+            custo, cidade = heapq.heappop(fila)
+            if custo > distancias[cidade]:
+                continue
+            for trecho in self._saidas.get(cidade, {}).values():
+                peso = self._peso(trecho, criterio)
+                if peso is None:
+                    continue
+                novo = custo + peso
+                if novo < distancias.get(trecho.destino_id, float('inf')):
+                    distancias[trecho.destino_id] = novo
+                    anteriores[trecho.destino_id] = trecho
+                    heapq.heappush(fila, (novo, trecho.destino_id))
+
+        self._memo[chave] = (distancias, anteriores)
+        return self._memo[chave]
+
+    def caminho(self, origem, destino, criterio='distancia'):
+        """Menor caminho entre duas cidades, ou None se não houver"""
+        if criterio not in CRITERIOS:
+            raise ValueError(f'Critério inválido: {criterio}')
+
+        distancias, anteriores = self._arvore(origem, criterio)
+        if destino not in distancias:
+            return None
+
+        trechos = []
+        cidade = destino
+        while cidade != origem:
+            trecho = anteriores[cidade]
+            trechos.append(trecho)
+            cidade = trecho.origem_id
+        trechos.reverse()
+        return Caminho(trechos)
+
+    def proxima_rota(self, origem, destino):
+        """Id da rota do primeiro trecho do menor caminho (por distância), ou None"""
+        caminho = self.caminho(origem, destino)
+        return caminho.trechos[0].rota_id if caminho and caminho.trechos else None
+
+    def rota_direta(self, origem, destino):
+        """Rota ativa mais curta ligando diretamente as duas cidades, ou None"""
+        candidatos = [t for t in self._saidas.get(origem, {}).values() if t.destino_id == destino]
+        return min(candidatos, key=lambda t: t.distancia, default=None)
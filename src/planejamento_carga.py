@@ -0,0 +1,180 @@
+"""
+Planejamento de carga
+
+Distribui volumes (entregas) entre veículos com capacidade de peso e,
+opcionalmente, de valor declarado (limite do seguro da carga). Usa a
+heurística first-fit decreasing: os volumes são ordenados do mais pesado ao
+mais leve e cada um vai para o primeiro veículo com espaço. Uma árvore de
+segmentos com a capacidade restante dos veículos encontra esse primeiro
+veículo em O(log n), o que permite planejar dezenas de milhares de volumes
+em uma fração de segundo. Uma busca local opcional tenta esvaziar os
+veículos menos carregados redistribuindo seus volumes entre os demais.
+"""
+
+import math
+from collections import namedtuple
+
+Volume = namedtuple('Volume', 'id peso valor')
+
+# Tolerância para somas de pesos em ponto flutuante
+_EPSILON = 1e-9
+
+
+class _ArvoreCapacidade:
+    """Árvore de segmentos com o máximo da capacidade restante (peso e valor) por intervalo de veículos"""
+
+    def __init__(self, quantidade, peso, valor):
+        tamanho = 1
+        while tamanho < quantidade:
+            tamanho *= 2
+        self.tamanho = tamanho
+        self.peso = [-1.0] * (2 * tamanho)
+        self.valor = [-1.0] * (2 * tamanho)
+        self.peso[tamanho:tamanho + quantidade] = [peso] * quantidade
+        self.valor[tamanho:tamanho + quantidade] = [valor] * quantidade
+        for no in range(tamanho - 1, 0, -1):
+            self.peso[no] = max(self.peso[2 * no], self.peso[2 * no + 1])
+            self.valor[no] = max(self.valor[2 * no], self.valor[2 * no + 1])
+
+    def restante(self, indice):
+        no = self.tamanho + indice
+        return self.peso[no], self.valor[no]
+
+    def definir(self, indice, peso, valor):
+        no = self.tamanho + indice
+        self.peso[no] = peso
+        self.valor[no] = valor
+        no //= 2
+        while no:
+            self.peso[no] = max(self.peso[2 * no], self.peso[2 * no + 1])
+            self.valor[no] = max(self.valor[2 * no], self.valor[2 * no + 1])
+            no //= 2
+
+    def primeiro(self, peso, valor):
+        """Índice do primeiro veículo com espaço para o volume, ou -1"""
+        pesos, valores = self.peso, self.valor
+        peso -= _EPSILON
+        valor -= _EPSILON
+        # Só com peso a descida é direta; com os dois limites pode haver retrocesso
+        pilha = [1]
+        while pilha:
+            no = pilha.pop()
+            if pesos[no] < peso or valores[no] < valor:
+                continue
+            if no >= self.tamanho:
+                return no - self.tamanho
+            pilha.append(2 * no + 1)
+            pilha.append(2 * no)
+        return -1
+
+
+class PlanoCarga:
+    """Resultado do planejamento: volumes de cada veículo e os que não couberam"""
+
+    def __init__(self, veiculos, nao_alocados, capacidade_peso, capacidade_valor):
+        self.veiculos = veiculos
+        self.nao_alocados = nao_alocados
+        self.capacidade_peso = capacidade_peso
+        self.capacidade_valor = capacidade_valor
+
+    @property
+    def limite_inferior(self):
+        """Número mínimo teórico de veículos para os volumes alocados"""
+        limite = math.ceil(sum(v.peso for carga in self.veiculos for v in carga) / self.capacidade_peso - _EPSILON)
+        if self.capacidade_valor:
+            total_valor = sum(v.valor for carga in self.veiculos for v in carga)
+            limite = max(limite, math.ceil(total_valor / self.capacidade_valor - _EPSILON))
+        return limite
+
+    def resumo(self):
+        return [{
+            'volumes': [v.id for v in carga],
+            'peso': round(sum(v.peso for v in carga), 3),
+            'valor': round(sum(v.valor for v in carga), 2),
+            'ocupacao': round(sum(v.peso for v in carga) / self.capacidade_peso, 4)
+        } for carga in self.veiculos]
+
+
+def planejar(volumes, capacidade_peso, capacidade_valor=None, melhorar=False):
+    """Distribui os volumes entre veículos iguais.
+
+    `volumes` são objetos com id, peso e valor (peso/valor None contam como 0).
+    Volumes que sozinhos excedem a capacidade ficam em `nao_alocados`.
+    """
+    if capacidade_peso <= 0 or (capacidade_valor is not None and capacidade_valor <= 0):
+        raise ValueError('Capacidade do veículo deve ser positiva')
+
+    limite_valor = capacidade_valor if capacidade_valor is not None else math.inf
+    alocaveis = []
+    nao_alocados = []
+    for volume in volumes:
+        volume = Volume(volume.id, volume.peso or 0.0, volume.valor or 0.0)
+        if volume.peso > capacidade_peso + _EPSILON or volume.valor > limite_valor + _EPSILON:
+            nao_alocados.append(volume)
+        else:
+            alocaveis.append(volume)
+    alocaveis.sort(key=lambda v: (v.peso, v.valor), reverse=True)
+
+    # Cada volume cabe em um veículo vazio, então len(alocaveis) veículos bastam
+    arvore = _ArvoreCapacidade(max(len(alocaveis), 1), capacidade_peso, limite_valor)
+    cargas = []
+    for volume in alocaveis:
+        indice = arvore.primeiro(volume.peso, volume.valor)
+        if indice == len(cargas):
+            cargas.append([])
+        cargas[indice].append(volume)
+        peso, valor = arvore.restante(indice)
+        arvore.definir(indice, peso - volume.peso, valor - volume.valor)
+
+    if melhorar and len(cargas) > 1:
+        # Veículos ainda não abertos não podem receber volumes na busca local
+        for indice in range(len(cargas), arvore.tamanho):
+            if arvore.restante(indice)[0] >= 0:
+                arvore.definir(indice, -1.0, -1.0)
+        cargas = _esvaziar_veiculos(cargas, arvore)
+
+    return PlanoCarga([c for c in cargas if c], nao_alocados, capacidade_peso, capacidade_valor)
+
+
+def _esvaziar_veiculos(cargas, arvore):
+    """Busca local: tenta redistribuir todos os volumes de cada veículo, do menos
+    carregado ao mais carregado, entre os demais; se couberem, o veículo sai do plano"""
+    pesos = [sum(v.peso for v in carga) for carga in cargas]
+    valores = [sum(v.valor for v in carga) for carga in cargas]
+    livre_peso = sum(arvore.restante(i)[0] for i in range(len(cargas)))
+    livre_valor = sum(arvore.restante(i)[1] for i in range(len(cargas)))
+
+    for origem in sorted(range(len(cargas)), key=pesos.__getitem__):
+        carga = cargas[origem]
+        restante_origem = arvore.restante(origem)
+        # Sem espaço livre suficiente nos demais veículos a tentativa é inútil
+        if (pesos[origem] > livre_peso - restante_origem[0] + _EPSILON
+                or valores[origem] > livre_valor - restante_origem[1] + _EPSILON):
+            continue
+        arvore.definir(origem, -1.0, -1.0)
+
+        destinos = []
+        anteriores = {}
+        for volume in carga:
+            indice = arvore.primeiro(volume.peso, volume.valor)
+            if indice < 0:
+                break
+            peso, valor = arvore.restante(indice)
+            anteriores.setdefault(indice, (peso, valor))
+            arvore.definir(indice, peso - volume.peso, valor - volume.valor)
+            destinos.append(indice)
+
+        if len(destinos) == len(carga):
+            for volume, indice in zip(carga, destinos):
+                cargas[indice].append(volume)
+                pesos[indice] += volume.peso
+                valores[indice] += volume.valor
+            livre_peso -= restante_origem[0] + pesos[origem]
+            livre_valor -= restante_origem[1] + valores[origem]
+            cargas[origem] = []
+            pesos[origem] = valores[origem] = 0.0
+        else:
+            for indice, (peso, valor) in anteriores.items():
+                arvore.definir(indice, peso, valor)
+            arvore.definir(origem, *restante_origem)
+    return cargas
@@ -0,0 +1,218 @@
+"""
+Previsão de entrega
+
+A previsão de uma entrega é a data de criação somada à duração do caminho
+mais rápido entre as cidades de origem e destino no grafo de rotas. O cálculo
+é vetorizado com NumPy: cada par (origem, destino) distinto consulta o grafo
+uma única vez e o resultado é espalhado para todas as entregas do par.
+"""
+
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+
+# Entregas que já saíram do remetente e ainda não foram entregues
+STATUS_PREVISAO = ('coletado', 'em_transito')
+
+# Margem na releitura incremental para alterações gravadas por transações que
+# começaram antes da última leitura
+FOLGA_ATUALIZACAO = timedelta(seconds=60)
+
+_SEM_CIDADE = -1
+
+
+def _ids(valores):
+    return np.fromiter((_SEM_CIDADE if v is None else v for v in valores), dtype=np.int64)
+
+
+def duracoes(grafo, origens, destinos):
+    """Horas do caminho mais rápido para cada par; NaN quando não há caminho"""
+    if len(origens) == 0:
+        return np.empty(0)
+
+    pares, inverso = np.unique(np.stack([origens, destinos], axis=1), axis=0, return_inverse=True)
+    horas = np.full(len(pares), np.nan)
+    for i, (origem, destino) in enumerate(pares):
+        if origem == _SEM_CIDADE or destino == _SEM_CIDADE:
+            continue
+        caminho = grafo.caminho(int(origem), int(destino), 'tempo')
+        if caminho is not None and caminho.horas is not None:
+            horas[i] = caminho.horas
+    return horas[inverso.reshape(-1)]
+
+
+def calcular(grafo, origens, destinos, criacao):
+    """Previsões (datetime64[s], NaT se indisponível) para arrays de entregas"""
+    horas = duracoes(grafo, origens, destinos)
+    previsao = np.full(len(horas), np.datetime64('NaT'), dtype='datetime64[s]')
+    conhecidas = ~np.isnan(horas) & ~np.isnat(criacao)
+    segundos = np.rint(horas[conhecidas] * 3600).astype(np.int64)
+    previsao[conhecidas] = criacao[conhecidas] + segundos.astype('timedelta64[s]')
+    return previsao
+
+
+def prever_linhas(grafo, linhas):
+    """Previsão (datetime ou None) para cada linha com status, data_criacao e cidades.
+
+    `grafo` pode ser uma função sem argumentos; ela só é chamada se alguma
+    linha estiver em trânsito.
+    """
+    linhas = list(linhas)
+    abertas = [i for i, linha in enumerate(linhas) if linha.status in STATUS_PREVISAO]
+    resultado = [None] * len(linhas)
+    if not abertas:
+        return resultado
+
+    if callable(grafo):
+        grafo = grafo()
+    selecionadas = [linhas[i] for i in abertas]
+    previsao = calcular(
+        grafo,
+        _ids(l.cidade_origem_id for l in selecionadas),
+        _ids(l.cidade_destino_id for l in selecionadas),
+        np.array([l.data_criacao for l in selecionadas], dtype='datetime64[s]')
+    )
+    for i, valor in zip(abertas, previsao.astype(object)):
+        resultado[i] = valor
+    return resultado
+
+
+class Previsoes:
+    """Previsões publicadas: arrays ordenados por id, nunca alterados depois de criados.
+
+    Quem obteve uma instância pode consultá-la sem trava enquanto outra
+    thread publica a próxima.
+    """
+
+    def __init__(self, ids=None, origens=None, destinos=None, criacao=None, previsao=None,
+                 grafo=None, revisao_grafo=None, marca=None, lido_em=None):
+        self.ids = np.empty(0, dtype=np.int64) if ids is None else ids
+        self.origens = np.empty(0, dtype=np.int64) if origens is None else origens
+        self.destinos = np.empty(0, dtype=np.int64) if destinos is None else destinos
+        self.criacao = np.empty(0, dtype='datetime64[s]') if criacao is None else criacao
+        self.previsao = np.empty(0, dtype='datetime64[s]') if previsao is None else previsao
+        self.grafo = grafo
+        self.revisao_grafo = revisao_grafo
+        self.marca = marca
+        self.lido_em = lido_em
+
+    def __len__(self):
+        return len(self.ids)
+
+    def grafo_atual(self, grafo):
+        return grafo is self.grafo and grafo.revisao == self.revisao_grafo
+
+    def previsao_de(self, entrega_id):
+        """Previsão de uma entrega em trânsito (datetime ou None)"""
+        i = np.searchsorted(self.ids, entrega_id)
+        if i < len(self.ids) and self.ids[i] == entrega_id:
+            return self.previsao[i].astype(object)
+        return None
+
+    def proximas(self, agora, limite, somente_atrasadas=False):
+        """(id, previsão, atrasada) das entregas com previsão, da mais próxima à mais distante"""
+        agora = np.datetime64(agora, 's')
+        atrasadas = self.previsao < agora
+        selecao = np.flatnonzero(atrasadas if somente_atrasadas else ~np.isnat(self.previsao))
+        ordem = selecao[np.argsort(self.previsao[selecao], kind='stable')][:limite]
+        return list(zip(self.ids[ordem].tolist(), self.previsao[ordem].astype(object), atrasadas[ordem].tolist()))
+
+    def resumo(self, agora):
+        """Totais de entregas em trânsito, atrasadas e sem previsão"""
+        return {
+            'em_transito': len(self.ids),
+            'atrasadas': int((self.previsao < np.datetime64(agora, 's')).sum()),
+            'sem_previsao': int(np.isnat(self.previsao).sum())
+        }
+
+
+class PrevisaoEntregas:
+    """Previsões de todas as entregas em trânsito, atualizadas de forma incremental.
+
+    `atualizar` recebe apenas as linhas alteradas desde a última leitura
+    (pela data de atualização): elas substituem as anteriores e saem do
+    conjunto quando deixam de estar em trânsito. Quando o grafo de rotas
+    muda, todas as previsões são recalculadas sem reler o banco. O banco é
+    relido no máximo a cada `intervalo` segundos.
+
+    As threads do processo compartilham a instância: cada atualização monta
+    arrays novos a partir dos publicados e publica um novo `Previsoes` com
+    uma única troca de referência, como o CacheReferencia. A trava só
+    serializa as atualizações; as consultas leem `atual` uma vez.
+    """
+
+    def __init__(self, intervalo=2.0):
+        self.intervalo = intervalo
+        self._trava = threading.Lock()
+        self.limpar()
+
+    def limpar(self):
+        self.atual = Previsoes()
+
+    def __len__(self):
+        return len(self.atual)
+
+    def vencida(self):
+        lido_em = self.atual.lido_em
+        return lido_em is None or time.monotonic() - lido_em >= self.intervalo
+
+    def desde(self):
+        """Data a partir da qual as linhas alteradas devem ser relidas (None: todas)"""
+        marca = self.atual.marca
+        return None if marca is None else marca - FOLGA_ATUALIZACAO
+
+    def atualizar(self, linhas, grafo, marca=None):
+        """Aplica as linhas (id, status, cidade_origem_id, cidade_destino_id,
+        data_criacao) lidas até `marca`, recalcula o que for preciso e
+        retorna as previsões publicadas"""
+        linhas = list(linhas)
+        with self._trava:
+            base = self.atual
+            if marca is not None and base.marca is not None and marca <= base.marca:
+                # Outra thread já publicou uma leitura mais recente
+                linhas, marca = [], None
+            if not linhas and marca is None and base.grafo_atual(grafo):
+                return base
+
+            ids, origens, destinos, criacao, previsao = base.ids, base.origens, base.destinos, base.criacao, base.previsao
+            if linhas:
+                alteradas = np.array([l.id for l in linhas], dtype=np.int64)
+                mantidas = ~np.isin(ids, alteradas)
+                novas = [l for l in linhas if l.status in STATUS_PREVISAO]
+
+                novas_origens = _ids(l.cidade_origem_id for l in novas)
+                novas_destinos = _ids(l.cidade_destino_id for l in novas)
+                nova_criacao = np.array([l.data_criacao for l in novas], dtype='datetime64[s]')
+                if base.grafo_atual(grafo):
+                    nova_previsao = calcular(grafo, novas_origens, novas_destinos, nova_criacao)
+                else:
+                    nova_previsao = np.empty(len(novas), dtype='datetime64[s]')
+
+                ids = np.concatenate([ids[mantidas], np.array([l.id for l in novas], dtype=np.int64)])
+                ordem = np.argsort(ids, kind='stable')
+                ids = ids[ordem]
+                origens = np.concatenate([origens[mantidas], novas_origens])[ordem]
+                destinos = np.concatenate([destinos[mantidas], novas_destinos])[ordem]
+                criacao = np.concatenate([criacao[mantidas], nova_criacao])[ordem]
+                previsao = np.concatenate([previsao[mantidas], nova_previsao])[ordem]
+
+            if not base.grafo_atual(grafo):
+                previsao = calcular(grafo, origens, destinos, criacao)
+
+            self.atual = Previsoes(
+                ids, origens, destinos, criacao, previsao, grafo, grafo.revisao,
+                base.marca if marca is None else marca,
+                base.lido_em if marca is None else time.monotonic(),
+            )
+            return self.atual
+
+    def previsao_de(self, entrega_id):
+        return self.atual.previsao_de(entrega_id)
+
+    def proximas(self, agora, limite, somente_atrasadas=False):
+        return self.atual.proximas(agora, limite, somente_atrasadas)
+
+    def resumo(self, agora):
+        return self.atual.resumo(agora)
@@ -0,0 +1,272 @@
+"""
+API assíncrona (ASGI) de rastreamento
+
+O rastreamento é a maior parte do tráfego: requisições pequenas que passam
+quase todo o tempo esperando o banco. No gunicorn cada uma ocupa um worker
+síncrono inteiro; aqui um único processo atende milhares de conexões
+simultâneas, com as consultas feitas pelo engine assíncrono do SQLAlchemy
+(aiosqlite no SQLite, asyncpg no PostgreSQL) sobre um pool de conexões
+limitado. É somente leitura e usa os mesmos modelos, consultas e
+serialização da aplicação Flask (app.py), então as respostas são idênticas.
+
+Rotas:
+    GET  /api/rastrear/<codigo>
+    POST /api/rastrear/lote
+    GET  /api/entregas/<codigo>
+
+Uso:
+    uvicorn src.rastreio_asgi:app --host 0.0.0.0 --port 8001
+
+Implantação: é um serviço separado da aplicação Flask, com o mesmo
+repositório e as mesmas variáveis (DATABASE_URL). No Railway, crie um
+segundo serviço e aponte o caminho de configuração para
+railway.rastreio.json, que usa o uvicorn como comando de início; o
+railway.json (gunicorn) continua servindo o site e o restante da API. O
+serviço tem domínio próprio: integrações que rastreiam em volume usam esse
+domínio, e a página de rastreamento do site continua na aplicação Flask.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+try:
+    from .app import app as aplicacao_flask
+    from .app import (db, VersaoReferencia, SERIALIZADOR_ENTREGA_DETALHE, cache_referencia,
+                      codigos_lote_rastreio, consulta_entrega_detalhe, consulta_grafo_rotas,
+                      consulta_rastreio, consulta_rastreio_arquivo, montar_rastreio,
+                      resultado_lote_rastreio, trecho_da_rota)
+    from .grafo_rotas import GrafoRotas
+    from .previsao import STATUS_PREVISAO, prever_linhas
+    from .serializacao import codificar, negociar_formato
+except ImportError:
+    from app import app as aplicacao_flask
+    from app import (db, VersaoReferencia, SERIALIZADOR_ENTREGA_DETALHE, cache_referencia,
+                     codigos_lote_rastreio, consulta_entrega_detalhe, consulta_grafo_rotas,
+                     consulta_rastreio, consulta_rastreio_arquivo, montar_rastreio,
+                     resultado_lote_rastreio, trecho_da_rota)
+    from grafo_rotas import GrafoRotas
+    from previsao import STATUS_PREVISAO, prever_linhas
+    from serializacao import codificar, negociar_formato
+
+logger = logging.getLogger(__name__)
+
+DRIVERS_ASSINCRONOS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+# O maior corpo aceito; um lote de LIMITE_LOTE_RASTREIO códigos cabe com folga
+TAMANHO_MAXIMO_CORPO = 64 * 1024
+
+# "busca" e "previsoes" são rotas da aplicação Flask, não códigos
+PADRAO_CODIGO = r'(?P<codigo>(?!busca$|previsoes$)[^/]+)'
+
+
+def engine_assincrono(url, **opcoes):
+    """Engine assíncrono para a mesma URL de banco da aplicação Flask"""
+    url = make_url(url)
+    url = url.set(drivername=DRIVERS_ASSINCRONOS.get(url.get_backend_name(), url.drivername))
+    if url.get_backend_name() == 'postgresql' and 'sslmode' in url.query:
+        # O asyncpg recebe o modo de SSL como argumento de conexão, não na URL
+        opcoes.setdefault('connect_args', {})['ssl'] = url.query['sslmode']
+        url = url.difference_update_query(['sslmode'])
+    if url.get_backend_name() == 'sqlite':
+        # O padrão do aiosqlite é abrir uma conexão por uso; o pool limita a concorrência no banco
+        opcoes.setdefault('poolclass', AsyncAdaptedQueuePool)
+    return create_async_engine(url, **opcoes)
+
+
+class CacheGrafoRotas:
+    """Grafo de rotas do processo, recarregado quando a versão 'rotas' muda.
+
+    Equivale ao CacheReferencia da aplicação Flask: a versão gravada pelas
+    alterações de rotas é relida no máximo a cada `intervalo` segundos.
+    """
+
+    def __init__(self, intervalo=2.0):
+        self.intervalo = intervalo
+        self.limpar()
+
+    def limpar(self):
+        self.grafo = None
+        self.versao = None
+        self.verificado_em = None
+
+    async def obter(self, conexao):
+        agora = time.monotonic()
+        if self.verificado_em is not None and agora - self.verificado_em < self.intervalo:
+            return self.grafo
+
+        versao = (await conexao.execute(
+            db.select(VersaoReferencia.versao).where(VersaoReferencia.chave == 'rotas')
+        )).scalar() or 0
+        if self.grafo is None or versao != self.versao:
+            rotas = await conexao.execute(consulta_grafo_rotas())
+            self.grafo = GrafoRotas(trecho_da_rota(r) for r in rotas)
+            self.versao = versao
+        self.verificado_em = agora
+        return self.grafo
+
+
+def cabecalho(scope, nome):
+    for chave, valor in scope['headers']:
+        if chave == nome:
+            return valor.decode('latin-1')
+    return None
+
+
+async def ler_json(receive):
+    """Corpo JSON da requisição; None se vazio ou inválido"""
+    corpo = b''
+    while True:
+        mensagem = await receive()
+        corpo += mensagem.get('body', b'')
+        if len(corpo) > TAMANHO_MAXIMO_CORPO:
+            raise ValueError('Corpo da requisição muito grande')
+        if not mensagem.get('more_body'):
+            break
+    try:
+        return json.loads(corpo) if corpo else None
+    except ValueError:
+        return None
+
+
+class AplicacaoRastreio:
+    """Aplicação ASGI das rotas de rastreamento, com engine assíncrono próprio.
+
+    O engine é criado na primeira requisição (ou no início do ciclo de vida)
+    e descartado no encerramento, dentro do loop de eventos do servidor.
+    """
+
+    def __init__(self, url, intervalo_grafo=2.0, **opcoes_engine):
+        self.url = url
+        self.opcoes_engine = opcoes_engine
+        self.engine = None
+        self.grafo_rotas = CacheGrafoRotas(intervalo_grafo)
+        self.rotas = [
+            ('POST', re.compile(r'/api/rastrear/lote'), self.rastrear_lote),
+            ('GET', re.compile(r'/api/rastrear/' + PADRAO_CODIGO), self.rastrear),
+            ('GET', re.compile(r'/api/entregas/' + PADRAO_CODIGO), self.entrega_por_codigo),
+        ]
+
+    def conectar(self):
+        if self.engine is None:
+            self.engine = engine_assincrono(self.url, **self.opcoes_engine)
+        return self.engine.connect()
+
+    async def encerrar(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.ciclo_de_vida(receive, send)
+        elif scope['type'] == 'http':
+            status, dados, cabecalhos = await self.despachar(scope, receive)
+            await self.responder(scope, send, status, dados, cabecalhos)
+
+    async def ciclo_de_vida(self, receive, send):
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'lifespan.startup':
+                if self.engine is None:
+                    self.engine = engine_assincrono(self.url, **self.opcoes_engine)
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensagem['type'] == 'lifespan.shutdown':
+                await self.encerrar()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def despachar(self, scope, receive):
+        """(status, dados, cabeçalhos) da rota correspondente ao método e caminho"""
+        permitidos = []
+        for metodo, padrao, tratar in self.rotas:
+            encontrado = padrao.fullmatch(scope['path'])
+            if not encontrado:
+                continue
+            if metodo != scope['method']:
+                permitidos.append(metodo)
+                continue
+            try:
+                return await tratar(receive, **encontrado.groupdict())
+            except Exception as e:
+                logger.exception('Erro em %s %s', scope['method'], scope['path'])
+                return 500, {'success': False, 'error': str(e)}, {}
+
+        if permitidos:
+            return 405, {'success': False, 'error': 'Método não permitido'}, {'allow': ', '.join(permitidos)}
+        return 404, {'success': False, 'error': 'Rota não encontrada'}, {}
+
+    async def responder(self, scope, send, status, dados, cabecalhos):
+        mimetype = negociar_formato(parse_accept_header(cabecalho(scope, b'accept'), MIMEAccept))
+        corpo = codificar(dados, mimetype)
+        headers = [
+            (b'content-type', mimetype.encode('latin-1')),
+            (b'content-length', str(len(corpo)).encode('latin-1')),
+            (b'vary', b'Accept'),
+        ]
+        headers += [(nome.encode('latin-1'), valor.encode('latin-1')) for nome, valor in cabecalhos.items()]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': corpo})
+
+    async def grafo_para(self, conexao, linhas):
+        # Como em prever_linhas, o grafo só é necessário para entregas em trânsito
+        if any(linha.status in STATUS_PREVISAO for linha in linhas):
+            return await self.grafo_rotas.obter(conexao)
+        return None
+
+    async def rastrear(self, receive, codigo):
+        async with self.conectar() as conexao:
+            linhas = (await conexao.execute(consulta_rastreio([codigo]))).all()
+            arquivadas = () if linhas else (await conexao.execute(consulta_rastreio_arquivo([codigo]))).all()
+            grafo = await self.grafo_para(conexao, linhas)
+        rastreio = montar_rastreio(linhas, arquivadas, grafo).get(codigo)
+        return 200, rastreio or {'encontrado': False}, {}
+
+    async def rastrear_lote(self, receive):
+        try:
+            codigos = codigos_lote_rastreio(await ler_json(receive))
+        except ValueError as e:
+            return 400, {'success': False, 'error': str(e)}, {}
+
+        unicos = list(dict.fromkeys(codigos))
+        async with self.conectar() as conexao:
+            linhas = (await conexao.execute(consulta_rastreio(unicos))).all()
+            faltando = set(unicos).difference(linha.codigo_rastreamento for linha in linhas)
+            arquivadas = (await conexao.execute(consulta_rastreio_arquivo(faltando))).all() if faltando else ()
+            grafo = await self.grafo_para(conexao, linhas)
+        return 200, resultado_lote_rastreio(codigos, montar_rastreio(linhas, arquivadas, grafo)), {}
+
+    async def entrega_por_codigo(self, receive, codigo):
+        async with self.conectar() as conexao:
+            linha = (await conexao.execute(consulta_entrega_detalhe(codigo))).first()
+            grafo = await self.grafo_para(conexao, [linha] if linha else [])
+        if not linha:
+            return 404, {'success': False, 'error': 'Entrega não encontrada'}, {}
+
+        dados = SERIALIZADOR_ENTREGA_DETALHE.linha(linha)
+        dados['previsao_entrega'] = prever_linhas(grafo, [linha])[0]
+        return 200, {'success': True, 'data': dados}, {'etag': f'"{linha.versao}"'}
+
+
+def criar_aplicacao():
+    """Aplicação ASGI ligada ao mesmo banco da aplicação Flask"""
+    with aplicacao_flask.app_context():
+        # URL já resolvida pelo Flask-SQLAlchemy (caminho do SQLite na pasta instance)
+        url = db.engine.url
+    return AplicacaoRastreio(
+        url,
+        cache_referencia.intervalo,
+        pool_size=int(os.environ.get('ASGI_POOL_TAMANHO', 10)),
+        max_overflow=int(os.environ.get('ASGI_POOL_EXTRA', 10))
+    )
+
+
+app = criar_aplicacao()
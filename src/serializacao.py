@@ -0,0 +1,106 @@
+"""
+Serialização das respostas da API
+
+Converte linhas de consulta (tuplas de colunas) em dicionários sem hidratar
+objetos do ORM e codifica a resposta com orjson. Clientes que enviam
+`Accept: application/x-msgpack` recebem MessagePack quando o pacote `msgpack`
+estiver instalado.
+"""
+
+import json
+from datetime import date, datetime
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson está no requirements.txt
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MIMETYPE_JSON = 'application/json'
+MIMETYPE_MSGPACK = 'application/x-msgpack'
+
+
+def _valor_padrao(obj):
+    """Conversão de tipos não suportados nativamente pelos codificadores"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'Tipo não serializável: {type(obj).__name__}')
+
+
+def compilar(chaves, conversores=None):
+    """Gera uma função que monta o dicionário de uma linha em uma única expressão.
+
+    `chaves` são os nomes de saída na ordem das colunas da consulta e
+    `conversores` mapeia uma chave para a função aplicada ao seu valor.
+    """
+    conversores = conversores or {}
+    namespace = {}
+    itens = []
+
+    for i, chave in enumerate(chaves):
+        if chave in conversores:
+            nome = f'_conv{i}'
+            namespace[nome] = conversores[chave]
+            itens.append(f'{chave!r}: {nome}(linha[{i}])')
+        else:
+            itens.append(f'{chave!r}: linha[{i}]')
+
+    codigo = 'def serializar(linha):\n    return {' + ', '.join(itens) + '}\n'
+    exec(compile(codigo, '<serializador>', 'exec'), namespace)
+    return namespace['serializar']
+
+
+class Serializador:
+    """Serializador pré-compilado para um conjunto fixo de colunas.
+
+    `campos` é uma sequência de pares (chave de saída, coluna); as colunas
+    são usadas no SELECT e as chaves no dicionário resultante.
+    """
+
+    def __init__(self, campos, conversores=None):
+        self.chaves = tuple(chave for chave, _ in campos)
+        self.colunas = tuple(coluna for _, coluna in campos)
+        self.linha = compilar(self.chaves, conversores)
+
+    def lista(self, linhas):
+        serializar = self.linha
+        return [serializar(linha) for linha in linhas]
+
+
+def formato_data_br(valor):
+    """Data no formato exibido no rastreamento público"""
+    return valor.strftime('%d/%m/%Y %H:%M') if valor else None
+
+
+def codificar(dados, mimetype=MIMETYPE_JSON):
+    """Codifica os dados no formato solicitado"""
+    if mimetype == MIMETYPE_MSGPACK:
+        return msgpack.packb(dados, default=_valor_padrao, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(dados, default=_valor_padrao)
+    return json.dumps(dados, default=_valor_padrao, ensure_ascii=False).encode('utf-8')
+
+
+def negociar_formato(aceitos=None):
+    """Escolhe o formato da resposta a partir do cabeçalho Accept.
+
+    `aceitos` é o MIMEAccept já interpretado; por padrão, o da requisição Flask.
+    """
+    if aceitos is None:
+        aceitos = request.accept_mimetypes
+    oferecidos = [MIMETYPE_JSON, MIMETYPE_MSGPACK] if msgpack is not None else [MIMETYPE_JSON]
+    return aceitos.best_match(oferecidos, default=MIMETYPE_JSON)
+
+
+def resposta(dados, status=200):
+    """Resposta da API codificada conforme a negociação de conteúdo"""
+    mimetype = negociar_formato()
+    response = Response(codificar(dados, mimetype), status=status, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept'
+    return response
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gerador de carga - Expresso Itaporanga
+
+Dispara requisições concorrentes contra uma instância em execução seguindo um
+mix de tráfego configurável (rastreamentos, criações, atualizações de status e
+dashboards) e informa vazão e percentis de latência. Também reproduz logs de
+acesso capturados (formato Common/Combined, usado pelo gunicorn).
+
+Uso:
+    python teste_carga.py --url http://localhost:5000 --duracao 60 --concorrencia 32
+    python teste_carga.py --mix rastrear=80,criar=10,status=5,dashboard=5
+    python teste_carga.py --replay access.log --respeitar-tempo --velocidade 2
+"""
+
+import argparse
+import http.cookiejar
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+MIX_PADRAO = 'rastrear=80,criar=10,status=5,dashboard=5'
+
+STATUS_VALIDOS = ['pendente', 'coletado', 'em_transito', 'entregue', 'cancelado']
+
+# "GET /api/rastrear/EI123 HTTP/1.1" precedido pelo timestamp entre colchetes
+PADRAO_LOG = re.compile(
+    r'\[(?P<data>[^\]]+)\]\s+"(?P<metodo>[A-Z]+) (?P<caminho>\S+) HTTP/[\d.]+"'
+)
+
+
+class Estatisticas:
+    """Latências coletadas por operação (thread-safe)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.erros = defaultdict(int)
+        self.status = defaultdict(int)
+
+    def registrar(self, operacao, latencia_ms, status_code):
+        with self.lock:
+            self.latencias[operacao].append(latencia_ms)
+            self.status[status_code] += 1
+            if status_code is None or status_code >= 500:
+                self.erros[operacao] += 1
+
+
+class PoolCodigos:
+    """Códigos de rastreamento conhecidos, alimentados pelas criações"""
+
+    def __init__(self, codigos=None, limite=50000):
+        self.lock = threading.Lock()
+        self.codigos = list(codigos or [])
+        self.limite = limite
+
+    def adicionar(self, codigo):
+        with self.lock:
+            if len(self.codigos) < self.limite:
+                self.codigos.append(codigo)
+            else:
+                self.codigos[random.randrange(self.limite)] = codigo
+
+    def sortear(self):
+        with self.lock:
+            return random.choice(self.codigos) if self.codigos else 'EI0000000000'
+
+
+class Cliente:
+    """Cliente HTTP com cookies próprios (uma sessão por thread)"""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def requisitar(self, metodo, caminho, corpo=None, formulario=None):
+        """Executa a requisição e retorna (status, corpo em bytes)"""
+        dados = None
+        headers = {}
+        if corpo is not None:
+            dados = json.dumps(corpo).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif formulario is not None:
+            dados = urllib.parse.urlencode(formulario).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        req = urllib.request.Request(self.base_url + caminho, data=dados, headers=headers, method=metodo)
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+        except (urllib.error.URLError, OSError):
+            return None, b''
+
+    def login(self, usuario, senha):
+        status, _ = self.requisitar('POST', '/gestao/login', formulario={'username': usuario, 'password': senha})
+        return status is not None and status < 400
+
+
+def nova_entrega_aleatoria():
+    """Payload sintético para POST /api/entregas"""
+    n = random.randint(1, 10 ** 6)
+    return {
+        'remetente_nome': f'Carga Remetente {n}',
+        'remetente_endereco': f'Rua {n % 500}, {n % 1000}',
+        'remetente_cidade': random.choice(['São Paulo/SP', 'Guarulhos/SP']),
+        'destinatario_nome': f'Carga Destinatário {n}',
+        'destinatario_endereco': f'Av. {n % 700}, {n % 900}',
+        'destinatario_cidade': random.choice(['Itaporanga/PB', 'Campina Grande/PB', 'Sousa/PB', 'Patos/PB']),
+        'tipo_produto': random.choice(['Eletrônicos', 'Roupas', 'Livros', 'Documentos']),
+        'peso': round(random.uniform(0.1, 30.0), 2),
+        'valor_declarado': round(random.uniform(10.0, 2000.0), 2)
+    }
+
+
+def op_rastrear(cliente, pool):
+    return cliente.requisitar('GET', f'/api/rastrear/{pool.sortear()}')
+
+
+def op_criar(cliente, pool):
+    status, corpo = cliente.requisitar('POST', '/api/entregas', corpo=nova_entrega_aleatoria())
+    if status == 201:
+        try:
+            pool.adicionar(json.loads(corpo)['data']['codigo_rastreamento'])
+        except (ValueError, KeyError):
+            pass
+    return status, corpo
+
+
+def op_status(cliente, pool):
+    return cliente.requisitar('PUT', f'/api/entregas/{pool.sortear()}/status',
+                              corpo={'status': random.choice(STATUS_VALIDOS)})
+
+
+def op_dashboard(cliente, pool):
+    return cliente.requisitar('GET', '/gestao/dashboard')
+
+
+OPERACOES = {
+    'rastrear': op_rastrear,
+    'criar': op_criar,
+    'status': op_status,
+    'dashboard': op_dashboard,
+}
+
+
+def interpretar_mix(texto):
+    """Converte 'rastrear=80,criar=10' em listas de operações e pesos"""
+    operacoes, pesos = [], []
+    for parte in texto.split(','):
+        nome, _, peso = parte.partition('=')
+        nome = nome.strip()
+        if nome not in OPERACOES:
+            raise ValueError(f'Operação desconhecida no mix: {nome}. Use: {", ".join(OPERACOES)}')
+        operacoes.append(nome)
+        pesos.append(float(peso or 1))
+    if not operacoes or sum(pesos) <= 0:
+        raise ValueError('Mix de tráfego vazio')
+    return operacoes, pesos
+
+
+def carregar_codigos_iniciais(base_url, timeout, limite=10000):
+    """Busca códigos existentes na API para alimentar os rastreamentos"""
+    status, corpo = Cliente(base_url, timeout).requisitar('GET', '/api/entregas')
+    if status != 200:
+        return []
+    try:
+        dados = json.loads(corpo)['data']
+    except (ValueError, KeyError):
+        return []
+    codigos = [e['codigo_rastreamento'] for e in dados]
+    random.shuffle(codigos)
+    return codigos[:limite]
+
+
+def executar_mix(args, estatisticas):
+    """Workers sorteiam operações do mix até o fim da duração ou do total"""
+    operacoes, pesos = interpretar_mix(args.mix)
+    pool = PoolCodigos(carregar_codigos_iniciais(args.url, args.timeout))
+    print(f"📦 {len(pool.codigos)} códigos de rastreamento carregados")
+
+    fim = time.monotonic() + args.duracao
+    restantes = [args.requisicoes] if args.requisicoes else None
+    lock = threading.Lock()
+
+    def continuar():
+        if time.monotonic() >= fim:
+            return False
+        if restantes is None:
+            return True
+        with lock:
+            if restantes[0] <= 0:
+                return False
+            restantes[0] -= 1
+            return True
+
+    def worker():
+        cliente = Cliente(args.url, args.timeout)
+        if 'dashboard' in operacoes:
+            cliente.login(args.usuario, args.senha)
+        while continuar():
+            nome = random.choices(operacoes, weights=pesos)[0]
+            inicio = time.perf_counter()
+            status, _ = OPERACOES[nome](cliente, pool)
+            estatisticas.registrar(nome, (time.perf_counter() - inicio) * 1000, status)
+
+    return executar_workers(worker, args.concorrencia)
+
+
+def ler_log_acesso(caminho):
+    """Extrai (timestamp, método, caminho) das linhas de um log de acesso"""
+    entradas = []
+    with open(caminho, 'r', encoding='utf-8', errors='replace') as f:
+        for linha in f:
+            m = PADRAO_LOG.search(linha)
+            if not m:
+                continue
+            try:
+                instante = datetime.strptime(m.group('data'), '%d/%b/%Y:%H:%M:%S %z').timestamp()
+            except ValueError:
+                instante = None
+            entradas.append((instante, m.group('metodo'), m.group('caminho')))
+    return entradas
+
+
+def classificar_caminho(caminho):
+    """Agrupa caminhos do log em operações para o relatório"""
+    if caminho.startswith('/api/rastrear/'):
+        return 'rastrear'
+    if caminho.startswith('/api/entregas'):
+        return 'entregas'
+    if caminho.startswith('/gestao'):
+        return 'gestao'
+    if caminho.startswith('/api/'):
+        return 'api'
+    return 'outros'
+
+
+def executar_replay(args, estatisticas):
+    """Reproduz as requisições GET de um log de acesso, em ordem"""
+    entradas = [e for e in ler_log_acesso(args.replay) if e[1] in ('GET', 'HEAD')]
+    if not entradas:
+        print("❌ Nenhuma requisição GET encontrada no log")
+        return 0.0
+    print(f"📜 {len(entradas)} requisições lidas de {args.replay}")
+
+    origem_log = entradas[0][0]
+    origem_real = time.monotonic()
+    indice = [0]
+    lock = threading.Lock()
+
+    def proxima():
+        with lock:
+            if indice[0] >= len(entradas):
+                return None
+            entrada = entradas[indice[0]]
+            indice[0] += 1
+            return entrada
+
+    def worker():
+        cliente = Cliente(args.url, args.timeout)
+        while True:
+            entrada = proxima()
+            if entrada is None:
+                return
+            instante, metodo, caminho = entrada
+            if args.respeitar_tempo and instante is not None and origem_log is not None:
+                atraso = (instante - origem_log) / args.velocidade - (time.monotonic() - origem_real)
+                if atraso > 0:
+                    time.sleep(atraso)
+            inicio = time.perf_counter()
+            status, _ = cliente.requisitar(metodo, caminho)
+            estatisticas.registrar(classificar_caminho(caminho), (time.perf_counter() - inicio) * 1000, status)
+
+    return executar_workers(worker, args.concorrencia)
+
+
+def executar_workers(worker, concorrencia):
+    """Executa os workers em threads e retorna a duração total em segundos"""
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concorrencia)]
+    inicio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - inicio
+
+
+def percentil(ordenados, p):
+    """Percentil por interpolação linear sobre uma lista ordenada"""
+    if not ordenados:
+        return 0.0
+    k = (len(ordenados) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(ordenados) - 1)
+    return ordenados[f] + (ordenados[c] - ordenados[f]) * (k - f)
+
+
+def resumir(latencias, erros, duracao):
+    ordenados = sorted(latencias)
+    return {
+        'requisicoes': len(ordenados),
+        'erros': erros,
+        'vazao_rps': round(len(ordenados) / duracao, 2) if duracao > 0 else 0.0,
+        'latencia_ms': {
+            'p50': round(percentil(ordenados, 50), 2),
+            'p90': round(percentil(ordenados, 90), 2),
+            'p95': round(percentil(ordenados, 95), 2),
+            'p99': round(percentil(ordenados, 99), 2),
+            'max': round(ordenados[-1], 2) if ordenados else 0.0
+        }
+    }
+
+
+def gerar_relatorio(estatisticas, duracao):
+    """Monta o relatório consolidado e por operação"""
+    todas = [l for lista in estatisticas.latencias.values() for l in lista]
+    return {
+        'duracao_s': round(duracao, 2),
+        'geral': resumir(todas, sum(estatisticas.erros.values()), duracao),
+        'operacoes': {
+            nome: resumir(lista, estatisticas.erros[nome], duracao)
+            for nome, lista in sorted(estatisticas.latencias.items())
+        },
+        'status_http': {str(k): v for k, v in sorted(estatisticas.status.items(), key=lambda i: str(i[0]))}
+    }
+
+
+def imprimir_relatorio(relatorio):
+    print("\n" + "=" * 78)
+    print("RESULTADO DO TESTE DE CARGA")
+    print("=" * 78)
+    print(f"{'operação':<12}{'reqs':>8}{'erros':>7}{'req/s':>10}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>10}")
+    linhas = list(relatorio['operacoes'].items()) + [('TOTAL', relatorio['geral'])]
+    for nome, dados in linhas:
+        lat = dados['latencia_ms']
+        print(f"{nome:<12}{dados['requisicoes']:>8}{dados['erros']:>7}{dados['vazao_rps']:>10.1f}"
+              f"{lat['p50']:>9.1f}{lat['p90']:>9.1f}{lat['p99']:>9.1f}{lat['max']:>10.1f}")
+    print(f"\nDuração: {relatorio['duracao_s']}s | Status HTTP: {relatorio['status_http']}")
+    print("Latências em milissegundos")
+
+
+def main():
+    """Função principal"""
+    parser = argparse.ArgumentParser(description='Gerador de carga da Expresso Itaporanga')
+    parser.add_argument('--url', default='http://localhost:5000', help='URL base da instância')
+    parser.add_argument('--concorrencia', type=int, default=16, help='Número de clientes simultâneos')
+    parser.add_argument('--duracao', type=float, default=30, help='Duração máxima em segundos')
+    parser.add_argument('--requisicoes', type=int, help='Número total de requisições (opcional)')
+    parser.add_argument('--mix', default=MIX_PADRAO, help=f'Mix de tráfego (padrão: {MIX_PADRAO})')
+    parser.add_argument('--usuario', default='admin', help='Usuário da gestão para o dashboard')
+    parser.add_argument('--senha', default='admin123', help='Senha da gestão para o dashboard')
+    parser.add_argument('--replay', help='Log de acesso a reproduzir em vez do mix')
+    parser.add_argument('--respeitar-tempo', action='store_true',
+                        help='No replay, preserva os intervalos originais entre requisições')
+    parser.add_argument('--velocidade', type=float, default=1.0, help='Fator de aceleração do replay')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Timeout por requisição em segundos')
+    parser.add_argument('--saida', help='Arquivo JSON para salvar o relatório')
+    args = parser.parse_args()
+
+    print("=" * 78)
+    print(f"TESTE DE CARGA - {args.url} ({args.concorrencia} clientes)")
+    print("=" * 78)
+
+    estatisticas = Estatisticas()
+    try:
+        if args.replay:
+            duracao = executar_replay(args, estatisticas)
+        else:
+            duracao = executar_mix(args, estatisticas)
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 2
+
+    relatorio = gerar_relatorio(estatisticas, duracao)
+    imprimir_relatorio(relatorio)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            json.dump(relatorio, f, indent=2, ensure_ascii=False)
+        print(f"\n✅ Relatório salvo em: {args.saida}")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
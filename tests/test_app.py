@@ -5,15 +5,40 @@ Testes automatizados para a aplicação Expresso Itaporanga
 """
 
 import unittest
+from unittest import mock
+import asyncio
 import json
 import sys
 import os
-from datetime import datetime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from datetime import date, datetime, timedelta
 
 # Adicionar o diretório src ao path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
-from app import app, db, Usuario, Entrega
+from app import app, db, Usuario, Entrega, Cidade, Rota, consultar_pagina_entregas, normalizar_cidades
+from app import cache_referencia, previsao_entregas, preencher_duracao_rotas, atribuir_rotas
+from app import obter_grafo_rotas, aplicar_rota
+from app import FOLGA_RESUMOS, ResumoDiario, atualizar_resumos_diarios, reconstruir_esbocos_tempo, verificar_sla
+from app import detectar_anomalias_volume, arquivar_entregas, EntregaArquivada, ChaveIdempotencia, AnomaliaVolume
+from app import CONCESSAO_IDEMPOTENCIA_SEGUNDOS, aplicar_migracoes, configurar_busca_textual
+from cidades import interpretar_cidade, chave_cidade
+from grafo_rotas import interpretar_duracao
+from planejamento_carga import Volume, planejar
+from cotacao import TABELA_PADRAO, TabelaFrete
+from consultas_analiticas import ConsultasAnaliticas, EstadoAnalitico
+from esboco_quantis import EsbocoQuantis
+from anomalias import detectar
+from previsao import PrevisaoEntregas
+from rastreio_asgi import AplicacaoRastreio
+from benchmark_endpoints import ContadorConsultas, ORCAMENTO_CONSULTAS, cenarios, medir_cenarios, semear_entregas
+from benchmark_endpoints import verificar_status
+from teste_carga import interpretar_mix, ler_log_acesso, percentil
 from werkzeug.security import generate_password_hash
 
 class ExpressoItaporangaTestCase(unittest.TestCase):
@@ -209,6 +234,1455 @@ class TestAPIEntregas(ExpressoItaporangaTestCase):
         self.assertFalse(data['success'])
         self.assertIn('inválido', data['error'])
 
+class TestSerializacao(ExpressoItaporangaTestCase):
+    """Testes para a serialização das respostas de entregas"""
+    
+    def test_rastrear_entrega(self):
+        """Testar formato da resposta do rastreamento público"""
+        response = self.app.get('/api/rastrear/EI1234567890')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        
+        data = json.loads(response.data)
+        self.assertTrue(data['encontrado'])
+        self.assertEqual(data['codigo'], 'EI1234567890')
+        self.assertEqual(data['cidade_destino'], 'Itaporanga/PB')
+        self.assertRegex(data['data_criacao'], r'^\d{2}/\d{2}/\d{4} \d{2}:\d{2}$')
+    
+    def test_rastrear_inexistente(self):
+        """Testar rastreamento de código inexistente"""
+        data = json.loads(self.app.get('/api/rastrear/INEXISTENTE').data)
+        self.assertEqual(data, {'encontrado': False})
+    
+    def test_datas_iso_na_listagem(self):
+        """Testar datas em ISO 8601 na listagem"""
+        data = json.loads(self.app.get('/api/entregas').data)
+        entrega = data['data'][0]
+        self.assertEqual(datetime.fromisoformat(entrega['data_criacao']).year, datetime.utcnow().year)
+        self.assertIn('valor_declarado', entrega)
+    
+    def test_resposta_msgpack(self):
+        """Testar negociação de conteúdo com MessagePack"""
+        try:
+            import msgpack
+        except ImportError:
+            self.skipTest('msgpack não instalado')
+        
+        response = self.app.get('/api/entregas/EI1234567890',
+                                headers={'Accept': 'application/x-msgpack'})
+        self.assertEqual(response.mimetype, 'application/x-msgpack')
+        data = msgpack.unpackb(response.data)
+        self.assertEqual(data['data']['codigo_rastreamento'], 'EI1234567890')
+
+class TestPaginacaoEntregas(ExpressoItaporangaTestCase):
+    """Testes para a listagem paginada da gestão"""
+    
+    def setUp(self):
+        super().setUp()
+        semear_entregas(db, Entrega, 120)
+    
+    def test_primeira_pagina(self):
+        """Testar tamanho da página e contagem total"""
+        entregas, paginacao = consultar_pagina_entregas({'por_pagina': '50'})
+        self.assertEqual(len(entregas), 50)
+        self.assertEqual(paginacao['total'], 121)
+        self.assertFalse(paginacao['total_aproximado'])
+        self.assertEqual(paginacao['paginas'], 3)
+        self.assertTrue(paginacao['tem_proxima'])
+        self.assertFalse(paginacao['tem_anterior'])
+        
+        datas = [e.data_criacao for e in entregas]
+        self.assertEqual(datas, sorted(datas, reverse=True))
+    
+    def test_paginas_sem_sobreposicao(self):
+        """Testar que as páginas não repetem registros"""
+        vistos = set()
+        for pagina in (1, 2, 3):
+            entregas, _ = consultar_pagina_entregas({'pagina': pagina, 'ordenar': 'status'})
+            ids = {e.id for e in entregas}
+            self.assertFalse(ids & vistos)
+            vistos |= ids
+        self.assertEqual(len(vistos), 121)
+    
+    def test_filtros_e_ordenacao(self):
+        """Testar filtro por status e cidade com ordenação ascendente"""
+        entregas, paginacao = consultar_pagina_entregas({
+            'status': 'entregue', 'cidade': 'Sousa', 'ordenar': 'codigo', 'direcao': 'asc'
+        })
+        self.assertTrue(all(e.status == 'entregue' for e in entregas))
+        self.assertTrue(all(e.destinatario_cidade.startswith('Sousa') for e in entregas))
+        codigos = [e.codigo_rastreamento for e in entregas]
+        self.assertEqual(codigos, sorted(codigos))
+        self.assertEqual(paginacao['total'], len(entregas))
+    
+    def test_parametros_invalidos(self):
+        """Testar valores inválidos de paginação e ordenação"""
+        entregas, paginacao = consultar_pagina_entregas({
+            'pagina': 'abc', 'por_pagina': '100000', 'ordenar': 'senha'
+        })
+        self.assertEqual(paginacao['pagina'], 1)
+        self.assertEqual(paginacao['por_pagina'], 200)
+        self.assertEqual(paginacao['ordenar'], 'data_criacao')
+    
+    def test_listagem_exige_login(self):
+        """Testar redirecionamento da listagem sem sessão"""
+        response = self.app.get('/gestao/entregas')
+        self.assertEqual(response.status_code, 302)
+
+class TestBuscaTextual(ExpressoItaporangaTestCase):
+    """Testes para a busca textual de entregas"""
+    
+    def buscar(self, termo):
+        response = self.app.get('/api/entregas/busca', query_string={'q': termo})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['data']
+    
+    def test_busca_sem_acentos(self):
+        """Testar busca por nome ignorando acentos e caixa"""
+        resultados = self.buscar('joao silva')
+        self.assertEqual([r['codigo_rastreamento'] for r in resultados], ['EI1234567890'])
+    
+    def test_busca_por_prefixo_de_endereco(self):
+        """Testar busca por fragmento inicial de palavra"""
+        self.assertEqual(len(self.buscar('Itapor')), 1)
+        self.assertEqual(self.buscar('inexistentexyz'), [])
+    
+    def test_indice_sincronizado(self):
+        """Testar sincronização do índice em atualizações e exclusões"""
+        entrega = Entrega.query.filter_by(codigo_rastreamento='EI1234567890').first()
+        entrega.destinatario_nome = 'Conceição Araújo'
+        db.session.commit()
+        
+        self.assertEqual(len(self.buscar('conceicao')), 1)
+        self.assertEqual(self.buscar('maria'), [])
+        
+        db.session.delete(entrega)
+        db.session.commit()
+        self.assertEqual(self.buscar('conceicao'), [])
+    
+    def test_relevancia_prioriza_nomes(self):
+        """Testar que correspondência no nome vem antes de observações"""
+        db.session.add(Entrega(
+            codigo_rastreamento='EI0000000001',
+            remetente_nome='Empresa X',
+            remetente_endereco='Rua A, 1',
+            remetente_cidade='Recife/PE',
+            destinatario_nome='Carlos Souza',
+            destinatario_endereco='Rua B, 2',
+            destinatario_cidade='Patos/PB',
+            tipo_produto='Livros',
+            observacoes='Entregar para Maria na portaria'
+        ))
+        db.session.commit()
+        
+        resultados = self.buscar('maria')
+        self.assertEqual(resultados[0]['codigo_rastreamento'], 'EI1234567890')
+        self.assertEqual(len(resultados), 2)
+    
+    def test_estrutura_verificada_uma_vez(self):
+        """Testar que a verificação da estrutura de busca não se repete a cada consulta"""
+        self.buscar('joao')
+        with ContadorConsultas(db.engine) as contador:
+            self.buscar('maria')
+        self.assertEqual(contador.total, 1)
+
+    def test_reindexacao_fora_da_inicializacao(self):
+        """Testar que a inicialização só cria a estrutura e o comando migrar-dados reindexa"""
+        db.session.execute(db.text("INSERT INTO entrega_fts(entrega_fts) VALUES ('delete-all')"))
+        db.session.commit()
+        with mock.patch('app.busca_textual_configurada', return_value=False):
+            aplicar_migracoes()
+        self.assertEqual(self.buscar('joao'), [])
+        
+        resultado = app.test_cli_runner().invoke(args=['migrar-dados'])
+        self.assertEqual(resultado.exit_code, 0, resultado.output)
+        self.assertIn('Índice de busca reconstruído', resultado.output)
+        self.assertEqual(len(self.buscar('joao')), 1)
+
+    def test_falha_na_estrutura_preserva_a_transacao(self):
+        """Testar que uma etapa com erro é desfeita sozinha, sem perder as escritas anteriores"""
+        entrega = Entrega.query.filter_by(codigo_rastreamento='EI1234567890').first()
+        entrega.observacoes = 'Conferida'
+        db.session.flush()
+        ddls = ['CREATE TABLE busca_parcial (id INTEGER)', 'CREATE VIRTUAL TABLE x USING modulo_inexistente']
+        with mock.patch('app._ddl_busca_sqlite', return_value=ddls):
+            configurar_busca_textual(db.session.connection())
+        db.session.commit()
+        
+        criada = 'busca_parcial' in db.inspect(db.engine).get_table_names()
+        db.session.execute(db.text('DROP TABLE IF EXISTS busca_parcial'))
+        db.session.commit()
+        self.assertFalse(criada)
+        self.assertEqual(Entrega.query.first().observacoes, 'Conferida')
+
+    def test_busca_sem_termo(self):
+        """Testar busca sem termo válido"""
+        response = self.app.get('/api/entregas/busca?q=%22*')
+        self.assertEqual(response.status_code, 400)
+
+class TestCidades(ExpressoItaporangaTestCase):
+    """Testes para a normalização de cidades"""
+    
+    def nova_entrega(self, codigo, cidade_destino):
+        entrega = Entrega(
+            codigo_rastreamento=codigo,
+            remetente_nome='Remetente',
+            remetente_endereco='Rua A, 1',
+            remetente_cidade='Recife - PE',
+            destinatario_nome='Destinatário',
+            destinatario_endereco='Rua B, 2',
+            destinatario_cidade=cidade_destino,
+            tipo_produto='Livros'
+        )
+        db.session.add(entrega)
+        db.session.commit()
+        return entrega
+    
+    def test_interpretar_formatos(self):
+        """Testar formatos livres de cidade e UF"""
+        self.assertEqual(interpretar_cidade('São Paulo/SP'), ('São Paulo', 'SP'))
+        self.assertEqual(interpretar_cidade('São Paulo - SP'), ('São Paulo', 'SP'))
+        self.assertEqual(interpretar_cidade(' Campina  Grande, pb '), ('Campina Grande', 'PB'))
+        self.assertEqual(interpretar_cidade('Mogi-Mirim'), ('Mogi-Mirim', None))
+        self.assertEqual(chave_cidade('SÃO Paulo', 'SP'), 'sao paulo/sp')
+    
+    def test_formatos_diferentes_mesma_cidade(self):
+        """Testar que grafias diferentes referenciam a mesma cidade"""
+        a = self.nova_entrega('EI0000000001', 'São Paulo/SP')
+        b = self.nova_entrega('EI0000000002', 'Sao Paulo - SP')
+        self.assertIsNotNone(a.cidade_destino_id)
+        self.assertEqual(a.cidade_destino_id, b.cidade_destino_id)
+    
+    def test_estatisticas_agrupadas(self):
+        """Testar agrupamento das estatísticas pela cidade canônica"""
+        self.nova_entrega('EI0000000001', 'São Paulo/SP')
+        self.nova_entrega('EI0000000002', 'São Paulo - SP')
+        
+        data = json.loads(self.app.get('/api/estatisticas').data)['data']
+        self.assertEqual(data['top_cidades_destino'][0], {'cidade': 'São Paulo/SP', 'total': 2})
+    
+    def test_rota_sem_uf_recebe_uf(self):
+        """Testar que a cidade sem UF de uma rota é completada pela entrega"""
+        rota = Rota(nome='Teste', origem='Recife', destino='Patos', distancia=400, tempo_estimado='8h')
+        db.session.add(rota)
+        db.session.commit()
+        
+        entrega = self.nova_entrega('EI0000000001', 'Patos/PB')
+        self.assertEqual(rota.destino_id, entrega.cidade_destino_id)
+        self.assertEqual(rota.origem_id, entrega.cidade_origem_id)
+        self.assertEqual(db.session.get(Cidade, rota.destino_id).uf, 'PB')
+    
+    def test_normalizar_entregas_existentes(self):
+        """Testar o preenchimento das referências em linhas antigas"""
+        db.session.execute(db.update(Entrega).values(cidade_origem_id=None, cidade_destino_id=None))
+        db.session.commit()
+        
+        self.assertEqual(normalizar_cidades(), 2)
+        entrega = Entrega.query.first()
+        self.assertEqual(db.session.get(Cidade, entrega.cidade_destino_id).chave, 'itaporanga/pb')
+    
+    def test_normalizar_uma_instrucao_por_coluna(self):
+        """Testar que o número de instruções não cresce com a quantidade de cidades distintas"""
+        esperadas = {}
+        for i in range(30):
+            entrega = self.nova_entrega(f'EI00000000{i:02d}', f'Cidade {i}/PB')
+            esperadas[entrega.id] = entrega.cidade_destino_id
+        db.session.execute(db.update(Entrega).values(cidade_origem_id=None, cidade_destino_id=None))
+        db.session.commit()
+        
+        with ContadorConsultas(db.engine) as contador:
+            self.assertEqual(normalizar_cidades(), 62)
+        self.assertLessEqual(contador.total, 12)
+        self.assertNotIn('mapa_cidades', db.metadata.tables)
+        for entrega in Entrega.query.filter(Entrega.id.in_(esperadas)):
+            self.assertEqual(entrega.cidade_destino_id, esperadas[entrega.id])
+    
+    def test_autocompletar_por_prefixo(self):
+        """Testar autocompletar sem acentos"""
+        self.nova_entrega('EI0000000001', 'São Paulo/SP')
+        self.nova_entrega('EI0000000002', 'Sousa/PB')
+        
+        data = json.loads(self.app.get('/api/cidades?prefixo=SAO').data)['data']
+        self.assertEqual([c['rotulo'] for c in data], ['São Paulo/SP'])
+        
+        data = json.loads(self.app.get('/api/cidades?prefixo=so').data)['data']
+        self.assertEqual([c['rotulo'] for c in data], ['Sousa/PB'])
+
+class TestCacheReferencia(ExpressoItaporangaTestCase):
+    """Testes para o cache de configurações e dados da empresa"""
+    
+    def setUp(self):
+        super().setUp()
+        self.intervalo_original = cache_referencia.intervalo
+    
+    def tearDown(self):
+        cache_referencia.intervalo = self.intervalo_original
+        super().tearDown()
+    
+    def test_leituras_em_cache(self):
+        """Testar que leituras repetidas não consultam o banco"""
+        self.assertEqual(json.loads(self.app.get('/api/configuracoes').data)['modo_escuro'], 'false')
+        self.app.get('/api/empresa')
+        
+        with ContadorConsultas(db.engine) as contador:
+            self.app.get('/api/configuracoes')
+            self.app.get('/api/empresa')
+        self.assertEqual(contador.total, 0)
+    
+    def test_salvar_em_lote(self):
+        """Testar gravação de várias chaves em uma instrução e leitura atualizada"""
+        self.app.get('/api/configuracoes')
+        novas = {f'chave_{i}': i for i in range(20)}
+        novas['modo_escuro'] = 'true'
+        
+        with ContadorConsultas(db.engine) as contador:
+            response = self.app.post('/api/configuracoes', json=novas)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(contador.total, 2)
+        
+        configs = json.loads(self.app.get('/api/configuracoes').data)
+        self.assertEqual(configs['modo_escuro'], 'true')
+        self.assertEqual(configs['chave_19'], '19')
+        
+        self.app.post('/api/configuracoes', json={'chave_19': 'alterada'})
+        self.assertEqual(json.loads(self.app.get('/api/configuracoes').data)['chave_19'], 'alterada')
+    
+    def test_invalidacao_por_outro_worker(self):
+        """Testar que a versão no banco invalida o cache de outros processos"""
+        cache_referencia.intervalo = 0
+        self.assertEqual(json.loads(self.app.get('/api/empresa').data)['nome'], 'Expresso Itaporanga')
+        
+        # Simula a escrita feita por outro worker diretamente no banco
+        db.session.execute(db.text(
+            "INSERT INTO empresa (nome, cnpj, telefone, email, endereco) "
+            "VALUES ('Expresso Novo', '1', '2', 'a@b.c', 'Rua X')"
+        ))
+        db.session.commit()
+        self.assertEqual(json.loads(self.app.get('/api/empresa').data)['nome'], 'Expresso Itaporanga')
+        
+        db.session.execute(db.text("INSERT INTO versao_referencia (chave, versao) VALUES ('empresa', 1)"))
+        db.session.commit()
+        self.assertEqual(json.loads(self.app.get('/api/empresa').data)['nome'], 'Expresso Novo')
+
+class TestGrafoRotas(ExpressoItaporangaTestCase):
+    """Testes para o menor caminho entre cidades pelas rotas"""
+    
+    def criar_rota(self, nome, origem, destino, distancia, tempo, status='ativa'):
+        response = self.app.post('/api/rotas', json={
+            'nome': nome, 'origem': origem, 'destino': destino,
+            'distancia': distancia, 'tempo_estimado': tempo, 'status': status
+        })
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.data)['id']
+    
+    def caminho(self, origem, destino, criterio='distancia'):
+        return self.app.get('/api/rotas/caminho', query_string={
+            'origem': origem, 'destino': destino, 'criterio': criterio
+        })
+    
+    def test_interpretar_duracao(self):
+        """Testar conversão do tempo estimado em horas"""
+        self.assertEqual(interpretar_duracao('36h'), 36)
+        self.assertEqual(interpretar_duracao('2 dias'), 48)
+        self.assertEqual(interpretar_duracao('1d 4h'), 28)
+        self.assertEqual(interpretar_duracao('2h30'), 2.5)
+        self.assertIsNone(interpretar_duracao('indefinido'))
+    
+    def test_caminho_com_varios_trechos(self):
+        """Testar caminhos por distância e por tempo com conexões"""
+        self.criar_rota('Direta', 'São Paulo/SP', 'Sousa/PB', 2300, '50h')
+        self.criar_rota('SP-Recife', 'São Paulo/SP', 'Recife/PE', 2600, '30h')
+        self.criar_rota('Recife-Sousa', 'Recife', 'Sousa/PB', 450, '7h')
+        
+        response = self.caminho('sao paulo', 'Sousa/PB')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([t['nome'] for t in data['trechos']], ['Direta'])
+        self.assertEqual(data['destino'], 'Sousa/PB')
+        
+        data = json.loads(self.caminho('São Paulo', 'Sousa', 'tempo').data)
+        self.assertEqual([t['nome'] for t in data['trechos']], ['SP-Recife', 'Recife-Sousa'])
+        self.assertEqual(data['distancia_total'], 3050)
+        self.assertEqual(data['tempo_total_horas'], 37)
+        
+        # Rotas são dirigidas
+        self.assertEqual(self.caminho('Sousa', 'São Paulo').status_code, 404)
+    
+    def test_alteracoes_atualizam_grafo(self):
+        """Testar que criar, alterar e excluir rotas reflete no caminho"""
+        self.criar_rota('A-B', 'Cidade A', 'Cidade B', 100, '2h')
+        direta = self.criar_rota('A-C', 'Cidade A', 'Cidade C', 500, '10h')
+        self.assertEqual(len(json.loads(self.caminho('Cidade A', 'Cidade C').data)['trechos']), 1)
+        
+        # Uma rota nova que encurta o caminho já é considerada
+        self.criar_rota('B-C', 'Cidade B', 'Cidade C', 100, '2h')
+        data = json.loads(self.caminho('Cidade A', 'Cidade C').data)
+        self.assertEqual(data['distancia_total'], 200)
+        
+        # Rota em manutenção sai do grafo
+        self.app.put(f'/api/rotas/{direta}', json={'distancia': 50})
+        self.assertEqual(json.loads(self.caminho('Cidade A', 'Cidade C').data)['distancia_total'], 50)
+        self.app.put(f'/api/rotas/{direta}', json={'status': 'manutenção'})
+        self.assertEqual(json.loads(self.caminho('Cidade A', 'Cidade C').data)['distancia_total'], 200)
+        
+        rotas = json.loads(self.app.get('/api/rotas').data)
+        for rota in rotas:
+            if rota['nome'] == 'B-C':
+                self.app.delete(f"/api/rotas/{rota['id']}")
+        self.assertEqual(self.caminho('Cidade A', 'Cidade C').status_code, 404)
+
+    def test_alteracao_publicada_apos_commit(self):
+        """Testar que outras threads não veem a rota antes do commit e o grafo lido não muda"""
+        self.criar_rota('A-B', 'Cidade A', 'Cidade B', 100, '2h')
+        grafo = obter_grafo_rotas()
+
+        def ler_em_outra_thread():
+            with app.app_context():
+                return obter_grafo_rotas()
+
+        rota = Rota(nome='B-C', origem='Cidade B', destino='Cidade C', distancia=100, tempo_estimado='2h')
+        db.session.add(rota)
+        db.session.flush()
+        cache_referencia.invalidar('rotas', aplicar_rota(rota))
+        self.assertIn(rota.id, obter_grafo_rotas())
+        with ThreadPoolExecutor(1) as executor:
+            self.assertNotIn(rota.id, executor.submit(ler_em_outra_thread).result())
+
+        db.session.commit()
+        self.assertNotIn(rota.id, grafo)
+        self.assertIn(rota.id, obter_grafo_rotas())
+        with ThreadPoolExecutor(1) as executor:
+            self.assertIn(rota.id, executor.submit(ler_em_outra_thread).result())
+
+    def test_parametros_invalidos(self):
+        """Testar validação dos parâmetros"""
+        self.assertEqual(self.caminho('A', 'B', 'custo').status_code, 400)
+        self.assertEqual(self.app.get('/api/rotas/caminho?origem=A').status_code, 400)
+        self.assertEqual(self.caminho('Inexistente', 'Outra').status_code, 404)
+
+class TestPrevisaoEntrega(ExpressoItaporangaTestCase):
+    """Testes para a duração das rotas e a previsão de entrega"""
+    
+    def setUp(self):
+        super().setUp()
+        self.intervalo_original = previsao_entregas.intervalo
+        previsao_entregas.intervalo = 0
+        response = self.app.post('/api/rotas', json={
+            'nome': 'SP-PB', 'origem': 'São Paulo', 'destino': 'Itaporanga',
+            'distancia': 2100, 'tempo_estimado': '1 dia e 12h'
+        })
+        self.rota_id = json.loads(response.data)['id']
+    
+    def tearDown(self):
+        previsao_entregas.intervalo = self.intervalo_original
+        super().tearDown()
+    
+    def criar_entrega(self, status, destino='Itaporanga/PB'):
+        response = self.app.post('/api/entregas', json={
+            'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+            'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+            'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': destino,
+            'tipo_produto': 'Documentos'
+        })
+        codigo = json.loads(response.data)['data']['codigo_rastreamento']
+        self.app.put(f'/api/entregas/{codigo}/status', json={'status': status})
+        return codigo
+    
+    def test_duracao_das_rotas(self):
+        """Testar duração numérica a partir do texto e preenchimento de rotas antigas"""
+        self.assertEqual(db.session.get(Rota, self.rota_id).duracao_horas, 36)
+        
+        self.app.put(f'/api/rotas/{self.rota_id}', json={'tempo_estimado': '40h'})
+        self.assertEqual(json.loads(self.app.get('/api/rotas').data)[0]['duracao_horas'], 40)
+        self.app.put(f'/api/rotas/{self.rota_id}', json={'duracao_horas': 41.5})
+        self.assertEqual(json.loads(self.app.get('/api/rotas').data)[0]['duracao_horas'], 41.5)
+        
+        db.session.execute(db.text('UPDATE rota SET duracao_horas = NULL'))
+        db.session.commit()
+        self.assertEqual(preencher_duracao_rotas(), 1)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Rota, self.rota_id).duracao_horas, 40)
+    
+    def test_previsao_no_rastreio(self):
+        """Testar previsão somente para entregas em trânsito"""
+        pendente = self.criar_entrega('pendente')
+        self.assertIsNone(json.loads(self.app.get(f'/api/rastrear/{pendente}').data)['previsao_entrega'])
+        
+        codigo = self.criar_entrega('em_transito')
+        entrega = Entrega.query.filter_by(codigo_rastreamento=codigo).first()
+        esperado = entrega.data_criacao.replace(microsecond=0) + timedelta(hours=36)
+        
+        data = json.loads(self.app.get(f'/api/rastrear/{codigo}').data)
+        self.assertEqual(data['previsao_entrega'], esperado.strftime('%d/%m/%Y %H:%M'))
+        
+        data = json.loads(self.app.get(f'/api/entregas/{codigo}').data)['data']
+        self.assertEqual(data['previsao_entrega'], esperado.isoformat())
+        
+        lista = {e['codigo_rastreamento']: e['previsao_entrega']
+                 for e in json.loads(self.app.get('/api/entregas').data)['data']}
+        self.assertIsNone(lista[pendente])
+        self.assertEqual(lista[codigo], esperado.isoformat())
+        
+        # Destino sem rota não tem previsão
+        sem_rota = self.criar_entrega('coletado', 'Recife/PE')
+        self.assertIsNone(json.loads(self.app.get(f'/api/rastrear/{sem_rota}').data)['previsao_entrega'])
+    
+    def test_previsoes_em_transito(self):
+        """Testar a lista de previsões, atualizada de forma incremental"""
+        atrasada = self.criar_entrega('em_transito')
+        no_prazo = self.criar_entrega('coletado')
+        self.criar_entrega('entregue')
+        db.session.execute(
+            db.update(Entrega).where(Entrega.codigo_rastreamento == atrasada)
+            .values(data_criacao=datetime.utcnow() - timedelta(days=3))
+        )
+        db.session.commit()
+        
+        data = json.loads(self.app.get('/api/entregas/previsoes').data)
+        self.assertEqual(data['resumo'], {'em_transito': 2, 'atrasadas': 1, 'sem_previsao': 0})
+        self.assertEqual([e['codigo_rastreamento'] for e in data['data']], [atrasada, no_prazo])
+        self.assertTrue(data['data'][0]['atrasada'])
+        
+        data = json.loads(self.app.get('/api/entregas/previsoes?atrasadas=1').data)
+        self.assertEqual([e['codigo_rastreamento'] for e in data['data']], [atrasada])
+        
+        # Entregue sai da lista; rota mais lenta recalcula as previsões
+        self.app.put(f'/api/entregas/{atrasada}/status', json={'status': 'entregue'})
+        self.app.put(f'/api/rotas/{self.rota_id}', json={'duracao_horas': 48})
+        data = json.loads(self.app.get('/api/entregas/previsoes').data)
+        self.assertEqual(data['resumo']['em_transito'], 1)
+        entrega = Entrega.query.filter_by(codigo_rastreamento=no_prazo).first()
+        self.assertEqual(data['data'][0]['previsao_entrega'],
+                         (entrega.data_criacao.replace(microsecond=0) + timedelta(hours=48)).isoformat())
+    
+    def test_atualizacoes_simultaneas(self):
+        """Testar que threads publicam previsões novas sem alterar as já obtidas"""
+        rota = db.session.get(Rota, self.rota_id)
+        grafo = obter_grafo_rotas()
+        linhas = [SimpleNamespace(id=i, status='em_transito', cidade_origem_id=rota.origem_id,
+                                  cidade_destino_id=rota.destino_id, data_criacao=datetime(2024, 1, 1))
+                  for i in range(1, 2001)]
+        previsoes = PrevisaoEntregas(0)
+        anteriores = previsoes.atualizar(linhas[:1000], grafo, datetime(2024, 1, 1))
+        
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda i: previsoes.atualizar(linhas[1000 + i * 25:1025 + i * 25], grafo), range(40)))
+        self.assertEqual(len(anteriores), 1000)
+        self.assertEqual(previsoes.atual.ids.tolist(), list(range(1, 2001)))
+        self.assertEqual(previsoes.previsao_de(2000), datetime(2024, 1, 2, 12))
+        
+        # Uma leitura mais antiga que a publicada é descartada
+        previsoes.atualizar([SimpleNamespace(**dict(vars(linhas[0]), status='entregue'))], grafo, datetime(2023, 12, 31))
+        self.assertEqual(len(previsoes), 2000)
+
+class TestAtribuicaoRotas(ExpressoItaporangaTestCase):
+    """Testes para a rota atribuída às entregas e o manifesto"""
+    
+    def setUp(self):
+        super().setUp()
+        response = self.app.post('/api/rotas', json={'nome': 'SP-ITA', 'origem': 'São Paulo', 'destino': 'Itaporanga',
+                                                      'distancia': 2100, 'tempo_estimado': '36h'})
+        self.rota_id = json.loads(response.data)['id']
+    
+    def criar_entrega(self, destino='Itaporanga/PB', peso=1.0):
+        response = self.app.post('/api/entregas', json={
+            'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+            'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+            'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': destino,
+            'tipo_produto': 'Documentos', 'peso': peso, 'valor_declarado': 50
+        })
+        return json.loads(response.data)['data']['codigo_rastreamento']
+    
+    def rota_da_entrega(self, codigo):
+        return json.loads(self.app.get(f'/api/entregas/{codigo}').data)['data']['rota_id']
+    
+    def test_atribuicao_na_criacao(self):
+        """Testar rota atribuída ao criar e removida ao excluir a rota"""
+        codigo = self.criar_entrega()
+        self.assertEqual(self.rota_da_entrega(codigo), self.rota_id)
+        self.assertIsNone(self.rota_da_entrega(self.criar_entrega('Recife/PE')))
+        
+        self.app.delete(f'/api/rotas/{self.rota_id}')
+        self.assertIsNone(self.rota_da_entrega(codigo))
+    
+    def test_reatribuicao(self):
+        """Testar o job de atribuição com rotas criadas depois das entregas"""
+        codigo = self.criar_entrega('Sousa/PB')
+        self.assertIsNone(self.rota_da_entrega(codigo))
+        
+        response = self.app.post('/api/rotas', json={'nome': 'SP-SOU', 'origem': 'São Paulo', 'destino': 'Sousa',
+                                                      'distancia': 2200, 'tempo_estimado': '38h'})
+        rota_sousa = json.loads(response.data)['id']
+        self.assertEqual(atribuir_rotas(), 2)
+        self.assertEqual(self.rota_da_entrega(codigo), rota_sousa)
+        
+        self.app.put(f'/api/rotas/{rota_sousa}', json={'status': 'manutenção'})
+        atribuir_rotas(reatribuir=True)
+        self.assertIsNone(self.rota_da_entrega(codigo))
+    
+    def test_manifesto(self):
+        """Testar manifesto da rota com filtro de status e consultas constantes"""
+        codigos = [self.criar_entrega(peso=peso) for peso in (2.0, 3.5)]
+        self.app.put(f'/api/entregas/{codigos[1]}/status', json={'status': 'entregue'})
+        
+        with ContadorConsultas(db.engine) as contador:
+            response = self.app.get(f'/api/rotas/{self.rota_id}/manifesto')
+        self.assertEqual(contador.total, 2)
+        data = json.loads(response.data)
+        self.assertEqual(data['rota']['nome'], 'SP-ITA')
+        self.assertEqual([e['codigo_rastreamento'] for e in data['data']], [codigos[0]])
+        self.assertEqual(data['peso_total'], 2.0)
+        
+        data = json.loads(self.app.get(f'/api/rotas/{self.rota_id}/manifesto?status=entregue').data)
+        self.assertEqual([e['codigo_rastreamento'] for e in data['data']], [codigos[1]])
+        self.assertEqual(self.app.get('/api/rotas/9999/manifesto').status_code, 404)
+
+class TestPlanejamentoCarga(ExpressoItaporangaTestCase):
+    """Testes para o planejamento de carga dos veículos"""
+    
+    def criar_entrega(self, origem, destino, peso, valor=100.0):
+        response = self.app.post('/api/entregas', json={
+            'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+            'remetente_cidade': origem, 'destinatario_nome': 'Maria Santos',
+            'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': destino,
+            'tipo_produto': 'Diversos', 'peso': peso, 'valor_declarado': valor
+        })
+        return json.loads(response.data)['data']['codigo_rastreamento']
+    
+    def test_first_fit_decreasing(self):
+        """Testar capacidade respeitada, volumes grandes demais e busca local"""
+        volumes = [Volume(i, peso, 10) for i, peso in enumerate([6, 5, 5, 4, 3, 7, 12, None])]
+        plano = planejar(volumes, 10, melhorar=True)
+        
+        self.assertEqual([v.id for v in plano.nao_alocados], [6])
+        self.assertEqual(sorted(v.id for carga in plano.veiculos for v in carga), [0, 1, 2, 3, 4, 5, 7])
+        self.assertTrue(all(sum(v.peso for v in carga) <= 10 for carga in plano.veiculos))
+        self.assertEqual(len(plano.veiculos), plano.limite_inferior)
+        
+        # Limite de valor também separa os volumes
+        plano = planejar([Volume(i, 1, 60) for i in range(4)], 10, capacidade_valor=100)
+        self.assertEqual(len(plano.veiculos), 4)
+        with self.assertRaises(ValueError):
+            planejar(volumes, 0)
+    
+    def test_planejamento_por_rota(self):
+        """Testar agrupamento pelo próximo trecho e a API"""
+        for nome, origem, destino in [('SP-ITA', 'São Paulo', 'Itaporanga'), ('ITA-SOU', 'Itaporanga', 'Sousa')]:
+            self.app.post('/api/rotas', json={'nome': nome, 'origem': origem, 'destino': destino,
+                                              'distancia': 100, 'tempo_estimado': '10h'})
+        direta = [self.criar_entrega('São Paulo/SP', 'Itaporanga/PB', peso) for peso in (700, 400, 500)]
+        
+        # Entrega criada antes das rotas recebe a rota pelo job de atribuição
+        direta.append('EI1234567890')
+        resultado = app.test_cli_runner().invoke(args=['atribuir-rotas'])
+        self.assertIn('1 entregas com rota atribuída', resultado.output)
+        conexao = self.criar_entrega('São Paulo/SP', 'Sousa/PB', 300)
+        pesada = self.criar_entrega('São Paulo/SP', 'Sousa/PB', 1500)
+        sem_rota = self.criar_entrega('Recife/PE', 'Sousa/PB', 10)
+        
+        response = self.app.post('/api/planejamento/carga', json={'capacidade_peso': 1000})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        
+        self.assertEqual(len(data['data']), 1)
+        plano = data['data'][0]
+        self.assertEqual(plano['rota'], 'SP-ITA')
+        self.assertEqual(plano['total_volumes'], 6)
+        self.assertEqual(plano['total_veiculos'], 2)
+        self.assertEqual(plano['nao_alocados'], [pesada])
+        self.assertEqual(sorted(c for v in plano['veiculos'] for c in v['volumes']), sorted(direta + [conexao]))
+        self.assertIn(sem_rota, data['sem_rota'])
+        
+        self.assertEqual(self.app.post('/api/planejamento/carga', json={}).status_code, 400)
+        self.assertEqual(self.app.post('/api/planejamento/carga', json={'capacidade_peso': -1}).status_code, 400)
+        
+        resultado = app.test_cli_runner().invoke(args=['planejar-carga', '--capacidade', '1000'])
+        self.assertEqual(resultado.exit_code, 0)
+        self.assertIn('SP-ITA: 6 volumes em 2 veículos', resultado.output)
+
+class TestCotacaoFrete(ExpressoItaporangaTestCase):
+    """Testes para a cotação de frete"""
+    
+    def test_tabela_de_frete(self):
+        """Testar faixas, excedente, adicionais e mínimo"""
+        tabela = TabelaFrete()
+        cotacao = tabela.cotar(2.5, 2100, 250, 'eletronicos')
+        self.assertEqual((cotacao['faixa_peso'], cotacao['faixa_distancia']), (1, 3))
+        self.assertEqual(cotacao['total'], 60.0 + 9.0 + 0.75)
+        
+        # Limite da faixa é inclusivo; acima da última faixa cobra excedente por kg
+        self.assertEqual(tabela.cotar(5, 300)['frete_peso'], 26.0)
+        self.assertEqual(tabela.cotar(110, 5000)['frete_peso'], 530.0 + 10 * 4.3)
+        self.assertEqual(tabela.cotar(0, 0)['total'], TABELA_PADRAO['minimo'])
+        
+        itens = [(0.5, 100, 0, None), (2.5, 2100, 250, 'Eletrônicos'), (150, 900, 1000, 'Frágil')]
+        lote = tabela.cotar_lote(*zip(*itens))
+        self.assertEqual(lote.tolist(), [tabela.cotar(*item)['total'] for item in itens])
+        
+        with self.assertRaises(ValueError):
+            tabela.cotar(-1, 100)
+        with self.assertRaises(ValueError):
+            TabelaFrete.de_json('{"faixas_peso": [5, 1]}')
+    
+    def test_api_cotacao(self):
+        """Testar cotação avulsa por distância e por cidades"""
+        self.app.post('/api/rotas', json={'nome': 'SP-ITA', 'origem': 'São Paulo/SP', 'destino': 'Itaporanga/PB',
+                                          'distancia': 2100, 'tempo_estimado': '36h'})
+        
+        response = self.app.post('/api/cotacao', json={'peso': 2.5, 'valor_declarado': 250, 'distancia': 2100,
+                                                       'tipo_produto': 'Eletrônicos'})
+        self.assertEqual(json.loads(response.data)['data']['total'], 69.75)
+        
+        data = json.loads(self.app.post('/api/cotacao', json={
+            'peso': 2.5, 'valor_declarado': 250, 'origem': 'São Paulo', 'destino': 'Itaporanga/PB',
+            'tipo_produto': 'Eletrônicos'
+        }).data)['data']
+        self.assertEqual((data['distancia'], data['total']), (2100, 69.75))
+        
+        self.assertEqual(self.app.post('/api/cotacao', json={'peso': 1, 'origem': 'Recife', 'destino': 'Sousa'}).status_code, 400)
+        self.assertEqual(self.app.post('/api/cotacao', json={'peso': -1, 'distancia': 10}).status_code, 400)
+    
+    def test_api_cotacao_lote_e_tabela(self):
+        """Testar lote com itens sem rota e substituição da tabela"""
+        itens = [{'peso': 2.5, 'valor_declarado': 250, 'distancia': 2100, 'tipo_produto': 'Eletrônicos'}] * 500
+        itens = itens + [{'peso': 1, 'origem': 'Recife', 'destino': 'Sousa'}]
+        data = json.loads(self.app.post('/api/cotacao/lote', json={'itens': itens}).data)
+        self.assertEqual(data['total_itens'], 501)
+        self.assertEqual(data['data'][0]['total'], 69.75)
+        self.assertIsNone(data['data'][-1]['total'])
+        self.assertEqual(data['valor_total'], round(500 * 69.75, 2))
+        self.assertEqual(self.app.post('/api/cotacao/lote', json={'itens': []}).status_code, 400)
+        for invalido in ({'peso': 1, 'distancia': 10, 'tipo_produto': 5}, {'peso': [1], 'distancia': 10},
+                         {'peso': 'x', 'distancia': 10}, {'peso': -1, 'distancia': 10}, 'item'):
+            response = self.app.post('/api/cotacao/lote', json={'itens': [itens[0], invalido]})
+            self.assertEqual(response.status_code, 400, invalido)
+            self.assertEqual(json.loads(response.data)['indice'], 1)
+        
+        tabela = dict(TABELA_PADRAO, minimo=100.0)
+        self.assertEqual(self.app.put('/api/cotacao/tabela', json=tabela).status_code, 200)
+        self.assertEqual(json.loads(self.app.get('/api/cotacao/tabela').data)['minimo'], 100.0)
+        data = json.loads(self.app.post('/api/cotacao', json={'peso': 1, 'distancia': 100}).data)
+        self.assertEqual(data['data']['total'], 100.0)
+        
+        self.assertEqual(self.app.put('/api/cotacao/tabela', json={'precos': []}).status_code, 400)
+
+class TestConsultasAnaliticas(ExpressoItaporangaTestCase):
+    """Testes para as agregações analíticas feitas no banco"""
+
+    def test_agregacoes_conferem_com_pandas(self):
+        """Testar contagens no banco e estatísticas em lotes contra o cálculo em memória"""
+        semear_entregas(db, Entrega, 300)
+        consultas = ConsultasAnaliticas(db.engine, tamanho_lote=64)
+
+        cidades = {c.id: f'{c.nome}/{c.uf}' for c in Cidade.query.all()}
+        df = pd.DataFrame([{
+            'status': e.status, 'tipo_produto': e.tipo_produto, 'peso': e.peso, 'valor': e.valor_declarado,
+            'criacao': e.data_criacao, 'atualizacao': e.data_atualizacao,
+            'rota': f'{cidades[e.cidade_origem_id]} → {cidades[e.cidade_destino_id]}'
+        } for e in Entrega.query.all()])
+        df['tempo'] = (df['atualizacao'] - df['criacao']).dt.total_seconds() / 3600
+
+        self.assertEqual(consultas.contagem_status().to_dict(), df['status'].value_counts().to_dict())
+        self.assertEqual(consultas.contagem_produtos().to_dict(), df['tipo_produto'].value_counts().to_dict())
+        self.assertEqual(consultas.contagem_rotas(3).tolist(), df['rota'].value_counts().head(3).tolist())
+        self.assertEqual(consultas.por_dia_semana().to_dict(), df['criacao'].dt.day_name().value_counts().to_dict())
+        self.assertEqual(consultas.por_mes().to_dict(), df['criacao'].dt.strftime('%Y-%m').value_counts().to_dict())
+
+        indicadores = consultas.indicadores()
+        self.assertEqual(indicadores['total'], 301)
+        self.assertEqual(indicadores['entregues'], int((df['status'] == 'entregue').sum()))
+        self.assertAlmostEqual(indicadores['valor_total'], df['valor'].sum(), places=2)
+        self.assertAlmostEqual(indicadores['tempo_medio'], df['tempo'].mean(), places=3)
+
+        esperado = df.groupby('status')['tempo'].agg(['mean', 'median', 'std', 'min', 'max']).round(2)
+        pd.testing.assert_frame_equal(consultas.tempo_por_status(), esperado, atol=0.01, check_names=False)
+
+    def _conferir_estado(self, estado, consultas, analises):
+        """Compara as análises do estado com as do banco.
+
+        A mediana do esboço é a de posição inferior, com erro relativo de até 1%.
+        """
+        for analise in analises:
+            self.assertEqual(getattr(estado, analise)().to_dict(), getattr(consultas, analise)().to_dict(), analise)
+        tempos, esperado = estado.tempo_por_status(), consultas.tempo_por_status()
+        pd.testing.assert_frame_equal(tempos.drop(columns='median'), esperado.drop(columns='median'), atol=0.01)
+        horas = pd.DataFrame([
+            (e.status, (e.data_atualizacao - e.data_criacao).total_seconds() / 3600)
+            for e in [*Entrega.query, *EntregaArquivada.query]
+        ], columns=['status', 'tempo'])
+        inferior = horas.groupby('status')['tempo'].quantile(0.5, interpolation='lower')
+        np.testing.assert_allclose(tempos['median'], inferior.loc[tempos.index], rtol=0.015, atol=0.01)
+
+    def test_estado_incremental(self):
+        """Testar que o estado incremental relê só os dias alterados e acompanha inclusões e exclusões"""
+        semear_entregas(db, Entrega, 300)
+        # Histórico com alterações antigas: nenhum dia fica dentro da folga da marca
+        tabela = Entrega.__table__
+        db.session.execute(db.update(tabela).where(tabela.c.id == db.bindparam('chave')), [
+            {'chave': id_, 'data_criacao': criacao - timedelta(days=2),
+             'data_atualizacao': criacao - timedelta(days=2) + timedelta(hours=id_ % 48)}
+            for id_, criacao in db.session.execute(db.select(Entrega.id, Entrega.data_criacao))
+        ])
+        db.session.commit()
+
+        consultas = ConsultasAnaliticas(db.engine)
+        estado = EstadoAnalitico()
+        self.assertEqual(estado.atualizar(consultas), 301)
+        self.assertEqual(estado.atualizar(consultas), 0)
+
+        self.app.put('/api/entregas/EI1234567890/status', json={'status': 'entregue'})
+        self.app.post('/api/entregas', json={
+            'remetente_nome': 'A', 'remetente_endereco': 'B', 'remetente_cidade': 'Natal/RN',
+            'destinatario_nome': 'C', 'destinatario_endereco': 'D', 'destinatario_cidade': 'Sousa/PB',
+            'tipo_produto': 'Novo', 'peso': 1, 'valor_declarado': 10
+        })
+        # A exclusão aparece quando outra entrega do mesmo dia é alterada
+        por_dia = {}
+        for entrega in Entrega.query.order_by(Entrega.id):
+            por_dia.setdefault(entrega.data_criacao.date(), []).append(entrega)
+        excluida, vizinha = next(e for e in por_dia.values() if len(e) > 1)[:2]
+        db.session.delete(excluida)
+        vizinha.observacoes = 'Conferida'
+        db.session.commit()
+
+        with tempfile.TemporaryDirectory() as pasta:
+            caminho = os.path.join(pasta, 'estado.npz')
+            estado.salvar(caminho)
+            estado = EstadoAnalitico.carregar(caminho)
+        relidas = estado.atualizar(consultas)
+        self.assertGreater(relidas, 0)
+        self.assertLess(relidas, 301)
+
+        self.assertEqual(len(estado), 301)
+        self._conferir_estado(estado, consultas, (
+            'contagem_status', 'contagem_produtos', 'contagem_rotas', 'por_dia_semana', 'por_mes'))
+        pd.testing.assert_frame_equal(estado.valor_peso()['por_produto'], consultas.valor_peso()['por_produto'])
+        indicadores, esperados = estado.indicadores(), consultas.indicadores()
+        self.assertEqual(indicadores['entregues'], esperados['entregues'])
+        self.assertAlmostEqual(indicadores['valor_total'], esperados['valor_total'], places=2)
+        self.assertAlmostEqual(indicadores['tempo_medio'], esperados['tempo_medio'], places=3)
+        self.assertEqual(indicadores['inicio'].floor('s'), pd.Timestamp(esperados['inicio']).floor('s'))
+
+    def test_snapshot_parquet(self):
+        """Testar exportação incremental para Parquet e leitura só das colunas pedidas"""
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow não instalado')
+        from exportar_parquet import COLUNAS_ANALISE, exportar, ler_snapshot, linhas_para_estado
+
+        semear_entregas(db, Entrega, 200)
+        url = db.engine.url.render_as_string(hide_password=False)
+        with tempfile.TemporaryDirectory() as pasta:
+            self.assertEqual(exportar(url, pasta), 201)
+            
+            # Arquivadas continuam no snapshot, como nas consultas analíticas
+            self.assertGreater(arquivar_entregas(dias=0), 0)
+            self.app.put('/api/entregas/EI1234567890/status', json={'status': 'entregue'})
+            self.assertGreaterEqual(exportar(url, pasta), 1)
+
+            df = ler_snapshot(pasta, ['status'])
+            self.assertEqual(set(df.columns), {'id', 'data_atualizacao', 'status'})
+            self.assertEqual(len(df), 201)
+            self.assertEqual(len(df), ConsultasAnaliticas(db.engine).indicadores()['total'])
+
+            estado = EstadoAnalitico()
+            estado.aplicar(linhas_para_estado(ler_snapshot(pasta, COLUNAS_ANALISE)))
+        consultas = ConsultasAnaliticas(db.engine)
+        self._conferir_estado(estado, consultas, ('contagem_status', 'contagem_produtos', 'contagem_rotas', 'por_mes'))
+
+    def test_graficos_incrementais(self):
+        """Testar que só os gráficos cujas seções mudaram são refeitos"""
+        try:
+            from gerar_graficos_analise import gerar_graficos
+        except ImportError:
+            self.skipTest('matplotlib não instalado')
+
+        dados = {
+            'distribuicao_status': {'pendente': 3, 'entregue': 5},
+            'distribuicao_produtos': {'Documentos': 8},
+            'entregas_por_dia_semana': {'Monday': 4, 'Friday': 4},
+            'indicadores': {'taxa_sucesso': 62.5, 'tempo_medio_processamento': 10.0,
+                            'total_valor_declarado': 800.0, 'peso_total': 4.0},
+        }
+        with tempfile.TemporaryDirectory() as pasta:
+            gerados, inalterados = gerar_graficos(dados, pasta, dpi=40, processos=2)
+            self.assertEqual((len(gerados), len(inalterados)), (4, 0))
+
+            dados['distribuicao_produtos'] = {'Documentos': 6, 'Livros': 2}
+            gerados, inalterados = gerar_graficos(dados, pasta, dpi=40)
+            self.assertEqual(sorted(os.path.basename(a) for a in gerados),
+                             ['dashboard_resumo.png', 'distribuicao_produtos.png'])
+
+            gerados, _ = gerar_graficos(dados, pasta, formato='svg', dpi=40, processos=1)
+            self.assertEqual(len(gerados), 4)
+            self.assertEqual(gerar_graficos(dados, pasta, formato='svg', dpi=40)[0], [])
+
+    def test_resumo_pre_calculado(self):
+        """Testar o resumo gravado pelo comando de atualização e servido pela API de analytics"""
+        semear_entregas(db, Entrega, 50)
+        self.assertEqual(self.app.get('/gestao/analytics/dados').status_code, 401)
+        with self.app.session_transaction() as sessao:
+            sessao['user_id'] = 1
+        response = self.app.get('/gestao/analytics/dados')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(json.loads(response.data)['success'])
+
+        with tempfile.TemporaryDirectory() as pasta:
+            caminho = os.path.join(pasta, 'analytics.estado.npz')
+            resultado = app.test_cli_runner().invoke(args=['atualizar-analytics', '--estado', caminho])
+            self.assertEqual(resultado.exit_code, 0)
+            self.assertIn('51 entregas relidas', resultado.output)
+
+            response = self.app.get('/gestao/analytics/dados')
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            consultas = ConsultasAnaliticas(db.engine)
+            self.assertEqual(data['total_entregas'], 51)
+            self.assertEqual(data['distribuicao_status'], consultas.contagem_status().to_dict())
+            self.assertEqual(data['entregas_por_mes'], consultas.por_mes().to_dict())
+            self.assertEqual(set(data['tempo_processamento']), set(consultas.tempo_por_status().index))
+
+            # O worker não lê as entregas: o resumo só muda na próxima execução do comando
+            self.app.post('/api/entregas', json={
+                'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+                'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+                'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': 'Itaporanga/PB',
+                'tipo_produto': 'Documentos'
+            })
+            with ContadorConsultas(db.engine) as contador:
+                self.assertEqual(json.loads(self.app.get('/gestao/analytics/dados').data)['total_entregas'], 51)
+            self.assertLessEqual(contador.total, 1)
+
+            resultado = app.test_cli_runner().invoke(args=['atualizar-analytics', '--estado', caminho])
+            self.assertIn('52 no estado', resultado.output)
+            with mock.patch.object(cache_referencia, 'intervalo', 0):
+                self.assertEqual(json.loads(self.app.get('/gestao/analytics/dados').data)['total_entregas'], 52)
+            self.assertEqual(len(EstadoAnalitico.carregar(caminho)), 52)
+
+class TestResumosDiarios(ExpressoItaporangaTestCase):
+    """Testes para os resumos diários e a série de estatísticas"""
+
+    def serie(self, **parametros):
+        response = self.app.get('/api/estatisticas/serie', query_string=parametros)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['data']
+
+    def test_resumos_conferem_com_entregas(self):
+        """Testar rollups completos, incrementais e a série por granularidade"""
+        semear_entregas(db, Entrega, 200)
+        self.assertEqual(atualizar_resumos_diarios(), len({e.data_criacao.date() for e in Entrega.query.all()}))
+
+        entregas = Entrega.query.all()
+        meses = pd.Series([e.data_criacao.strftime('%Y-%m') for e in entregas]).value_counts().sort_index()
+        self.assertEqual({p['periodo']: p['total'] for p in self.serie(granularidade='mes')}, meses.to_dict())
+        semanas = self.serie(granularidade='semana')
+        self.assertTrue(all(date.fromisoformat(p['periodo']).weekday() == 0 for p in semanas))
+        self.assertEqual(sum(p['total'] for p in semanas), 201)
+        dias = self.serie(granularidade='dia', status='entregue')
+        self.assertEqual(sum(p['total'] for p in dias), sum(e.status == 'entregue' for e in entregas))
+
+        # Só os dias com entregas alteradas são recalculados (a semeadura gera atualizações futuras)
+        antiga = min(entregas, key=lambda e: e.data_criacao)
+        self.app.put(f'/api/entregas/{antiga.codigo_rastreamento}/status', json={'status': 'cancelado'})
+        desde = db.session.query(db.func.max(ResumoDiario.atualizado_em)).scalar() - FOLGA_RESUMOS
+        recentes = {e.data_criacao.date() for e in entregas if e.data_atualizacao >= desde}
+        self.assertEqual(atualizar_resumos_diarios(), len(recentes | {antiga.data_criacao.date()}))
+        canceladas = self.serie(granularidade='mes', status='cancelado')
+        self.assertEqual(sum(p['total'] for p in canceladas), Entrega.query.filter_by(status='cancelado').count())
+        self.assertEqual(db.session.query(db.func.sum(ResumoDiario.quantidade)).scalar(), 201)
+
+        self.assertEqual(self.app.get('/api/estatisticas/serie?granularidade=ano').status_code, 400)
+        self.assertEqual(self.app.get('/api/estatisticas/serie?inicio=ontem').status_code, 400)
+        resultado = app.test_cli_runner().invoke(args=['atualizar-resumos', '--completo'])
+        self.assertEqual(resultado.exit_code, 0)
+        self.assertIn('dias recalculados', resultado.output)
+        self.assertEqual(db.session.query(db.func.sum(ResumoDiario.quantidade)).scalar(), 201)
+
+    def test_destino_desconhecido(self):
+        """Testar que um destino inexistente não devolve os resumos sem cidade"""
+        db.session.execute(db.update(Entrega).values(cidade_destino_id=None))
+        db.session.commit()
+        atualizar_resumos_diarios()
+        self.assertEqual(sum(p['total'] for p in self.serie()), 1)
+        self.assertEqual(self.serie(destino='Cidade Inexistente/ZZ'), [])
+
+
+class TestPercentisTempo(ExpressoItaporangaTestCase):
+    """Testes para os esboços de quantis do tempo de entrega"""
+
+    def test_esboco_erro_relativo_e_mescla(self):
+        """Testar quantis dentro da precisão e mescla equivalente à união"""
+        valores = [0.0] + [1.5 ** i for i in range(1, 40)]
+        esboco = EsbocoQuantis()
+        for valor in valores:
+            esboco.adicionar(valor)
+        ordenados = sorted(valores)
+        for q in (0.5, 0.9, 0.99):
+            exato = ordenados[int(q * (len(ordenados) - 1))]
+            self.assertLessEqual(abs(esboco.quantil(q) - exato), exato * esboco.precisao + 1e-9)
+        self.assertEqual(esboco.quantil(0), 0.0)
+
+        primeira, segunda = EsbocoQuantis(), EsbocoQuantis()
+        for i, valor in enumerate(valores):
+            (primeira if i % 2 else segunda).adicionar(valor)
+        self.assertEqual(primeira.mesclar(segunda).quantis(), esboco.quantis())
+        self.assertIsNone(EsbocoQuantis().quantil(0.5))
+        with self.assertRaises(ValueError):
+            esboco.mesclar(EsbocoQuantis(precisao=0.05))
+
+    def test_percentis_por_status(self):
+        """Testar registro a cada mudança de status e reconstrução a partir do banco"""
+        self.app.put('/api/entregas/EI1234567890/status', json={'status': 'coletado'})
+        self.app.put('/api/entregas/EI1234567890/status', json={'status': 'entregue'})
+        self.app.put('/api/entregas/EI1234567890/status', json={'status': 'entregue'})
+
+        response = self.app.get('/api/estatisticas/tempos')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)['data']
+        self.assertEqual([(g['status'], g['quantidade']) for g in data], [('coletado', 1), ('entregue', 1)])
+        self.assertEqual(data[0]['p50'], 0.0)
+
+        semear_entregas(db, Entrega, 300)
+        self.assertEqual(reconstruir_esbocos_tempo(tamanho_lote=64), 301)
+        entregues = sorted((e.data_atualizacao - e.data_criacao).total_seconds() / 3600
+                           for e in Entrega.query.filter_by(status='entregue'))
+        response = self.app.get('/api/estatisticas/tempos', query_string={'status': 'entregue', 'quantis': '0.5,0.9'})
+        grupo = json.loads(response.data)['data'][0]
+        self.assertEqual(grupo['quantidade'], len(entregues))
+        exato = entregues[int(0.9 * (len(entregues) - 1))]
+        self.assertAlmostEqual(grupo['p90'], exato, delta=exato * 0.01 + 0.01)
+
+        por_rota = json.loads(self.app.get('/api/estatisticas/tempos?agrupar=rota_status').data)['data']
+        self.assertEqual(sum(g['quantidade'] for g in por_rota), 301)
+        self.assertEqual(self.app.get('/api/estatisticas/tempos?quantis=2').status_code, 400)
+        self.assertEqual(self.app.get('/api/estatisticas/tempos?agrupar=dia').status_code, 400)
+
+
+class TestAlertasSla(ExpressoItaporangaTestCase):
+    """Testes para o detector de entregas paradas além do prazo da rota"""
+    
+    def criar_em_transito(self, horas_paradas, destino='Itaporanga/PB'):
+        response = self.app.post('/api/entregas', json={
+            'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+            'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+            'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': destino,
+            'tipo_produto': 'Documentos'
+        })
+        codigo = json.loads(response.data)['data']['codigo_rastreamento']
+        self.parar(codigo, horas_paradas)
+        return codigo
+    
+    def parar(self, codigo, horas):
+        db.session.execute(db.update(Entrega).where(Entrega.codigo_rastreamento == codigo).values(
+            status='em_transito', data_atualizacao=datetime.utcnow() - timedelta(hours=horas)))
+        db.session.commit()
+    
+    def test_alertas_por_duracao_da_rota(self):
+        """Testar prazo pela rota, prazo padrão, alerta único e resolução"""
+        self.app.post('/api/rotas', json={'nome': 'SP-PB', 'origem': 'São Paulo', 'destino': 'Itaporanga',
+                                          'distancia': 2100, 'tempo_estimado': '36h'})
+        atrasada = self.criar_em_transito(40)
+        self.criar_em_transito(10)
+        self.criar_em_transito(40, destino='Recife/PE')  # sem rota: prazo padrão de 72h
+        self.parar('EI1234567890', 80)
+        
+        self.assertEqual(verificar_sla(), (2, 0))
+        self.assertEqual(verificar_sla(), (0, 0))
+        
+        data = json.loads(self.app.get('/api/alertas/sla').data)
+        self.assertEqual([a['codigo_rastreamento'] for a in data['data']], ['EI1234567890', atrasada])
+        self.assertAlmostEqual(data['data'][1]['atraso_horas'], 4, delta=0.2)
+        
+        # Verificações seguintes leem só a faixa que venceu desde a anterior
+        parada_antiga = self.criar_em_transito(100)
+        self.assertEqual(verificar_sla(), (0, 0))
+        self.assertEqual(verificar_sla(completo=True), (1, 0))
+        self.app.put(f'/api/entregas/{parada_antiga}/status', json={'status': 'entregue'})
+        
+        self.app.put(f'/api/entregas/{atrasada}/status', json={'status': 'entregue'})
+        resultado = app.test_cli_runner().invoke(args=['verificar-sla'])
+        self.assertIn('0 alertas novos, 2 resolvidos', resultado.output)
+        data = json.loads(self.app.get('/api/alertas/sla').data)
+        self.assertEqual((data['abertos'], len(data['data'])), (1, 1))
+        self.assertEqual(len(json.loads(self.app.get('/api/alertas/sla?todos=1').data)['data']), 3)
+
+
+class TestAnomaliasVolume(ExpressoItaporangaTestCase):
+    """Testes para a detecção de quedas e picos no volume diário"""
+    
+    def test_linha_de_base_robusta(self):
+        """Testar que só a queda e o pico destoam da série sazonal"""
+        semana = [30, 32, 31, 29, 33, 12, 10]
+        serie = [float(semana[dia % 7]) for dia in range(120)]
+        serie[80], serie[100] = 0.0, 90.0
+        plana = [2.0] * 120
+        plana[90] = 9.0  # abaixo do volume mínimo esperado
+        series, dias, observados, esperados, escores = detectar(np.array([serie, plana]))
+        self.assertEqual(list(zip(series.tolist(), dias.tolist())), [(0, 80), (0, 100)])
+        self.assertLess(escores[0], 0)
+        self.assertGreater(escores[1], 0)
+    
+    def test_job_e_api(self):
+        """Testar detecção sobre os resumos diários e a API"""
+        atualizar_resumos_diarios()
+        cidade_id = Entrega.query.first().cidade_destino_id
+        hoje = datetime.utcnow().date()
+        marca = datetime.utcnow()
+        linhas = []
+        for atras in range(60, 0, -1):
+            quantidade = 0 if atras == 5 else 20 + atras % 3
+            linhas.append({'dia': hoje - timedelta(days=atras), 'status': 'entregue', 'cidade_destino_id': cidade_id,
+                           'tipo_produto': 'Livros', 'quantidade': quantidade, 'peso_total': 0.0,
+                           'valor_total': 0.0, 'atualizado_em': marca})
+        db.session.execute(db.insert(ResumoDiario), linhas)
+        db.session.commit()
+        
+        self.assertEqual(detectar_anomalias_volume(), 2)  # série da cidade e série cidade × produto
+        data = json.loads(self.app.get('/api/anomalias').data)['data']
+        self.assertEqual({(a['dia'], a['tipo'], a['tipo_produto']) for a in data},
+                         {((hoje - timedelta(days=5)).isoformat(), 'queda', p) for p in ('Livros', None)})
+        self.assertEqual(data[0]['destino'], 'Itaporanga/PB')
+        self.assertEqual(json.loads(self.app.get('/api/anomalias?tipo=pico').data)['data'], [])
+        self.assertEqual(self.app.get('/api/anomalias?desde=ontem').status_code, 400)
+        
+        # Destino inexistente não lista as séries sem cidade de destino
+        db.session.add(AnomaliaVolume(dia=hoje, tipo='pico', observado=50, esperado=10.0, escore=8.0))
+        db.session.commit()
+        self.assertEqual(len(json.loads(self.app.get('/api/anomalias?destino=Itaporanga/PB').data)['data']), 2)
+        self.assertEqual(json.loads(self.app.get('/api/anomalias?destino=Cidade Inexistente/ZZ').data)['data'], [])
+
+
+class TestArquivamento(ExpressoItaporangaTestCase):
+    """Testes para o arquivamento de entregas encerradas"""
+    
+    def criar_encerrada(self, status, dias):
+        response = self.app.post('/api/entregas', json={
+            'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+            'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+            'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': 'Itaporanga/PB',
+            'tipo_produto': 'Documentos', 'peso': 2.0
+        })
+        codigo = json.loads(response.data)['data']['codigo_rastreamento']
+        db.session.execute(db.update(Entrega).where(Entrega.codigo_rastreamento == codigo).values(
+            status=status, data_atualizacao=datetime.utcnow() - timedelta(days=dias)))
+        db.session.commit()
+        return codigo
+    
+    def test_arquivamento_em_lotes(self):
+        """Testar lotes, retenção, rastreamento pelo arquivo e resumos diários"""
+        antigas = [self.criar_encerrada('entregue', 200), self.criar_encerrada('cancelado', 300),
+                   self.criar_encerrada('entregue', 400)]
+        recente = self.criar_encerrada('entregue', 10)
+        atualizar_resumos_diarios()
+        
+        self.assertEqual(arquivar_entregas(lote=2, limite_lotes=1), 2)
+        self.assertEqual(arquivar_entregas(lote=2), 1)
+        self.assertEqual(arquivar_entregas(), 0)
+        self.assertEqual(sorted(e.codigo_rastreamento for e in EntregaArquivada.query.all()), sorted(antigas))
+        self.assertEqual(Entrega.query.count(), 2)
+        
+        data = json.loads(self.app.get(f'/api/rastrear/{antigas[1]}').data)
+        self.assertTrue(data['encontrado'])
+        self.assertEqual((data['status'], data['previsao_entrega']), ('cancelado', None))
+        self.assertTrue(json.loads(self.app.get(f'/api/rastrear/{recente}').data)['encontrado'])
+        self.assertFalse(json.loads(self.app.get('/api/rastrear/EI0000000000').data)['encontrado'])
+        
+        # Os resumos continuam contando as arquivadas, mesmo quando o dia é recalculado
+        self.app.put(f'/api/entregas/{recente}/status', json={'status': 'cancelado'})
+        atualizar_resumos_diarios()
+        self.assertEqual(db.session.query(db.func.sum(ResumoDiario.quantidade)).scalar(), 5)
+        atualizar_resumos_diarios(completo=True)
+        self.assertEqual(db.session.query(db.func.sum(ResumoDiario.peso_total)).scalar(), 8.5)
+        
+        resultado = app.test_cli_runner().invoke(args=['arquivar-entregas', '--dias', '0'])
+        self.assertIn('1 entregas arquivadas', resultado.output)
+    
+    def test_alterada_durante_o_lote_nao_e_arquivada(self):
+        """Testar que uma entrega reaberta entre a leitura dos ids e a cópia fica ativa"""
+        reaberta, antiga = self.criar_encerrada('entregue', 400), self.criar_encerrada('entregue', 300)
+        ler_ids = db.session.scalars
+        
+        def ler_e_reabrir(*args, **kwargs):
+            ids = ler_ids(*args, **kwargs).all()
+            db.session.execute(db.update(Entrega).where(Entrega.codigo_rastreamento == reaberta).values(
+                status='em_transito', data_atualizacao=datetime.utcnow()))
+            return mock.Mock(all=lambda: ids)
+        
+        with mock.patch.object(db.session, 'scalars', side_effect=ler_e_reabrir):
+            self.assertEqual(arquivar_entregas(limite_lotes=1), 1)
+        self.assertEqual([e.codigo_rastreamento for e in EntregaArquivada.query.all()], [antiga])
+        self.assertEqual(Entrega.query.filter_by(codigo_rastreamento=reaberta).one().status, 'em_transito')
+    
+    def test_codigo_novo_nao_repete_arquivado(self):
+        """Testar que a criação não reutiliza o código de uma entrega arquivada"""
+        arquivada = self.criar_encerrada('entregue', 400)
+        arquivar_entregas()
+        
+        # O primeiro código sorteado é o da arquivada; o segundo é livre
+        sorteios = [list(arquivada[2:]), list('0000000001')]
+        with mock.patch('random.choices', side_effect=lambda *a, **k: sorteios.pop(0)):
+            response = self.app.post('/api/entregas', json={
+                'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+                'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+                'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': 'Itaporanga/PB',
+                'tipo_produto': 'Documentos'
+            })
+        self.assertEqual(json.loads(response.data)['data']['codigo_rastreamento'], 'EI0000000001')
+        self.assertEqual(json.loads(self.app.get(f'/api/rastrear/{arquivada}').data)['status'], 'entregue')
+    
+    def test_id_novo_nao_repete_arquivado(self):
+        """Testar que o id da última entrega arquivada não é reaproveitado"""
+        self.criar_encerrada('entregue', 400)
+        self.assertEqual(arquivar_entregas(), 1)
+        arquivada = db.session.query(db.func.max(EntregaArquivada.id)).scalar()
+        
+        codigo = self.criar_encerrada('entregue', 400)
+        self.assertGreater(Entrega.query.filter_by(codigo_rastreamento=codigo).one().id, arquivada)
+        self.assertEqual(arquivar_entregas(), 1)
+        consultas = ConsultasAnaliticas(db.engine)
+        self.assertEqual(consultas.indicadores()['total'], Entrega.query.count() + EntregaArquivada.query.count())
+
+
+class TestIdempotencia(ExpressoItaporangaTestCase):
+    """Testes para o cabeçalho Idempotency-Key"""
+    
+    nova_entrega = {
+        'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+        'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+        'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': 'Itaporanga/PB',
+        'tipo_produto': 'Documentos'
+    }
+    
+    def test_repeticao_devolve_a_mesma_entrega(self):
+        """Testar que a repetição não cria outra entrega"""
+        cabecalhos = {'Idempotency-Key': 'parceiro-123'}
+        primeira = self.app.post('/api/entregas', json=self.nova_entrega, headers=cabecalhos)
+        repetida = self.app.post('/api/entregas', json=self.nova_entrega, headers=cabecalhos)
+        self.assertEqual((primeira.status_code, repetida.status_code), (201, 201))
+        self.assertEqual(repetida.data, primeira.data)
+        self.assertEqual(repetida.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(Entrega.query.count(), 2)
+        
+        # Mesma chave com outro conteúdo; sem chave, cada requisição cria uma entrega
+        outra = dict(self.nova_entrega, peso=3.0)
+        self.assertEqual(self.app.post('/api/entregas', json=outra, headers=cabecalhos).status_code, 422)
+        self.app.post('/api/entregas', json=self.nova_entrega)
+        self.assertEqual(Entrega.query.count(), 3)
+    
+    def test_status_e_chaves_vencidas(self):
+        """Testar atualização de status, escopo por endpoint, erros e expiração"""
+        cabecalhos = {'Idempotency-Key': 'chave-1'}
+        url = '/api/entregas/EI1234567890/status'
+        self.assertEqual(self.app.put(url, json={'status': 'em_transito'}, headers=cabecalhos).status_code, 200)
+        self.app.put(url, json={'status': 'entregue'})
+        repetida = self.app.put(url, json={'status': 'em_transito'}, headers=cabecalhos)
+        self.assertEqual(json.loads(repetida.data)['data']['status'], 'em_transito')
+        self.assertEqual(Entrega.query.first().status, 'entregue')
+        
+        # Primeira requisição ainda sem resposta guardada
+        db.session.add(ChaveIdempotencia(chave='chave-3', endpoint='api_atualizar_status', hash_requisicao='-',
+                                         expira_em=datetime.utcnow() + timedelta(hours=1)))
+        db.session.commit()
+        self.assertEqual(self.app.put(url, json={'status': 'entregue'}, headers={'Idempotency-Key': 'chave-3'}).status_code, 409)
+        
+        # Reserva de uma requisição interrompida: retomada depois da concessão
+        db.session.execute(db.update(ChaveIdempotencia).where(ChaveIdempotencia.chave == 'chave-3').values(
+            criada_em=datetime.utcnow() - timedelta(seconds=CONCESSAO_IDEMPOTENCIA_SEGUNDOS + 1)))
+        db.session.commit()
+        retomada = self.app.put(url, json={'status': 'em_transito'}, headers={'Idempotency-Key': 'chave-3'})
+        self.assertEqual(retomada.status_code, 200)
+        repetida = self.app.put(url, json={'status': 'em_transito'}, headers={'Idempotency-Key': 'chave-3'})
+        self.assertEqual(repetida.headers.get('Idempotent-Replayed'), 'true')
+        
+        # Erros de validação também são guardados
+        invalida = {'Idempotency-Key': 'chave-2'}
+        self.assertEqual(self.app.put(url, json={'status': 'x'}, headers=invalida).status_code, 400)
+        self.assertEqual(self.app.put(url, json={'status': 'x'}, headers=invalida).headers.get('Idempotent-Replayed'), 'true')
+        
+        db.session.execute(db.update(ChaveIdempotencia).values(expira_em=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+        resultado = app.test_cli_runner().invoke(args=['limpar-idempotencia'])
+        self.assertIn('3 chaves vencidas removidas', resultado.output)
+        response = self.app.put(url, json={'status': 'em_transito'}, headers=cabecalhos)
+        self.assertIsNone(response.headers.get('Idempotent-Replayed'))
+        self.assertEqual(Entrega.query.first().status, 'em_transito')
+    
+    def test_conflitos_nao_sao_guardados(self):
+        """Testar que 412 libera a chave e que a repetição devolve o ETag"""
+        url = '/api/entregas/EI1234567890/status'
+        cabecalhos = {'Idempotency-Key': 'chave-etag', 'If-Match': '"7"'}
+        self.assertEqual(self.app.put(url, json={'status': 'coletado'}, headers=cabecalhos).status_code, 412)
+        self.assertEqual(ChaveIdempotencia.query.count(), 0)
+        
+        cabecalhos['If-Match'] = '"1"'
+        primeira = self.app.put(url, json={'status': 'coletado'}, headers=cabecalhos)
+        repetida = self.app.put(url, json={'status': 'coletado'}, headers=cabecalhos)
+        self.assertEqual((primeira.status_code, repetida.status_code), (200, 200))
+        self.assertEqual(repetida.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(repetida.headers['ETag'], primeira.headers['ETag'])
+        self.assertEqual(repetida.headers['Content-Length'], primeira.headers['Content-Length'])
+
+
+class TestConcorrenciaOtimista(ExpressoItaporangaTestCase):
+    """Testes para a versão da entrega, ETag e If-Match"""
+    
+    url = '/api/entregas/EI1234567890/status'
+    
+    def atualizar(self, status, cabecalhos=None):
+        # Um cliente por thread; cada requisição tem o seu contexto e a sua sessão
+        return app.test_client().put(self.url, json={'status': status}, headers=cabecalhos or {})
+    
+    def test_if_match(self):
+        """Testar ETag da entrega e pré-condição do If-Match"""
+        etag = self.app.get('/api/entregas/EI1234567890').headers['ETag']
+        self.assertEqual(etag, '"1"')
+        
+        response = self.atualizar('coletado', {'If-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['ETag'], '"2"')
+        self.assertEqual(json.loads(response.data)['data']['versao'], 2)
+        
+        self.assertEqual(self.atualizar('em_transito', {'If-Match': etag}).status_code, 412)
+        self.assertEqual(self.atualizar('em_transito', {'If-Match': '"2"'}).status_code, 200)
+        self.assertEqual(self.atualizar('entregue', {'If-Match': '*'}).status_code, 200)
+        self.assertEqual(self.atualizar('entregue').status_code, 200)
+        self.assertEqual(Entrega.query.first().versao, 5)
+    
+    def test_atualizacoes_em_massa_mudam_a_versao(self):
+        """Testar que atribuir ou remover a rota muda o ETag"""
+        def etag_e_rota():
+            response = self.app.get('/api/entregas/EI1234567890')
+            return response.headers['ETag'], json.loads(response.data)['data']['rota_id']
+        
+        inicial, _ = etag_e_rota()
+        rota_id = json.loads(self.app.post('/api/rotas', json={
+            'nome': 'SP-PB', 'origem': 'São Paulo', 'destino': 'Itaporanga', 'distancia': 2100, 'tempo_estimado': '36h'
+        }).data)['id']
+        atribuir_rotas(reatribuir=True)
+        atribuida, rota = etag_e_rota()
+        self.assertEqual(rota, rota_id)
+        self.assertNotEqual(atribuida, inicial)
+        
+        self.app.delete(f'/api/rotas/{rota_id}')
+        removida, rota = etag_e_rota()
+        self.assertIsNone(rota)
+        self.assertNotEqual(removida, atribuida)
+        self.assertEqual(self.atualizar('coletado', {'If-Match': atribuida}).status_code, 412)
+    
+    def test_escritas_simultaneas(self):
+        """Testar muitas threads atualizando a mesma entrega"""
+        status = ['coletado', 'em_transito', 'entregue', 'cancelado']
+        
+        # Todas leram a versão 1: só uma escrita vence, as demais falham na pré-condição
+        with ThreadPoolExecutor(8) as executor:
+            respostas = list(executor.map(lambda i: self.atualizar(status[i % 4], {'If-Match': '"1"'}), range(24)))
+        codigos = [r.status_code for r in respostas]
+        self.assertEqual(codigos.count(200), 1, codigos)
+        self.assertEqual(set(codigos), {200, 412})
+        
+        # Sem If-Match os conflitos são refeitos sobre a versão atual; esgotadas as
+        # tentativas a resposta é 409, mas nenhuma escrita confirmada se perde
+        with ThreadPoolExecutor(8) as executor:
+            respostas = list(executor.map(lambda i: self.atualizar(status[i % 4]), range(40)))
+        self.assertLessEqual({r.status_code for r in respostas}, {200, 409})
+        versoes = sorted(json.loads(r.data)['data']['versao'] for r in respostas if r.status_code == 200)
+        self.assertGreater(len(versoes), 20)
+        self.assertEqual(versoes, list(range(3, 3 + len(versoes))))
+        db.session.expire_all()
+        self.assertEqual(Entrega.query.first().versao, 2 + len(versoes))
+
+
+class TestRastreioAssincrono(ExpressoItaporangaTestCase):
+    """Testes para a API assíncrona (ASGI) de rastreamento"""
+    
+    def setUp(self):
+        super().setUp()
+        try:
+            import aiosqlite
+        except ImportError:
+            self.skipTest('aiosqlite não instalado')
+        
+        self.app.post('/api/rotas', json={
+            'nome': 'SP-PB', 'origem': 'São Paulo', 'destino': 'Itaporanga',
+            'distancia': 2100, 'tempo_estimado': '1 dia e 12h'
+        })
+        self.em_transito, self.arquivada = [json.loads(self.app.post('/api/entregas', json={
+            'remetente_nome': 'João Silva', 'remetente_endereco': 'Rua A, 123',
+            'remetente_cidade': 'São Paulo/SP', 'destinatario_nome': 'Maria Santos',
+            'destinatario_endereco': 'Rua B, 456', 'destinatario_cidade': 'Itaporanga/PB',
+            'tipo_produto': 'Documentos'
+        }).data)['data']['codigo_rastreamento'] for _ in range(2)]
+        self.app.put(f'/api/entregas/{self.em_transito}/status', json={'status': 'em_transito'})
+        db.session.execute(db.update(Entrega).where(Entrega.codigo_rastreamento == self.arquivada).values(
+            status='entregue', data_atualizacao=datetime.utcnow() - timedelta(days=400)))
+        db.session.commit()
+        arquivar_entregas()
+    
+    def executar(self, *requisicoes, pool=2):
+        """Executa as requisições (método, caminho[, corpo]) ao mesmo tempo na aplicação ASGI"""
+        aplicacao = AplicacaoRastreio(db.engine.url, 0, pool_size=pool, max_overflow=0)
+        
+        async def requisitar(metodo, caminho, corpo=None):
+            mensagens = []
+            
+            async def receive():
+                return {'type': 'http.request', 'body': b'' if corpo is None else json.dumps(corpo).encode(),
+                        'more_body': False}
+            
+            async def send(mensagem):
+                mensagens.append(mensagem)
+            
+            await aplicacao({'type': 'http', 'method': metodo, 'path': caminho, 'headers': []}, receive, send)
+            cabecalhos = {nome.decode(): valor.decode() for nome, valor in mensagens[0]['headers']}
+            return mensagens[0]['status'], cabecalhos, json.loads(mensagens[1]['body'])
+        
+        async def todas():
+            try:
+                return await asyncio.gather(*(requisitar(*r) for r in requisicoes))
+            finally:
+                await aplicacao.encerrar()
+        
+        return asyncio.run(todas())
+    
+    def test_respostas_iguais_as_do_flask(self):
+        """Testar que as rotas ASGI respondem exatamente como as da aplicação Flask"""
+        casos = [
+            ('GET', '/api/rastrear/EI1234567890'),
+            ('GET', f'/api/rastrear/{self.em_transito}'),
+            ('GET', f'/api/rastrear/{self.arquivada}'),
+            ('GET', '/api/rastrear/EI0000000000'),
+            ('GET', f'/api/entregas/{self.em_transito}'),
+            ('GET', '/api/entregas/EI0000000000'),
+            ('POST', '/api/rastrear/lote',
+             {'codigos': [self.em_transito, 'EI0000000000', self.arquivada, 'EI1234567890', self.em_transito]}),
+            ('POST', '/api/rastrear/lote', {'codigos': []}),
+        ]
+        for (status, cabecalhos, dados), (metodo, caminho, *corpo) in zip(self.executar(*casos), casos):
+            response = self.app.open(caminho, method=metodo, json=corpo[0] if corpo else None)
+            self.assertEqual(status, response.status_code, caminho)
+            self.assertEqual(dados, json.loads(response.data), caminho)
+            self.assertEqual(cabecalhos.get('etag'), response.headers.get('ETag'), caminho)
+        
+        (_, _, rastreio), (_, _, lote) = self.executar(
+            ('GET', f'/api/rastrear/{self.em_transito}'), casos[6])
+        self.assertIsNotNone(rastreio['previsao_entrega'])
+        self.assertEqual((lote['total'], lote['encontrados']), (5, 4))
+        self.assertEqual([item['encontrado'] for item in lote['data']], [True, False, True, True, True])
+    
+    def test_rotas_e_concorrencia(self):
+        """Testar rotas desconhecidas e muitas requisições simultâneas com pool pequeno"""
+        (nao_encontrada, _, _), (metodo, cabecalhos, _), (busca, _, _) = self.executar(
+            ('GET', '/api/outra'), ('PUT', f'/api/rastrear/{self.em_transito}'), ('GET', '/api/entregas/busca'))
+        self.assertEqual((nao_encontrada, metodo, busca), (404, 405, 404))
+        self.assertEqual(cabecalhos['allow'], 'GET')
+        
+        codigos = ['EI1234567890', self.em_transito, self.arquivada, 'EI0000000000']
+        respostas = self.executar(*[('GET', f'/api/rastrear/{codigos[i % 4]}') for i in range(200)], pool=2)
+        self.assertEqual({status for status, _, _ in respostas}, {200})
+        self.assertEqual([dados['encontrado'] for _, _, dados in respostas[:4]], [True, True, True, False])
+
+
 class TestAPIEstatisticas(ExpressoItaporangaTestCase):
     """Testes para a API de estatísticas"""
     
@@ -335,6 +1809,110 @@ class TestValidacoes(ExpressoItaporangaTestCase):
         self.assertTrue(codigo1.startswith('EI'))
         self.assertTrue(codigo2.startswith('EI'))
 
+class TestOrcamentoConsultas(ExpressoItaporangaTestCase):
+    """Testes de orçamento de consultas SQL por endpoint"""
+    
+    def setUp(self):
+        super().setUp()
+        self.codigos = semear_entregas(db, Entrega, 200)
+    
+    def assertDentroDoOrcamento(self, endpoint, metodo, url, **kwargs):
+        with ContadorConsultas(db.engine) as contador:
+            response = getattr(self.app, metodo)(url, **kwargs)
+        self.assertLess(response.status_code, 400)
+        self.assertLessEqual(contador.total, ORCAMENTO_CONSULTAS[endpoint],
+                             f'{endpoint} executou {contador.total} consultas')
+    
+    def test_orcamento_rastrear(self):
+        """Testar consultas do rastreamento público"""
+        self.assertDentroDoOrcamento('api_rastrear', 'get', f'/api/rastrear/{self.codigos[0]}')
+    
+    def test_orcamento_listar_entregas(self):
+        """Testar que a listagem não executa consultas por linha"""
+        self.assertDentroDoOrcamento('api_entregas', 'get', '/api/entregas')
+    
+    def test_orcamento_estatisticas(self):
+        """Testar consultas das estatísticas gerais"""
+        self.assertDentroDoOrcamento('api_estatisticas', 'get', '/api/estatisticas')
+    
+    def test_orcamento_criar_entrega(self):
+        """Testar consultas da criação de entrega"""
+        self.assertDentroDoOrcamento('api_criar_entrega', 'post', '/api/entregas', json={
+            'remetente_nome': 'Pedro Costa',
+            'remetente_endereco': 'Rua C, 789',
+            'remetente_cidade': 'Recife/PE',
+            'destinatario_nome': 'Ana Lima',
+            'destinatario_endereco': 'Rua D, 321',
+            'destinatario_cidade': 'Itaporanga/PB',
+            'tipo_produto': 'Eletrônicos'
+        })
+    
+    def test_orcamento_atualizar_status(self):
+        """Testar consultas da atualização de status"""
+        self.assertDentroDoOrcamento('api_atualizar_status', 'put',
+                                     f'/api/entregas/{self.codigos[0]}/status',
+                                     json={'status': 'em_transito'})
+    
+    def test_benchmark_confere_status(self):
+        """Testar que o benchmark acusa respostas com status inesperado"""
+        # Os templates do painel não fazem parte dos testes
+        sem_painel = [c for c in cenarios(self.codigos) if c[0] != 'dashboard']
+        with mock.patch('benchmark_endpoints.cenarios', return_value=sem_painel):
+            resultados = {'endpoints': medir_cenarios(app, db, self.codigos, repeticoes=2)}
+        self.assertEqual(verificar_status(resultados), [])
+        
+        sem_painel = [c for c in cenarios(['EI0000000000']) if c[0] != 'dashboard']
+        with mock.patch('benchmark_endpoints.cenarios', return_value=sem_painel):
+            resultados = {'endpoints': medir_cenarios(app, db, ['EI0000000000'], repeticoes=1)}
+        self.assertIn('api_atualizar_status: status 404 (esperado 200)', verificar_status(resultados))
+
+class TestGeradorCarga(ExpressoItaporangaTestCase):
+    """Testes para as funções auxiliares do gerador de carga"""
+    
+    def test_interpretar_mix(self):
+        """Testar leitura do mix de tráfego e rejeição de mixes inválidos"""
+        self.assertEqual(interpretar_mix('rastrear=80, criar=10,status=5,dashboard=5'),
+                         (['rastrear', 'criar', 'status', 'dashboard'], [80.0, 10.0, 5.0, 5.0]))
+        self.assertEqual(interpretar_mix('rastrear'), (['rastrear'], [1.0]))
+        with self.assertRaises(ValueError):
+            interpretar_mix('rastrear=80,excluir=20')
+        with self.assertRaises(ValueError):
+            interpretar_mix('rastrear=0')
+        with self.assertRaises(ValueError):
+            interpretar_mix('rastrear=muito')
+    
+    def test_ler_log_acesso(self):
+        """Testar extração das requisições de um log no formato Combined"""
+        linhas = [
+            '127.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /api/rastrear/EI1234567890 HTTP/1.1" 200 512 "-" "curl"',
+            'linha sem requisição',
+            '10.0.0.2 - - [19/Oct/2026:10:00:01 -0300] "POST /api/entregas HTTP/1.0" 201 90',
+            '10.0.0.3 - - [data inválida] "HEAD /gestao HTTP/1.1" 302 0',
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False, encoding='utf-8') as arquivo:
+            arquivo.write('\n'.join(linhas))
+        try:
+            entradas = ler_log_acesso(arquivo.name)
+        finally:
+            os.remove(arquivo.name)
+        
+        self.assertEqual([(metodo, caminho) for _, metodo, caminho in entradas], [
+            ('GET', '/api/rastrear/EI1234567890'), ('POST', '/api/entregas'), ('HEAD', '/gestao')
+        ])
+        self.assertEqual(entradas[1][0] - entradas[0][0], 3 * 3600 + 1)
+        self.assertIsNone(entradas[2][0])
+    
+    def test_percentil(self):
+        """Testar percentis por interpolação linear"""
+        self.assertEqual(percentil([], 50), 0.0)
+        self.assertEqual(percentil([7.0], 99), 7.0)
+        valores = [1.0, 2.0, 3.0, 4.0]
+        self.assertEqual(percentil(valores, 0), 1.0)
+        self.assertEqual(percentil(valores, 50), 2.5)
+        self.assertEqual(percentil(valores, 100), 4.0)
+        self.assertAlmostEqual(percentil(list(range(101)), 99), 99.0)
+        self.assertAlmostEqual(percentil(valores, 90), 3.7)
+
 def run_tests():
     """Executar todos os testes"""
     # Descobrir e executar todos os testes